@@ -0,0 +1,160 @@
+"""git_clone against real git and local bare repositories.
+
+    python3 -m benchmarks.git_clone              # exits with 1 if a check fails
+
+Runs syncsmith in a sandbox with the system git (see Sandbox(real_git=True))
+on file:// bare repositories, and checks that clones are made and updated
+(also shallow), that prefetch leaves the clone alone, that clones made with a
+reference repository keep working after its refs are force-updated (as
+`reference: true` does with REFERENCE_REPO) and it is pruned, and that a
+failing clone fails the run. REFERENCE_REPO itself is in the real user's
+home, so the reference check uses one in the sandbox.
+"""
+import subprocess
+import sys
+
+from benchmarks.sandbox import Sandbox
+
+GIT_ENV = {"GIT_AUTHOR_NAME": "syncsmith", "GIT_AUTHOR_EMAIL": "syncsmith@localhost",
+           "GIT_COMMITTER_NAME": "syncsmith", "GIT_COMMITTER_EMAIL": "syncsmith@localhost"}
+
+
+class Remote:
+    """A bare repository in the sandbox, with a work tree to commit from."""
+
+    def __init__(self, sandbox, name):
+        self.sandbox = sandbox
+        self.bare = sandbox.path / "remotes" / f"{name}.git"
+        self.work = sandbox.path / "remotes" / f"{name}-work"
+        self.url = f"file://{self.bare}"
+        self.git("init", "--quiet", "--bare", "--initial-branch=main", str(self.bare))
+        self.git("init", "--quiet", "--initial-branch=main", str(self.work))
+        self.commits = 0
+        self.commit()
+
+    def git(self, *args, cwd=None):
+        env = dict(self.sandbox.env(), **GIT_ENV)
+        return subprocess.run(["git", *args], cwd=cwd, env=env, check=True, capture_output=True, text=True).stdout.strip()
+
+    def commit(self, amend=False):
+        """Add a commit (or replace the last one) and push it, returns its hash."""
+        self.commits += 1
+        (self.work / "file.txt").write_text(f"version {self.commits}\n")
+        self.git("add", "file.txt", cwd=self.work)
+        self.git("commit", "--quiet", *(["--amend"] if amend else []), "-m", f"version {self.commits}", cwd=self.work)
+        self.git("push", "--quiet", "--force", self.url, "main", cwd=self.work)
+        return self.head()
+
+    def head(self):
+        return self.git("--git-dir", str(self.bare), "rev-parse", "main")
+
+
+def clone_head(sandbox, path):
+    proc = subprocess.run(["git", "-C", str(path), "rev-parse", "HEAD"], env=sandbox.env(), capture_output=True, text=True)
+    return proc.stdout.strip() if proc.returncode == 0 else None
+
+
+def run(sandbox, modules):
+    sandbox.write_config({"modules": modules})
+    proc = subprocess.run([sys.executable, str(sandbox.app / "syncsmith.py"), "--apply", "--force"], cwd=sandbox.app,
+                          env=sandbox.env(), capture_output=True, text=True)
+    return proc.returncode, proc.stdout + proc.stderr
+
+
+def check_clone_and_update(sandbox):
+    remote = Remote(sandbox, "plain")
+    shallow = Remote(sandbox, "shallow")
+    modules = [{"name": "git_clone", "url": remote.url, "path": str(sandbox.home / "plain"), "absolute_path": True},
+               {"name": "git_clone", "url": shallow.url, "path": str(sandbox.home / "shallow"), "depth": 1, "absolute_path": True}]
+    code, output = run(sandbox, modules)
+    if code != 0 or clone_head(sandbox, sandbox.home / "plain") != remote.head() or clone_head(sandbox, sandbox.home / "shallow") != shallow.head():
+        return f"clone failed:\n{output}"
+    remote.commit()
+    shallow.commit()
+    code, output = run(sandbox, modules)
+    if code != 0 or clone_head(sandbox, sandbox.home / "plain") != remote.head():
+        return f"update failed:\n{output}"
+    if clone_head(sandbox, sandbox.home / "shallow") != shallow.head():
+        return f"shallow update failed:\n{output}"
+    return None
+
+
+def check_prefetch_side_effect_free(sandbox):
+    remote = Remote(sandbox, "prefetch")
+    path = sandbox.home / "prefetch"
+    code, output = run(sandbox, [{"name": "git_clone", "url": remote.url, "path": str(path), "absolute_path": True}])
+    if code != 0:
+        return f"clone failed:\n{output}"
+    new_head = remote.commit()
+    before = sorted(str(p.relative_to(path)) for p in (path / ".git").rglob("*"))
+    staging = sandbox.path / "prefetch-staging"
+    staging.mkdir()
+    sandbox.python("-c", "import json, sys; from modules.git_clone import GitClone; "
+                         "GitClone.prefetch(json.loads(sys.argv[1]), sys.argv[2], sys.argv[3], sys.argv[4])",
+                   f'{{"url": "{remote.url}", "path": "{path}"}}', sandbox.user, str(sandbox.home), str(staging))
+    after = sorted(str(p.relative_to(path)) for p in (path / ".git").rglob("*"))
+    if before != after:
+        return f"prefetch changed the clone: {sorted(set(after) ^ set(before))}"
+    if subprocess.run(["git", "-C", str(path), "cat-file", "-e", new_head], env=sandbox.env(), capture_output=True).returncode == 0:
+        return "prefetch fetched into the clone"
+    staged = list(staging.glob("*.git"))
+    if not staged or subprocess.run(["git", "--git-dir", str(staged[0]), "cat-file", "-e", new_head], env=sandbox.env(), capture_output=True).returncode != 0:
+        return "prefetch did not download the new commit"
+    return None
+
+
+def check_reference(sandbox):
+    remote = Remote(sandbox, "referenced")
+    reference = sandbox.path / "reference.git"
+    remote.git("init", "--quiet", "--bare", str(reference))
+
+    def update_reference():
+        remote.git("--git-dir", str(reference), "fetch", "--quiet", remote.url, "+refs/heads/main:refs/syncsmith/referenced")
+
+    update_reference()
+    modules = [{"name": "git_clone", "url": remote.url, "path": str(sandbox.home / f"ref{i}"), "reference": str(reference), "absolute_path": True} for i in range(2)]
+    code, output = run(sandbox, modules)
+    if code != 0:
+        return f"clone with reference failed:\n{output}"
+    # Rewrite the history the reference repository holds and drop what is no longer referenced
+    remote.commit(amend=True)
+    update_reference()
+    code, output = run(sandbox, [dict(modules[0], path=str(sandbox.home / "ref2"))])
+    if code != 0:
+        return f"second clone with reference failed:\n{output}"
+    remote.git("--git-dir", str(reference), "reflog", "expire", "--expire=now", "--all")
+    remote.git("--git-dir", str(reference), "gc", "--quiet", "--prune=now")
+    for i in range(3):
+        path = sandbox.home / f"ref{i}"
+        if (path / ".git" / "objects" / "info" / "alternates").exists():
+            return f"{path} still borrows objects from the reference repository"
+        fsck = subprocess.run(["git", "-C", str(path), "fsck", "--full"], env=sandbox.env(), capture_output=True, text=True)
+        if fsck.returncode != 0:
+            return f"{path} is broken after gc in the reference repository:\n{fsck.stdout}{fsck.stderr}"
+    return None
+
+
+def check_failure(sandbox):
+    code, output = run(sandbox, [{"name": "git_clone", "url": f"file://{sandbox.path}/missing.git", "path": str(sandbox.home / "missing"), "absolute_path": True}])
+    if code == 0:
+        return f"a failing clone did not fail the run:\n{output}"
+    return None
+
+
+CHECKS = [check_clone_and_update, check_prefetch_side_effect_free, check_reference, check_failure]
+
+
+def main():
+    failed = False
+    for check in CHECKS:
+        with Sandbox(real_git=True) as sandbox:
+            error = check(sandbox)
+        failed = failed or error is not None
+        print(f"{check.__name__[len('check_'):]:<28} {'ok' if error is None else 'FAILED'}")
+        if error:
+            print("    " + error.replace("\n", "\n    "))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
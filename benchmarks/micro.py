@@ -0,0 +1,152 @@
+"""In-process micro benchmarks. Run inside a sandbox app by `benchmarks.run`:
+
+    python3 -m benchmarks.micro parse '{"entries": 5000, "depth": 6}'
+
+Prints a JSON object mapping benchmark names to the best time in seconds.
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+from globals import FILES_DIR
+
+
+def _best(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_parse(entries=5000, depth=6, repeat=5):
+    from benchmarks.synthetic import make_config
+    from utils.conditional_config import ConditionalConfig
+
+    config, env = make_config("/nonexistent", entries=entries, depth=depth)
+    return {"parse": _best(lambda: ConditionalConfig.parse(config, env), repeat)}
+
+
+def bench_filesync(target_dir, tree_dirs, repeat=3):
+    from modules.__filesync_backbone import build_entries, apply_entries
+    from modules.copy import Copy
+
+    copy = Copy()
+    configs = [{"source": f"{tree}/*", "target": os.path.join(target_dir, tree) + "/"} for tree in tree_dirs]
+
+    def build():
+        for config in configs:
+            list(build_entries(config["source"], config["target"]))
+
+    def apply():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for config in configs:
+                apply_entries(config, copy._apply_one, copy.is_synced_file)
+
+    results = {"build_entries": _best(build, repeat)}
+    start = time.perf_counter()
+    apply()
+    results["apply_entries_cold"] = time.perf_counter() - start
+    results["apply_entries_warm"] = _best(apply, repeat)
+    return results
+
+
+def bench_gnome(keys=2000, custom=500, repeat=3):
+    from benchmarks.synthetic import make_dconf_dump
+    from modules.gnome_sync import GnomeSync
+
+    gnome = GnomeSync()
+    os.makedirs(os.path.join(FILES_DIR, "gnome_sync"), exist_ok=True)
+
+    def parse(text):
+        path = os.path.join(FILES_DIR, "gnome_sync", "bench-input")
+        with open(path, "w") as f:
+            f.write(text)
+        return gnome._parse_gnome_keybindings(path)
+
+    global_kb = parse(make_dconf_dump(keys, custom, seed=1))
+    local_kb = parse(make_dconf_dump(keys, custom, seed=2))
+    previous_kb = parse(make_dconf_dump(keys, custom, seed=3))
+    exceptions = [{"name": f"Custom {i}"} for i in range(0, custom, 10)]
+
+    def generate():
+        with contextlib.redirect_stdout(io.StringIO()):
+            gnome._generate_gnome_keybindings("settings-daemon/plugins/media-keys", dict(local_kb), dict(previous_kb), dict(global_kb), exceptions)
+
+    return {"gnome_keybindings": _best(generate, repeat)}
+
+
+def bench_dconf(keys=20000, custom=5000, repeat=3):
+    """The generic three-way merge next to the gnome_sync merge it generalises, on the same dumps."""
+    from benchmarks.synthetic import make_dconf_dump
+    from modules.__dconf_merge import merge, parse_keyfile
+    from modules.gnome_sync import GnomeSync
+
+    base = "/org/gnome/settings-daemon/plugins/media-keys"
+    dumps = [make_dconf_dump(keys, custom, seed=seed) for seed in (1, 2, 3)]
+    global_values, local_values, previous_values = (parse_keyfile(dump, base) for dump in dumps)
+    rules = [{"key": f"{base}/custom-keybindings/custom{i}/binding"} for i in range(0, custom, 10)] + [{"key": "*/action-1?"}]
+
+    results = {
+        "dconf_parse": _best(lambda: parse_keyfile(dumps[0], base), repeat),
+        "dconf_merge": _best(lambda: merge(global_values, local_values, previous_values, rules), repeat),
+    }
+
+    gnome = GnomeSync()
+    os.makedirs(os.path.join(FILES_DIR, "gnome_sync"), exist_ok=True)
+    global_kb, local_kb, previous_kb = (gnome._parse_gnome_keybindings_text(dump) for dump in dumps)
+    exceptions = [{"name": f"Custom {i}"} for i in range(0, custom, 10)]
+
+    def legacy():
+        with contextlib.redirect_stdout(io.StringIO()):
+            gnome._generate_gnome_keybindings("settings-daemon/plugins/media-keys", dict(local_kb), dict(previous_kb), dict(global_kb), exceptions)
+
+    results["dconf_merge_gnome_sync"] = _best(legacy, repeat)
+    return results
+
+
+def bench_edit(lines=20000, patterns=500, repeat=3):
+    """edit_file modifications batched by the edit engine next to applying them one by one."""
+    import random
+    from modules.__edit_engine import _apply_one, apply_modifications
+
+    rng = random.Random(1)
+    words = [f"key_{i}_{rng.randrange(1 << 30):x}=" for i in range(patterns)]
+    content = "\n".join(f"{rng.choice(words)} value {i}" for i in range(lines)) + "\n"
+    modifications = [{"replace": word, "with": f"renamed_{i}:"} for i, word in enumerate(words)]
+    modifications += [{"delete": f"{word} value {i}"} for i, word in enumerate(words)]
+    modifications += [{"add": f"added line {i}"} for i in range(patterns)]
+
+    def sequential():
+        result = content
+        for modification in modifications:
+            result = _apply_one(result, modification)
+        return result
+
+    def quiet(fn):
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn()
+
+    return {
+        "edit_sequential": _best(lambda: quiet(sequential), repeat),
+        "edit_batched": _best(lambda: quiet(lambda: apply_modifications(content, modifications)), repeat),
+    }
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "filesync": bench_filesync,
+    "gnome": bench_gnome,
+    "dconf": bench_dconf,
+    "edit": bench_edit,
+}
+
+
+if __name__ == "__main__":
+    name = sys.argv[1]
+    params = json.loads(sys.argv[2]) if len(sys.argv) > 2 else {}
+    print(json.dumps(BENCHMARKS[name](**params)))
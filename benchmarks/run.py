@@ -0,0 +1,140 @@
+"""Syncsmith benchmark suite.
+
+    python3 -m benchmarks.run            # full suite
+    python3 -m benchmarks.run --quick    # smaller inputs
+    python3 -m benchmarks.run --only parse e2e
+
+Everything runs in a throwaway sandbox (see benchmarks/sandbox.py). Results
+are appended to benchmarks/results/results.jsonl together with the current
+git commit, and each run is compared with the last stored result from a
+different commit so regressions are visible.
+"""
+import argparse
+import json
+import subprocess
+import time
+from pathlib import Path
+
+from benchmarks.sandbox import Sandbox, REPO_DIR
+from benchmarks.synthetic import make_config, make_dconf_db, make_files_tree
+
+RESULTS_FILE = Path(__file__).resolve().parent / "results" / "results.jsonl"
+
+SIZES = {
+    "full": {"entries": 5000, "depth": 8, "tree_dirs": 40, "files_per_dir": 100, "dconf_keys": 5000, "dconf_custom": 1000, "merge_keys": 20000, "merge_custom": 5000, "edit_lines": 20000, "edit_patterns": 500, "e2e_entries": 300},
+    "quick": {"entries": 1000, "depth": 4, "tree_dirs": 5, "files_per_dir": 20, "dconf_keys": 500, "dconf_custom": 100, "merge_keys": 2000, "merge_custom": 500, "edit_lines": 5000, "edit_patterns": 100, "e2e_entries": 50},
+}
+
+
+def _micro(sandbox, name, **params):
+    return json.loads(sandbox.python("-m", "benchmarks.micro", name, json.dumps(params)))
+
+
+def bench_parse(sandbox, size):
+    return _micro(sandbox, "parse", entries=size["entries"], depth=size["depth"])
+
+
+def bench_filesync(sandbox, size):
+    tree_dirs = make_files_tree(sandbox.files, dirs=size["tree_dirs"], files_per_dir=size["files_per_dir"])
+    return _micro(sandbox, "filesync", target_dir=str(sandbox.root / "filesync"), tree_dirs=tree_dirs)
+
+
+def bench_gnome(sandbox, size):
+    return _micro(sandbox, "gnome", keys=size["dconf_keys"], custom=size["dconf_custom"])
+
+
+def bench_dconf(sandbox, size):
+    return _micro(sandbox, "dconf", keys=size["merge_keys"], custom=size["merge_custom"])
+
+
+def bench_edit(sandbox, size):
+    return _micro(sandbox, "edit", lines=size["edit_lines"], patterns=size["edit_patterns"])
+
+
+def bench_e2e(sandbox, size):
+    url = sandbox.start_http()
+    (sandbox.www / "payload.txt").write_text("payload\n" * 1000)
+    (sandbox.files / "bench.txt").write_text("hello world\n" * 100)
+    (sandbox.path / "dconf.ini").write_text(make_dconf_db("org/gnome/settings-daemon/plugins/media-keys"))
+    tree_dirs = make_files_tree(sandbox.files, name="e2e", dirs=4, files_per_dir=20)
+
+    config, env = make_config(str(sandbox.path), entries=size["e2e_entries"], depth=3, tree_dirs=tree_dirs, url=url)
+    config["modules"].append({"name": "gnome_sync", "shortcut_exceptions": []})
+    config["modules"].append({"name": "dconf_sync", "paths": ["/org/gnome/settings-daemon/plugins/media-keys/"]})
+    sandbox.write_config(config, env)
+
+    results = {}
+    sandbox.reset_state()
+    results["e2e_cold"] = sandbox.run("--apply")
+    results["e2e_warm"] = sandbox.run("--apply", "--force")
+    results["e2e_noop"] = sandbox.run("--apply")
+    results["e2e_warm_jobs4"] = sandbox.run("--apply", "--force", "--jobs", "4")
+    return results
+
+
+def bench_startup(sandbox, size):
+    from benchmarks.startup import measure
+    return {f"startup_imports_{name}": total_ms / 1000 for name, (total_ms, _) in measure(sandbox).items()}
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "filesync": bench_filesync,
+    "gnome": bench_gnome,
+    "dconf": bench_dconf,
+    "edit": bench_edit,
+    "e2e": bench_e2e,
+    "startup": bench_startup,
+}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _previous_results(commit, profile):
+    if not RESULTS_FILE.exists():
+        return None
+    previous = None
+    with open(RESULTS_FILE) as f:
+        for line in f:
+            record = json.loads(line)
+            if record["commit"] != commit and record["profile"] == profile:
+                previous = record
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run syncsmith benchmarks in a hermetic sandbox")
+    parser.add_argument("--quick", action="store_true", help="Use small inputs")
+    parser.add_argument("--only", nargs="*", choices=list(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--no-save", action="store_true", help="Do not store the results")
+    args = parser.parse_args()
+
+    profile = "quick" if args.quick else "full"
+    size = SIZES[profile]
+    results = {}
+    for name in args.only or BENCHMARKS:
+        with Sandbox() as sandbox:
+            results.update(BENCHMARKS[name](sandbox, size))
+
+    commit = _git_commit()
+    previous = _previous_results(commit, profile)
+    for name, seconds in results.items():
+        line = f"{name:<24} {seconds * 1000:10.1f} ms"
+        if previous and name in previous["results"]:
+            before = previous["results"][name]
+            line += f"   ({(seconds - before) / before * 100:+.0f}% vs {previous['commit']})"
+        print(line)
+
+    if not args.no_save:
+        RESULTS_FILE.parent.mkdir(exist_ok=True)
+        with open(RESULTS_FILE, "a") as f:
+            f.write(json.dumps({"commit": commit, "profile": profile, "time": int(time.time()), "results": results}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
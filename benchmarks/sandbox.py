@@ -0,0 +1,182 @@
+"""Hermetic sandbox for running syncsmith in benchmarks.
+
+A sandbox is a temporary directory holding a copy of the syncsmith code
+(`app/`), a fake home (`home/`), a fake system root for /etc-style targets
+(`root/`), stand-in `sudo`, `dconf`, `systemctl` and `git` binaries
+(`bin/`) and a local HTTP server serving `www/`. Nothing outside the sandbox
+is written to. With `real_git=True` the system git is used instead of the
+stand-in, for runs against local bare repositories.
+"""
+import http.server
+import os
+import pwd
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import yaml
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+APP_ITEMS = ["syncsmith.py", "globals.py", "modules", "utils", "benchmarks"]
+
+STUBS = {
+    # Drop sudo's options and run the command as the current user
+    "sudo": """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -u) shift 2 ;;
+        -*) shift ;;
+        *) break ;;
+    esac
+done
+exec "$@"
+""",
+    "systemctl": """#!/bin/sh
+echo "systemctl $*" >> "$SANDBOX/systemctl.log"
+""",
+    # Keeps the dconf database as a keyfile in the sandbox
+    "dconf": """#!/usr/bin/env python3
+import configparser, os, sys
+db_path = os.path.join(os.environ["SANDBOX"], "dconf.ini")
+db = configparser.ConfigParser(interpolation=None)
+db.optionxform = str
+db.read(db_path)
+cmd, base = sys.argv[1], sys.argv[2].strip("/")
+if cmd == "dump":
+    for section in db.sections():
+        if section == base or section.startswith(base + "/"):
+            rel = section[len(base):].strip("/") or "/"
+            print(f"[{rel}]")
+            for key, value in db[section].items():
+                print(f"{key}={value}")
+            print()
+elif cmd == "load":
+    data = configparser.ConfigParser(interpolation=None)
+    data.optionxform = str
+    data.read_string(sys.stdin.read())
+    for section in data.sections():
+        full = base if section == "/" else f"{base}/{section}".strip("/")
+        if not db.has_section(full):
+            db.add_section(full)
+        for key, value in data[section].items():
+            db[full][key] = value
+    with open(db_path, "w") as f:
+        db.write(f, space_around_delimiters=False)
+elif cmd == "reset":
+    section, key = base.rsplit("/", 1)
+    if db.has_section(section):
+        db.remove_option(section, key)
+        with open(db_path, "w") as f:
+            db.write(f, space_around_delimiters=False)
+""",
+    "git": """#!/bin/sh
+echo "git $*" >> "$SANDBOX/git.log"
+if [ "$1" = "clone" ]; then
+    for last; do true; done
+    mkdir -p "$last/.git"
+fi
+""",
+}
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Sandbox:
+    def __init__(self, base_dir=None, real_git=False):
+        self.path = Path(tempfile.mkdtemp(prefix="syncsmith-bench-", dir=base_dir))
+        self.app = self.path / "app"
+        self.home = self.path / "home"
+        self.root = self.path / "root"
+        self.bin = self.path / "bin"
+        self.www = self.path / "www"
+        self.user = pwd.getpwuid(os.getuid()).pw_name
+        self.server = None
+
+        for item in APP_ITEMS:
+            src = REPO_DIR / item
+            if src.is_dir():
+                shutil.copytree(src, self.app / item, ignore=shutil.ignore_patterns("__pycache__", "results"))
+            else:
+                self.app.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(src, self.app / item)
+        for directory in (self.home, self.root, self.bin, self.www, self.app / "files"):
+            directory.mkdir(parents=True, exist_ok=True)
+        for name, script in STUBS.items():
+            if real_git and name == "git":
+                continue
+            stub = self.bin / name
+            stub.write_text(script)
+            stub.chmod(0o755)
+
+    @property
+    def files(self):
+        return self.app / "files"
+
+    def start_http(self):
+        handler = lambda *a, **kw: _QuietHandler(*a, directory=str(self.www), **kw)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def write_config(self, config, env=None):
+        with open(self.app / "config.yaml", "w") as f:
+            yaml.safe_dump(config, f, sort_keys=False)
+        env = dict(env or {})
+        env.setdefault("user", self.user)
+        env.setdefault("tags", [])
+        with open(self.app / "environment.yaml", "w") as f:
+            yaml.safe_dump(env, f, sort_keys=False)
+
+    def reset_state(self):
+        """Forget everything a previous run left behind, for cold runs."""
+        for name in ("compiled_files", "compiled_generations", "state"):
+            shutil.rmtree(self.app / name, ignore_errors=True)
+        for directory in (self.home, self.root):
+            shutil.rmtree(directory, ignore_errors=True)
+            directory.mkdir()
+
+    def env(self):
+        env = os.environ.copy()
+        env.update({
+            "SANDBOX": str(self.path),
+            "HOME": str(self.home),
+            "USER": self.user,
+            "PATH": f"{self.bin}:{env.get('PATH', '')}",
+            "PYTHONDONTWRITEBYTECODE": "1",
+        })
+        return env
+
+    def run(self, *args, check=True):
+        """Run syncsmith.py in the sandbox and return the elapsed wall time."""
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, str(self.app / "syncsmith.py"), *args], cwd=self.app, env=self.env(), capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+        if check and proc.returncode != 0:
+            raise RuntimeError(f"syncsmith failed in sandbox {self.path}:\n{proc.stdout}\n{proc.stderr}")
+        return elapsed
+
+    def python(self, *args):
+        """Run a Python module inside the sandbox app and return its stdout."""
+        proc = subprocess.run([sys.executable, *args], cwd=self.app, env=self.env(), capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"{' '.join(args)} failed in sandbox {self.path}:\n{proc.stdout}\n{proc.stderr}")
+        return proc.stdout
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
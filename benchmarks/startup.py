@@ -0,0 +1,81 @@
+"""Startup budget: how much syncsmith imports before it gets to work.
+
+    python3 -m benchmarks.startup              # exits with 1 if over budget
+    python3 -m benchmarks.startup --verbose    # and list the slowest imports
+
+Runs `syncsmith.py --help` and a run with nothing to do (the same config
+again) in a sandbox under `python -X importtime`, and checks the import time
+against BUDGET_MS. Timings depend on the machine, so the modules in HEAVY are
+checked too: neither run may import them at all, they are only needed once
+there is something to do.
+"""
+import argparse
+import subprocess
+import sys
+
+from benchmarks.sandbox import Sandbox
+
+# Import time in ms, as measured under -X importtime (which adds some overhead)
+BUDGET_MS = {"help": 70, "noop": 80}
+REPEAT = 5
+
+HEAVY = ["yaml", "inspect", "concurrent.futures", "utils.conditional_config", "utils.module_worker",
+         "utils.scheduler", "utils.journal", "utils.backups", "utils.drift", "utils.watch", "modules.__syncsmith_module"]
+
+
+def import_times(sandbox, *args):
+    """{module: (self us, cumulative us)} of what `syncsmith.py *args` imports, and the top-level total in us."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", str(sandbox.app / "syncsmith.py"), *args],
+                          cwd=sandbox.app, env=sandbox.env(), capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"syncsmith {' '.join(args)} failed in sandbox {sandbox.path}:\n{proc.stdout}\n{proc.stderr}")
+    modules = {}
+    total = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+        # Nested imports are indented below the one that caused them
+        if not name.startswith("  "):
+            total += int(cumulative_us)
+    return modules, total
+
+
+def measure(sandbox):
+    """{"help": ..., "noop": ...}: (best total import time in ms, modules imported) of each."""
+    (sandbox.files / "startup.txt").write_text("startup\n")
+    sandbox.write_config({"modules": [{"name": "copy", "source": "startup.txt", "target": str(sandbox.home / "startup.txt")}]})
+    sandbox.run("--apply")
+    results = {}
+    for name, args in (("help", ["--help"]), ("noop", ["--apply"])):
+        runs = [import_times(sandbox, *args) for _ in range(REPEAT)]
+        modules, total = min(runs, key=lambda run: run[1])
+        results[name] = (total / 1000, modules)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check syncsmith's startup imports against their budget")
+    parser.add_argument("--verbose", "-v", action="store_true", help="List the slowest imports")
+    args = parser.parse_args()
+
+    with Sandbox() as sandbox:
+        results = measure(sandbox)
+
+    over = False
+    for name, (total_ms, modules) in results.items():
+        heavy = [module for module in HEAVY if module in modules]
+        ok = total_ms <= BUDGET_MS[name] and not heavy
+        over = over or not ok
+        print(f"{name:<6} {total_ms:8.1f} ms  (budget {BUDGET_MS[name]} ms)  {'ok' if ok else 'OVER'}")
+        if heavy:
+            print(f"       imports {', '.join(heavy)}")
+        if args.verbose:
+            for module, (self_us, cumulative_us) in sorted(modules.items(), key=lambda item: -item[1][0])[:15]:
+                print(f"       {self_us / 1000:6.1f} ms  {module}")
+    sys.exit(1 if over else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Generators for synthetic benchmark inputs: configs, files/ trees and dconf dumps."""
+import os
+import random
+
+
+def make_files_tree(files_dir, name="tree", dirs=20, files_per_dir=50, size=2048, seed=0):
+    """Create files/<name>/d<i>/f<j>.txt and return the directory names below files/."""
+    rng = random.Random(seed)
+    created = []
+    for i in range(dirs):
+        rel = f"{name}/d{i}"
+        directory = os.path.join(files_dir, rel)
+        os.makedirs(directory, exist_ok=True)
+        for j in range(files_per_dir):
+            with open(os.path.join(directory, f"f{j}.txt"), "wb") as f:
+                f.write(rng.randbytes(size))
+        created.append(rel)
+    return created
+
+
+def make_dconf_dump(keys=500, custom=100, seed=0):
+    """Return a `dconf dump`-style keyfile with `keys` root keys and `custom` custom keybindings."""
+    rng = random.Random(seed)
+    lines = ["[/]"]
+    for i in range(keys):
+        lines.append(f"action-{i}=['<Super><Alt>{rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ')}{i}']")
+    if custom:
+        root = "/org/gnome/settings-daemon/plugins/media-keys/custom-keybindings"
+        lines.append("custom-keybindings=" + str([f"{root}/custom{i}/" for i in range(custom)]))
+    lines.append("")
+    for i in range(custom):
+        lines += [
+            f"[custom-keybindings/custom{i}]",
+            f"binding='<Super><Shift>{i}'",
+            f"command='command-{i}'",
+            f"name='Custom {i}'",
+            "",
+        ]
+    return "\n".join(lines)
+
+
+def make_dconf_db(base, keys=200, custom=20, seed=0):
+    """Like `make_dconf_dump`, but with absolute section names for the sandbox dconf stand-in."""
+    lines = []
+    for line in make_dconf_dump(keys, custom, seed).splitlines():
+        if line == "[/]":
+            line = f"[{base}]"
+        elif line.startswith("["):
+            line = f"[{base}/{line[1:]}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _leaf_entries(index, sandbox_dir, tree_dirs, url):
+    """A handful of module entries touching disjoint sandbox paths."""
+    entries = [
+        {"name": "symlink", "source": "bench.txt", "target": f"{sandbox_dir}/home/links/link{index}"},
+        {"name": "edit_file", "file": "bench.txt", "output": f"edited/bench{index}.txt",
+         "modifications": [{"add": f"line {index}"}, {"replace": "hello", "with": f"hello {index}"}]},
+        {"name": "systemctl_exec", "command": "daemon-reload --user"},
+    ]
+    if tree_dirs:
+        tree = tree_dirs[index % len(tree_dirs)]
+        entries.append({"name": "copy", "source": f"{tree}/*", "target": f"{sandbox_dir}/root/etc/{tree}/{index}/"})
+    if url:
+        entries.append({"name": "curl", "url": f"{url}/payload.txt", "path": f"{sandbox_dir}/home/downloads/payload{index}.txt"})
+    return entries
+
+
+def _nest(entries, depth, rng):
+    """Wrap entries in `depth` levels of when:/do:/else: blocks that always end up enabled."""
+    for level in range(depth):
+        tag = f"level{level}"
+        if rng.random() < 0.5:
+            entries = [{"when": {"tag": tag}, "do": entries}]
+        else:
+            entries = [{"when": {"not": {"tag": tag}}, "do": [{"name": "systemctl_exec", "command": "daemon-reload"}], "else": entries}]
+    return entries
+
+
+def make_config(sandbox_dir, entries=1000, depth=4, tree_dirs=None, url=None, seed=0):
+    """Return (config, env) with roughly `entries` module entries spread over nested blocks.
+
+    The env enables every `when:` level, so the pruned plan keeps about
+    `entries` entries.
+    """
+    rng = random.Random(seed)
+    modules = []
+    index = 0
+    while index < entries:
+        block = _leaf_entries(index, sandbox_dir, tree_dirs, url)
+        index += len(block)
+        modules.extend(_nest(block, rng.randint(0, depth), rng))
+    env = {"tags": [f"level{level}" for level in range(depth)]}
+    return {"modules": modules}, env
@@ -1,7 +1,20 @@
+import os
 from pathlib import Path
 
 ROOT_DIR = Path(__file__).parent
 ENV_FILE = ROOT_DIR / "environment.yaml"
 CONFIG_FILE = ROOT_DIR / "config.yaml"
 FILES_DIR = ROOT_DIR / "files"
-COMPILED_FILES_DIR = ROOT_DIR / "compiled_files"
\ No newline at end of file
+COMPILED_FILES_DIR = ROOT_DIR / "compiled_files"
+GENERATIONS_DIR = ROOT_DIR / "compiled_generations"
+STATE_DIR = ROOT_DIR / "state"
+
+# Set for runs applying into another root directory (--root), see utils/target_root.py.
+# Those keep their compiled files and state apart, so several can run at once.
+TARGET_ROOT = os.environ.get("SYNCSMITH_TARGET_ROOT") or None
+if TARGET_ROOT:
+    import hashlib
+    ROOT_RUN_DIR = ROOT_DIR / "roots" / hashlib.sha256(TARGET_ROOT.encode()).hexdigest()[:16]
+    COMPILED_FILES_DIR = ROOT_RUN_DIR / "compiled_files"
+    GENERATIONS_DIR = ROOT_RUN_DIR / "compiled_generations"
+    STATE_DIR = ROOT_RUN_DIR / "state"
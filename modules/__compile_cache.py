@@ -0,0 +1,91 @@
+"""Content-addressed cache of compiled files.
+
+A compiled output is stored once under a key derived from everything that
+went into it (the module and its version, the source content and the
+modifications), and installed into compiled_files/ as a hardlink. When the
+next run computes the same key, the output is linked again instead of being
+recompiled, so it keeps its inode and mtime and the copy/symlink entries that
+read it see an unchanged file.
+
+Entries are remembered with their fingerprint like synced targets are (see
+__filesync_state), so an entry that was changed in place through one of its
+links is not handed out again. Entries unused for MAX_AGE are removed.
+"""
+import hashlib
+import json
+import os
+import time
+from modules.__filesync_state import FileSyncState, _fingerprint
+from utils import counters
+from globals import STATE_DIR
+
+CACHE_NAME = "compile cache"
+MAX_AGE = 30 * 24 * 3600
+# "used" is only refreshed this often, so a run full of hits doesn't have to save the state
+USED_RESOLUTION = 24 * 3600
+
+
+def key(*parts):
+    """Cache key of JSON-serialisable parts, e.g. key("edit_file", 1, content, modifications)."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class CompileCache(FileSyncState):
+    """Per-user cache entries, keyed by cache key."""
+
+    def __init__(self, path, directory):
+        super().__init__(path)
+        self.directory = directory
+
+    def lookup(self, cache_key):
+        """Path of the entry for cache_key, or None if there is no intact one."""
+        record = self.targets.get(cache_key)
+        path = os.path.join(self.directory, cache_key)
+        try:
+            intact = record is not None and _fingerprint(os.lstat(path)) == record["dst"]
+        except OSError:
+            intact = False
+        if not intact:
+            counters.miss(CACHE_NAME)
+            return None
+
+        counters.hit(CACHE_NAME)
+        now = int(time.time())
+        if now - record.get("used", 0) > USED_RESOLUTION:
+            self._set(cache_key, dict(record, used=now))
+        return path
+
+    def store(self, cache_key, content):
+        """Store content as the entry for cache_key and return its path."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, cache_key)
+        # Never written in place: the old entry may still be linked from compiled_files
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        self._set(cache_key, {"dst": _fingerprint(os.lstat(path)), "used": int(time.time())})
+        self.prune()
+        return path
+
+    def prune(self, max_age=MAX_AGE):
+        now = time.time()
+        for cache_key, record in list(self.targets.items()):
+            if now - record.get("used", 0) > max_age:
+                try:
+                    os.unlink(os.path.join(self.directory, cache_key))
+                except FileNotFoundError:
+                    pass
+                self.forget(cache_key)
+
+
+_state = None
+
+
+def get_state():
+    """The compile cache of the current user, loaded once per process."""
+    global _state
+    if _state is None:
+        uid = os.getuid()
+        _state = CompileCache(os.path.join(STATE_DIR, f"compile-{uid}.json"), os.path.join(STATE_DIR, f"compile-cache-{uid}"))
+    return _state
@@ -0,0 +1,130 @@
+"""Three-way merge of dconf settings.
+
+Settings are indexed by their full key path ("/org/gnome/desktop/interface/gtk-theme"),
+so merging the stored (global) values with the live (local) values and the
+values applied last run (previous) takes one pass over the keys, whatever the
+size of the dump.
+
+Precedence per key, as in gnome_sync:
+1) An exception rule with a `value` forces that value
+2) An exception rule without a `value` keeps the local value and keeps it out of global storage
+3) A local change since the last run wins and is stored globally, a local removal removes the key globally
+4) Otherwise the global value is used
+"""
+import fnmatch
+import re
+
+
+def parse_keyfile(text, base="/"):
+    """Parse `dconf dump <base>` output into {key path: value}."""
+    base = base.rstrip("/")
+    values = {}
+    prefix = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("[") and line.endswith("]"):
+            section = line[1:-1].strip("/")
+            prefix = f"{base}/{section}/" if section else f"{base}/"
+        elif prefix is not None and "=" in line:
+            key, value = line.split("=", 1)
+            values[prefix + key.strip()] = value.strip()
+    return values
+
+
+def format_keyfile(values, base="/"):
+    """The inverse of `parse_keyfile`: a keyfile `dconf load <base>` accepts."""
+    base = base.rstrip("/") + "/"
+    sections = {}
+    for path, value in values.items():
+        directory, key = path.rsplit("/", 1)
+        section = directory[len(base):] if (directory + "/").startswith(base) else directory
+        sections.setdefault(section or "/", []).append(f"{key}={value}")
+    return "".join(f"[{section}]\n" + "\n".join(lines) + "\n\n" for section, lines in sections.items())
+
+
+class ExceptionRules:
+    """Per-key exception rules, e.g. `{"key": "*/font-name", "value": "'Cantarell 11'"}`.
+
+    Plain keys are looked up in a dict; glob patterns are compiled into a
+    single regular expression so each key is matched once.
+    """
+
+    def __init__(self, rules=None):
+        self.exact = {}
+        self.patterns = []
+        for rule in rules or []:
+            if any(c in rule["key"] for c in "*?["):
+                self.patterns.append(rule)
+            else:
+                self.exact.setdefault(rule["key"], rule)
+        self.regex = None
+        if self.patterns:
+            self.regex = re.compile("|".join(f"(?P<r{i}>{fnmatch.translate(rule['key'])})" for i, rule in enumerate(self.patterns)))
+
+    def match(self, path):
+        rule = self.exact.get(path)
+        if rule is not None or self.regex is None:
+            return rule
+        found = self.regex.match(path)
+        if found is None:
+            return None
+        return self.patterns[int(found.lastgroup[1:])]
+
+
+class MergeResult:
+    def __init__(self):
+        self.compiled = {}
+        self.global_values = {}
+        self.updated = []
+        self.removed = []
+
+    @property
+    def globals_changed(self):
+        return bool(self.updated or self.removed)
+
+
+def merge(global_values, local_values, previous_values, rules=None):
+    """Three-way merge of {key path: value} dicts, see the module docstring."""
+    rules = rules if isinstance(rules, ExceptionRules) else ExceptionRules(rules)
+    result = MergeResult()
+    result.global_values = dict(global_values)
+
+    # dicts keep the order keys were first seen in: local, then global, then previous
+    paths = dict.fromkeys(local_values)
+    paths.update(dict.fromkeys(global_values))
+    paths.update(dict.fromkeys(previous_values))
+    paths.update(dict.fromkeys(path for path, rule in rules.exact.items() if "value" in rule))
+
+    for path in paths:
+        local = local_values.get(path)
+        rule = rules.match(path)
+        if rule is not None:
+            if "value" in rule:
+                result.compiled[path] = str(rule["value"])
+            elif local is not None:
+                result.compiled[path] = local
+            continue
+
+        previous = previous_values.get(path)
+        if local is not None and local != previous:
+            result.compiled[path] = local
+            if global_values.get(path) != local:
+                result.global_values[path] = local
+                result.updated.append(path)
+        elif local is None and previous is not None:
+            if path in result.global_values:
+                del result.global_values[path]
+                result.removed.append(path)
+        elif path in global_values:
+            result.compiled[path] = global_values[path]
+        # Otherwise the key was removed globally and is left out, so it gets reset
+    return result
+
+
+def diff(compiled, live):
+    """Keys to write to make `live` match `compiled`, and keys to reset."""
+    changes = {path: value for path, value in compiled.items() if live.get(path) != value}
+    resets = [path for path in live if path not in compiled]
+    return changes, resets
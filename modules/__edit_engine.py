@@ -0,0 +1,223 @@
+"""Edit engine for edit_file.
+
+Modifications are applied with exactly the semantics of applying them one
+after the other, but consecutive modifications of the same kind are batched:
+
+- consecutive `delete`s filter the lines once, against a set
+- consecutive plain `add`s check for their text in the original content once
+  each (or all at once, see below) and append everything with a single copy
+- consecutive `replace`s with many patterns are done in a single pass with one
+  regular expression built as a trie of the patterns, which unlike a plain
+  alternation only tries the patterns that can still match at each position
+
+The single-pass matcher is only used when the outcome can't depend on the
+order of the patterns: no pattern contains or overlaps another, and no
+replacement contains or overlaps a pattern. Otherwise, and for `add`s with
+`after`/`before`, modifications are applied one by one.
+"""
+import re
+
+# Below this many patterns separate str.replace/`in` scans are faster than one regex pass
+SINGLE_PASS_MIN_PATTERNS = 64
+
+
+def _apply_one(content, modification, log=print):
+    """Apply one modification, the reference semantics for everything below."""
+    if "add" in modification:
+        text = modification.get("add", "")
+
+        if text in content:
+            log(f"Text already exists, skipping add: {text}")
+            return content
+
+        if "after" in modification:
+            after_text = modification.get("after", "")
+            if after_text not in content:
+                log(f"Could not find text to add after ({after_text}), skipping add: {text}")
+                return content
+            log(f"Adding content after '{after_text}': {text}")
+            content = content.replace(after_text, after_text + "\n" + text)
+
+        elif "before" in modification:
+            before_text = modification.get("before", "")
+            if before_text not in content:
+                log(f"Could not find text to add before ({before_text}), skipping add: {text}")
+                return content
+            log(f"Adding content before '{before_text}': {text}")
+            content = content.replace(before_text, text + "\n" + before_text)
+
+        log(f"Adding content: {text}")
+        content += "\n" + text
+    elif "delete" in modification:
+        log(f"Deleting content: {modification.get('delete', '')}")
+        lines = content.splitlines()
+        lines = [line for line in lines if line.strip() != modification.get("delete", "").strip()]
+        content = "\n".join(lines)
+    elif "replace" in modification:
+        log(f"Replacing '{modification.get('replace', '')}' with '{modification.get('with', '')}'")
+        content = content.replace(
+            modification.get("replace", ""),
+            modification.get("with", "")
+        )
+    return content
+
+
+def _kind(modification):
+    if "add" in modification:
+        return "add" if "after" not in modification and "before" not in modification else None
+    if "delete" in modification:
+        return "delete"
+    if "replace" in modification:
+        return "replace"
+    return None
+
+
+def _runs(modifications):
+    """Split modifications into runs of the same batchable kind; None runs hold a single modification."""
+    runs = []
+    for modification in modifications:
+        kind = _kind(modification)
+        if runs and kind is not None and runs[-1][0] == kind:
+            runs[-1][1].append(modification)
+        else:
+            runs.append((kind, [modification]))
+    return runs
+
+
+def _trie_regex(words):
+    """A regex matching any of `words`, factored by common prefixes. Returns None unless
+    the words are prefix-free (then at most one of them can match at any position)."""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            if "" in node:
+                return None
+            node = node.setdefault(char, {})
+        if node:
+            return None
+        node[""] = True
+
+    def build(node):
+        if "" in node:
+            return ""
+        alternatives = [re.escape(char) + build(child) for char, child in node.items()]
+        return alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+
+    return re.compile(build(trie))
+
+
+def _independent(patterns, replacements=()):
+    """True if no pattern contains or overlaps another pattern or a replacement.
+    Returns the compiled trie regex of the patterns in that case, otherwise None."""
+    if "" in patterns or len(set(patterns)) != len(patterns):
+        return None
+    regex = _trie_regex(patterns)
+    if regex is None:
+        return None
+
+    lookahead = re.compile(f"(?=({regex.pattern}))")
+    prefixes = {}
+    for pattern in patterns:
+        for i in range(1, len(pattern)):
+            prefixes.setdefault(pattern[:i], set()).add(pattern)
+    suffixes = {pattern[-i:] for pattern in patterns for i in range(1, len(pattern))}
+    for pattern in patterns:
+        # Another pattern inside this one, or one starting inside and running past its end.
+        # A pattern overlapping itself is fine: both sides scan left to right without overlaps.
+        if any(match.group(1) != pattern for match in lookahead.finditer(pattern)):
+            return None
+        if any(prefixes.get(pattern[i:], {pattern}) - {pattern} for i in range(1, len(pattern))):
+            return None
+
+    joined = "\0".join(patterns)
+    for replacement in replacements:
+        # An empty replacement joins its neighbours, which could form a pattern
+        if not replacement or "\0" in replacement or replacement in joined:
+            return None
+        if lookahead.search(replacement):
+            return None
+        if any(replacement[i:] in prefixes for i in range(1, len(replacement))):
+            return None
+        if any(replacement[:i] in suffixes for i in range(1, len(replacement))):
+            return None
+    return regex
+
+
+def _replace_run(content, modifications, log=print):
+    for modification in modifications:
+        log(f"Replacing '{modification.get('replace', '')}' with '{modification.get('with', '')}'")
+
+    table = {}
+    for modification in modifications:
+        table.setdefault(modification.get("replace", ""), modification.get("with", ""))
+    regex = None
+    if len(modifications) >= SINGLE_PASS_MIN_PATTERNS and len(table) == len(modifications):
+        regex = _independent(list(table), list(table.values()))
+
+    if regex is None:
+        for modification in modifications:
+            content = content.replace(modification.get("replace", ""), modification.get("with", ""))
+        return content
+    return regex.sub(lambda match: table[match.group()], content)
+
+
+def _delete_run(content, modifications, log=print):
+    deleted = set()
+    for modification in modifications:
+        log(f"Deleting content: {modification.get('delete', '')}")
+        deleted.add(modification.get("delete", "").strip())
+
+    lines = content.splitlines()
+    # Each delete after the first splits the lines joined by the one before again, which drops
+    # a trailing empty line. That only affects lines after the last one that is neither empty
+    # nor deleted, so everything up to there is filtered once and only the rest one by one.
+    keep = len(lines)
+    while keep and (lines[keep - 1] == "" or lines[keep - 1].strip() in deleted):
+        keep -= 1
+    head = [line for line in lines[:keep] if line.strip() not in deleted]
+    tail = lines[keep:]
+    for index, modification in enumerate(modifications):
+        if index and tail and tail[-1] == "":
+            tail.pop()
+        tail = [line for line in tail if line.strip() != modification.get("delete", "").strip()]
+    return "\n".join(head + tail)
+
+
+def _add_run(content, modifications, log=print):
+    texts = [modification.get("add", "") for modification in modifications]
+    present = None
+    if len(texts) >= SINGLE_PASS_MIN_PATTERNS:
+        regex = _independent(list(dict.fromkeys(texts)))
+        if regex is not None:
+            present = {match.group() for match in regex.finditer(content)}
+
+    added = []
+    tail = ""
+    for text in texts:
+        if present is not None:
+            in_content = text in present
+        else:
+            in_content = text in content
+        # A match that isn't entirely in the original content overlaps what was added so far
+        if in_content or (added and text in content[max(0, len(content) - len(text) + 1):] + tail):
+            log(f"Text already exists, skipping add: {text}")
+            continue
+        log(f"Adding content: {text}")
+        added.append("\n" + text)
+        tail += "\n" + text
+    return content + "".join(added)
+
+
+def apply_modifications(content, modifications, log=print):
+    """Apply edit_file modifications to content, reporting what is done through `log`."""
+    for kind, run in _runs(modifications):
+        if kind == "replace":
+            content = _replace_run(content, run, log)
+        elif kind == "delete":
+            content = _delete_run(content, run, log)
+        elif kind == "add":
+            content = _add_run(content, run, log)
+        else:
+            content = _apply_one(content, run[0], log)
+    return content
@@ -1,9 +1,11 @@
-import subprocess
-import filecmp
 import os
 import shutil
-from typing import Callable, Iterable, List, Tuple
-from modules.__syncsmith_module import SyncsmithModule
+import fnmatch
+from functools import lru_cache
+from typing import Callable, Iterable, Iterator, List, Tuple
+from modules.__syncsmith_module import SyncsmithModule, at_end_of_run
+from modules.__filesync_state import get_state
+from utils import backups, journal, target_root, tracing
 
 def _is_synced_file(src: str, dst: str) -> bool:
     """Check if dst is a symlink to src or a file with same contents."""
@@ -13,82 +15,195 @@ def _is_synced_file(src: str, dst: str) -> bool:
     if os.path.islink(dst):
         return os.readlink(dst) == src
     elif os.path.isfile(dst):
-        return filecmp.cmp(src, dst)
+        return get_state().is_synced_copy(src, dst)
     return False
 
-def build_entries(raw_source: str, target: str) -> List[Tuple[str, str]]:
-    """Return list of (src, dst) pairs for either single or contents mode.
+def _matches(rel_path: str, patterns: Iterable[str]) -> bool:
+    """Patterns with a slash match the path relative to the source directory, others just the name.
+    As with fnmatch, `*` also matches across slashes."""
+    name = rel_path.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatchcase(rel_path if "/" in pattern else name, pattern.rstrip("/")) for pattern in patterns)
+
+def _walk(source_dir: str, target: str, recursive: bool, include: List[str], exclude: List[str], rel: str = "", ancestors: frozenset = None) -> Iterator[Tuple[str, str]]:
+    """In recursive mode symlinks to directories are descended into like directories, so
+    the files below them are synced; a link back to a directory being walked is skipped."""
+    if recursive:
+        st = os.stat(source_dir)
+        ancestors = (ancestors or frozenset()) | {(st.st_dev, st.st_ino)}
+    with os.scandir(source_dir) as it:
+        dir_entries = sorted(it, key=lambda entry: entry.name)
+    for entry in dir_entries:
+        rel_path = rel + entry.name
+        if exclude and _matches(rel_path, exclude):
+            continue
+        if recursive and entry.is_dir():
+            if entry.is_symlink():
+                st = entry.stat()
+                if (st.st_dev, st.st_ino) in ancestors:
+                    print(f"Skipping {entry.path}: symlink loop")
+                    continue
+            yield from _walk(entry.path, os.path.join(target, entry.name), recursive, include, exclude, rel_path + "/", ancestors)
+            continue
+        if include and not _matches(rel_path, include):
+            continue
+        yield entry.path, os.path.join(target, entry.name)
+
+def build_entries(raw_source: str, target: str, include: List[str] = None, exclude: List[str] = None) -> Iterator[Tuple[str, str]]:
+    """Return (src, dst) pairs for either single, contents or recursive contents mode.
     In contents mode (source ends with /*), all entries in the source directory are synced to target directory.
+    In recursive mode (source ends with /**), all files below the source directory are synced to the same
+    relative path below target, following symlinks to directories. `include`/`exclude` glob patterns filter both modes.
+
+    Pairs are yielded while the source directory is walked. A missing source raises right away.
     """
-    target = os.path.expanduser(target)
-    contents_mode = raw_source.endswith("/*")
-    source = raw_source[:-2] if contents_mode else raw_source
+    target = target_root.path(os.path.expanduser(target))
+    recursive = raw_source.endswith("/**")
+    contents_mode = recursive or raw_source.endswith("/*")
+    source = raw_source.rsplit("/", 1)[0] if contents_mode else raw_source
 
     if contents_mode:
         source_dir = SyncsmithModule._find_file(source)
         if not os.path.isdir(source_dir):
             raise FileNotFoundError(f"Source for contents mode is not a directory: {source_dir}")
-        os.makedirs(target, exist_ok=True)
-        entries: List[Tuple[str, str]] = []
-        for entry in sorted(os.listdir(source_dir)):
-            src_entry = os.path.join(source_dir, entry)
-            dst_entry = os.path.join(target, entry)
-            entries.append((src_entry, dst_entry))
-        return entries
+        return _walk(source_dir, target, recursive, include or [], exclude or [])
     else:
         source_file = SyncsmithModule._find_file(source)
-        return [(source_file, target)]
-    
-def set_permissions(filepath, config, dry_run=False):
-    expected_ownership = config.get("ownership", None)
-    expected_permissions = config.get("permissions", None)
-    
-    changes_made = False
-    stat_info = os.stat(filepath)
+        return iter([(source_file, target)])
 
-    # Check and set permissions
-    if expected_permissions:
-        current_perms = oct(stat_info.st_mode & 0o777)
-        expected_perms = oct(int(expected_permissions, 8) & 0o777)
-        
-        if current_perms != expected_perms:
-            if dry_run:
-                print(f"[DRY RUN] Would set permissions of {filepath} to {expected_permissions}")
-            else:
-                print(f"Updating permissions of {filepath} to {expected_permissions}")
-                os.chmod(filepath, int(expected_permissions, 8))
-            changes_made = True
-            stat_info = os.stat(filepath)
+def config_entries(config: dict) -> Iterator[Tuple[str, str]]:
+    return build_entries(config.get("source", ""), config.get("target", ""), config.get("include"), config.get("exclude"))
     
-    # Check and set ownership
-    if expected_ownership:
-        uid, gid = expected_ownership.split(":")
-        uid_int = int(uid) if uid.isdigit() else shutil._get_uid(uid)
-        gid_int = int(gid) if gid.isdigit() else shutil._get_gid(gid)
-        
-        if stat_info.st_uid != uid_int or stat_info.st_gid != gid_int:
-            if dry_run:
-                print(f"[DRY RUN] Would set ownership of {filepath} to {uid_int}:{gid_int}")
-            else:
-                os.chown(filepath, uid_int, gid_int)
-            changes_made = True
-            stat_info = os.stat(filepath)
-    
-    # Check and restore SELinux context if restorecon is available and SELinux is enabled
+@lru_cache(maxsize=None)
+def _resolve_ownership(ownership):
+    uid, gid = ownership.split(":")
+    uid_int = int(uid) if uid.isdigit() else target_root.user(uid)[0]
+    gid_int = int(gid) if gid.isdigit() else target_root.group(gid)
+    return uid_int, gid_int
+
+@lru_cache(maxsize=None)
+def _selinux_restorecon():
+    """Path of restorecon if SELinux is available and enabled, otherwise None."""
     restorecon_bin = shutil.which("restorecon")
-    if restorecon_bin:
-        is_enabled = subprocess.run(["selinuxenabled"], capture_output=True).returncode == 0
-        
-        if is_enabled:
-            check = subprocess.run(["matchpathcon", "-Vq", str(filepath)])
-            if check.returncode != 0:
-                print(f"Restoring SELinux context for {filepath} using {restorecon_bin}")
-                if not dry_run:
-                    subprocess.run(["sudo", restorecon_bin, "-F", str(filepath)], 
-                                   capture_output=True)
+    if restorecon_bin and tracing.run(["selinuxenabled"], capture_output=True).returncode == 0:
+        return restorecon_bin
+    return None
+
+# Paths whose SELinux context is checked at the end of the run, with whether it is a dry run
+_pending_contexts = {}
+
+class MetadataEnforcer:
+    """Collects expected permissions and ownership for paths and enforces them in
+    one go, per directory through a directory fd. SELinux contexts of the paths are
+    left for the end of the run, when those of all entries the process applied are
+    checked with one matchpathcon call and fixed with one restorecon call.
+    """
+
+    def __init__(self):
+        self.expected = {}
+
+    def add(self, filepath, config):
+        self.expected[str(filepath)] = (config.get("permissions", None), config.get("ownership", None))
+
+    def enforce(self, dry_run=False):
+        """Returns True if any changes were made (or would be made)."""
+        changes_made = False
+        by_dir = {}
+        for filepath, expected in self.expected.items():
+            by_dir.setdefault(os.path.dirname(filepath), []).append((filepath, expected))
+
+        existing = []
+        for directory, items in by_dir.items():
+            try:
+                dir_fd = os.open(directory or ".", os.O_RDONLY | os.O_DIRECTORY)
+            except FileNotFoundError:
+                continue
+            try:
+                for filepath, (expected_permissions, expected_ownership) in items:
+                    if self._enforce_one(dir_fd, filepath, expected_permissions, expected_ownership, dry_run):
+                        changes_made = True
+                    if os.path.lexists(filepath):
+                        existing.append(filepath)
+            finally:
+                os.close(dir_fd)
+
+        for path in existing:
+            _pending_contexts[path] = dry_run
+        self.expected.clear()
+        return changes_made
+
+    def _enforce_one(self, dir_fd, filepath, expected_permissions, expected_ownership, dry_run):
+        name = os.path.basename(filepath)
+        # chmod and chown follow symlinks, and in another root a link may point at the host
+        if target_root.active() and os.path.islink(filepath):
+            return False
+        try:
+            stat_info = os.stat(name, dir_fd=dir_fd)
+        except FileNotFoundError:
+            return False
+
+        changes_made = False
+
+        # Check and set permissions
+        if expected_permissions:
+            current_perms = oct(stat_info.st_mode & 0o777)
+            expected_perms = oct(int(expected_permissions, 8) & 0o777)
+
+            if current_perms != expected_perms:
+                if dry_run:
+                    print(f"[DRY RUN] Would set permissions of {filepath} to {expected_permissions}")
+                else:
+                    print(f"Updating permissions of {filepath} to {expected_permissions}")
+                    journal.before_metadata(filepath, stat_info, mode=True)
+                    with tracing.span("chmod", cat="fs", path=filepath):
+                        os.chmod(name, int(expected_permissions, 8), dir_fd=dir_fd)
                 changes_made = True
-    
-    return changes_made
+
+        # Check and set ownership
+        if expected_ownership:
+            uid_int, gid_int = _resolve_ownership(expected_ownership)
+
+            if stat_info.st_uid != uid_int or stat_info.st_gid != gid_int:
+                if dry_run:
+                    print(f"[DRY RUN] Would set ownership of {filepath} to {uid_int}:{gid_int}")
+                else:
+                    journal.before_metadata(filepath, stat_info, owner=True)
+                    with tracing.span("chown", cat="fs", path=filepath):
+                        os.chown(name, uid_int, gid_int, dir_fd=dir_fd)
+                changes_made = True
+
+        return changes_made
+
+@at_end_of_run
+def restore_contexts():
+    """Check and restore the SELinux contexts of the paths enforced so far, if SELinux is enabled."""
+    pending = dict(_pending_contexts)
+    _pending_contexts.clear()
+    if not pending or not _selinux_restorecon():
+        return
+    for dry_run in (False, True):
+        _restore_contexts([path for path, dry in pending.items() if dry == dry_run], dry_run)
+
+def _restore_contexts(paths, dry_run):
+    restorecon_bin = _selinux_restorecon()
+    if not paths:
+        return
+
+    check = tracing.run(["matchpathcon", "-V"] + paths, capture_output=True, text=True)
+    verified = set(line[:-len(" verified.")] for line in check.stdout.splitlines() if line.endswith(" verified."))
+    mismatched = [path for path in paths if path not in verified]
+    if not mismatched:
+        return False
+
+    for path in mismatched:
+        print(f"Restoring SELinux context for {path} using {restorecon_bin}")
+    if not dry_run:
+        tracing.run(["sudo", restorecon_bin, "-F"] + mismatched, capture_output=True)
+    return True
+
+def set_permissions(filepath, config, dry_run=False):
+    enforcer = MetadataEnforcer()
+    enforcer.add(filepath, config)
+    return enforcer.enforce(dry_run=dry_run)
 
 def apply_entries(config: dict, apply_one: Callable[[str, str], None], is_synced_file: Callable[[str, str], bool], dry_run: bool = False) -> bool:
     """Generic apply routine. `apply_one(src, dst)` performs the concrete action.
@@ -97,43 +212,96 @@ def apply_entries(config: dict, apply_one: Callable[[str, str], None], is_synced
     """
 
     try:
-        entries = build_entries(config.get("source", ""), config.get("target", ""))
+        entries = config_entries(config)
     except FileNotFoundError as e:
         print(f"[ERROR] {e}")
         return
     
     changes_made = False
+    enforcer = MetadataEnforcer()
+    # Parent directories are checked (and created) once, not once per file
+    known_parents = set()
     for src_entry, dst_entry in entries:
         parent = os.path.dirname(dst_entry)
-        if parent and not os.path.exists(parent):
-            if dry_run:
-                print(f"[DRY RUN] Would create parent directory {parent}")
-            else:
-                os.makedirs(parent, exist_ok=True)
+        if parent not in known_parents:
+            known_parents.add(parent)
+            if parent and not os.path.isdir(parent):
+                if dry_run:
+                    print(f"[DRY RUN] Would create parent directory {parent}")
+                else:
+                    journal.before_makedirs(parent)
+                    os.makedirs(parent, exist_ok=True)
         
         if dst_entry.endswith("/"):
             dst_entry = str(os.path.join(dst_entry, os.path.basename(src_entry)))
 
-        if os.path.exists(dst_entry) and not is_synced_file(src_entry, dst_entry):
-            backup_path = dst_entry + ".bak"
-            if dry_run:
-                print(f"[DRY RUN] Would back up existing {dst_entry} to {backup_path}")
-            else:
-                print(f"Backing up existing file {dst_entry} to {backup_path}")
-                os.rename(dst_entry, backup_path)
-
-        if not os.path.exists(dst_entry):
-            apply_one(src_entry, dst_entry, dry_run=dry_run)
+        with tracing.span("check", cat="fs", path=dst_entry):
+            diverged = os.path.lexists(dst_entry) and not is_synced_file(src_entry, dst_entry)
+        # apply_one replaces a diverged target in place
+        if diverged or not os.path.lexists(dst_entry):
+            if not dry_run:
+                journal.before_write(dst_entry)
+            if diverged:
+                if dry_run:
+                    print(f"[DRY RUN] Would back up existing {dst_entry}")
+                else:
+                    print(f"Backing up existing file {dst_entry}")
+                    with tracing.span("backup", cat="fs", path=dst_entry):
+                        backups.save(dst_entry)
+            with tracing.span("apply", cat="fs", path=dst_entry):
+                apply_one(src_entry, dst_entry, dry_run=dry_run)
             changes_made = True
 
-        if set_permissions(dst_entry, config, dry_run=dry_run):
-            changes_made = True
+        enforcer.add(dst_entry, config)
 
+    if enforcer.enforce(dry_run=dry_run):
+        changes_made = True
+
+    get_state().save()
     return changes_made
 
 
+def _metadata_drift(path, config):
+    drifts = []
+    try:
+        stat_info = os.stat(path)
+    except FileNotFoundError:
+        return drifts
+    expected_permissions = config.get("permissions", None)
+    if expected_permissions and stat_info.st_mode & 0o777 != int(expected_permissions, 8) & 0o777:
+        drifts.append({"path": path, "drift": "permissions", "expected": expected_permissions, "actual": oct(stat_info.st_mode & 0o777)[2:]})
+    expected_ownership = config.get("ownership", None)
+    if expected_ownership:
+        uid_int, gid_int = _resolve_ownership(expected_ownership)
+        if stat_info.st_uid != uid_int or stat_info.st_gid != gid_int:
+            drifts.append({"path": path, "drift": "ownership", "expected": f"{uid_int}:{gid_int}", "actual": f"{stat_info.st_uid}:{stat_info.st_gid}"})
+    return drifts
+
+def check_entries(config: dict, is_synced_file: Callable[[str, str], bool]) -> List[dict]:
+    """Read-only counterpart of `apply_entries`: the drifts of every target, see SyncsmithModule.check."""
+    try:
+        entries = config_entries(config)
+        drifts = []
+        for src_entry, dst_entry in entries:
+            if dst_entry.endswith("/"):
+                dst_entry = str(os.path.join(dst_entry, os.path.basename(src_entry)))
+            if not os.path.lexists(dst_entry):
+                drifts.append({"path": dst_entry, "drift": "missing", "source": src_entry})
+                continue
+            if not os.path.exists(dst_entry):
+                # A symlink whose target is gone is broken even if it points where it should
+                drifts.append({"path": dst_entry, "drift": "dangling", "link": os.readlink(dst_entry), "source": src_entry})
+                continue
+            if not is_synced_file(src_entry, dst_entry):
+                drifts.append({"path": dst_entry, "drift": "differs", "source": src_entry})
+            drifts += _metadata_drift(dst_entry, config)
+    except FileNotFoundError as e:
+        return [{"path": config.get("source", ""), "drift": "source missing", "error": str(e)}]
+    return drifts
+
+
 def rollback_entries(entries: Iterable[Tuple[str, str]], remove_one: Callable[[str], None] = None, dry_run: bool = False) -> None:
-    """Generic rollback: remove created targets and restore backups.
+    """Generic rollback: remove created targets and restore their newest backups.
 
     `remove_one(dst)` should remove the created object (e.g. unlink symlink or remove file).
     If `remove_one` is None a sensible default will be used.
@@ -158,6 +326,5 @@ def rollback_entries(entries: Iterable[Tuple[str, str]], remove_one: Callable[[s
         if os.path.exists(dst_entry):
             remove_one(src_entry, dst_entry)
 
-        backup_path = dst_entry + ".bak"
-        if os.path.exists(backup_path):
-            os.rename(backup_path, dst_entry)
+        if not os.path.lexists(dst_entry) and backups.versions(dst_entry):
+            backups.restore(dst_entry)
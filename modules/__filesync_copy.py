@@ -0,0 +1,157 @@
+"""Atomic file replacement for the filesync modules.
+
+New contents are written to a temporary file next to the target and renamed
+over it, so the target never goes missing and readers see either the old or
+the new file. Copies try a reflink first (FICLONE, free on btrfs/XFS), then
+copy_file_range and sendfile, which keep the data in the kernel, and only then
+fall back to a userspace copy.
+"""
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+from utils import tracing
+
+FICLONE = 0x40049409
+
+# Errors meaning "this filesystem or kernel can't do that", so the next method is tried
+_UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF, errno.EPERM}
+
+
+def _reflink(src_fd, dst_fd, size):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd, dst_fd, size):
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(src_fd, dst_fd, size - copied)
+        if n == 0:
+            break
+        copied += n
+
+
+def _sendfile(src_fd, dst_fd, size):
+    copied = 0
+    while copied < size:
+        n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+        if n == 0:
+            break
+        copied += n
+
+
+def _userspace(src_fd, dst_fd, size):
+    os.lseek(src_fd, 0, os.SEEK_SET)
+    while chunk := os.read(src_fd, 1024 * 1024):
+        os.write(dst_fd, chunk)
+
+
+_METHODS = [("reflink", _reflink), ("copy_file_range", _copy_file_range), ("sendfile", _sendfile), ("userspace", _userspace)]
+if not hasattr(os, "copy_file_range"):
+    _METHODS.remove(("copy_file_range", _copy_file_range))
+
+
+def _copy_data(src_fd, dst_fd, size):
+    """Copy the contents of src_fd into the empty dst_fd, returns the method used."""
+    for name, method in _METHODS:
+        try:
+            method(src_fd, dst_fd, size)
+            return name
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or name == "userspace":
+                raise
+            # A partial copy is thrown away before trying the next method
+            os.ftruncate(dst_fd, 0)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+            os.lseek(src_fd, 0, os.SEEK_SET)
+
+
+def _temp_path(dst):
+    directory, name = os.path.split(dst)
+    return tempfile.mkstemp(prefix=f".{name}.", suffix=".syncsmith-tmp", dir=directory or ".")
+
+
+def _temp_name(dst):
+    directory, name = os.path.split(dst)
+    return os.path.join(directory, f".{name}.{os.urandom(4).hex()}.syncsmith-tmp")
+
+
+def copy_file(src, dst):
+    """Copy src to dst like shutil.copy2, replacing dst atomically."""
+    dst_fd, tmp_path = _temp_path(dst)
+    try:
+        with open(src, "rb") as src_file:
+            size = os.fstat(src_file.fileno()).st_size
+            with tracing.span("copy data", cat="fs", path=dst, size=size):
+                method = _copy_data(src_file.fileno(), dst_fd, size)
+        os.close(dst_fd)
+        dst_fd = None
+        shutil.copystat(src, tmp_path)
+        os.replace(tmp_path, dst)
+        return method
+    except BaseException:
+        if dst_fd is not None:
+            os.close(dst_fd)
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def replace_with_symlink(src, dst):
+    """Point dst at src, replacing whatever non-directory is at dst atomically."""
+    tmp_path = _temp_name(dst)
+    try:
+        os.symlink(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def replace_with_link(src, dst):
+    """Make dst a hardlink to src, replacing it atomically. Returns False if dst already is one.
+
+    Filesystems without hardlinks, and links across filesystems, get a copy
+    that keeps the mtime of src instead.
+    """
+    try:
+        if os.path.samefile(src, dst):
+            return False
+    except OSError:
+        pass
+    tmp_path = _temp_name(dst)
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            copy_file(src, dst)
+            return True
+        os.replace(tmp_path, dst)
+        return True
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def backup(dst, backup_path):
+    """Keep the current dst as backup_path without taking it away.
+
+    Files and symlinks are hardlinked, so dst stays in place until it is
+    replaced; directories can't be, and are moved out of the way instead.
+    """
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        os.rename(dst, backup_path)
+        return
+    tmp_path = _temp_name(backup_path)
+    try:
+        os.link(dst, tmp_path, follow_symlinks=False)
+    except OSError:
+        # Filesystems without hardlinks get a copy
+        if os.path.islink(dst):
+            os.symlink(os.readlink(dst), tmp_path)
+        else:
+            shutil.copy2(dst, tmp_path)
+    os.replace(tmp_path, backup_path)
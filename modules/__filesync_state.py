@@ -0,0 +1,149 @@
+"""Persistent sync state for copy/symlink targets.
+
+For every copied target the state records the source and target fingerprints
+(dev, inode, size, mtime_ns, sha256 once computed) from the last time they were confirmed in
+sync; symlinks only record the link itself. A pair whose fingerprints have not moved is confirmed from one stat of
+each file; otherwise only the side that moved is hashed again.
+
+Each user gets its own state file, so root and the real user never write to
+the same one. Saving merges with whatever other workers wrote in the meantime.
+"""
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import stat
+from utils import counters
+from globals import STATE_DIR
+
+CACHE_NAME = "sync state"
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            # Hashed straight from the page cache, without copying into Python
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return hashlib.sha256(mapped).hexdigest()
+        h = hashlib.sha256()
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _fingerprint(st):
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+class FileSyncState:
+    def __init__(self, path):
+        self.path = path
+        self.targets = self._load()
+        self.changed = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f).get("targets", {})
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def is_synced_copy(self, src, dst):
+        """True if dst is a regular file with the same contents as src."""
+        try:
+            src_stat = os.stat(src)
+            dst_stat = os.lstat(dst)
+        except FileNotFoundError:
+            return False
+        if not stat.S_ISREG(dst_stat.st_mode) or not stat.S_ISREG(src_stat.st_mode):
+            return False
+
+        src_fp = _fingerprint(src_stat)
+        dst_fp = _fingerprint(dst_stat)
+        record = self.targets.get(dst)
+        if record and record.get("source") != src:
+            record = None
+
+        if record and record["src"][:4] == src_fp and record["dst"][:4] == dst_fp:
+            self.hits += 1
+            counters.hit(CACHE_NAME)
+            return True
+
+        self.misses += 1
+        counters.miss(CACHE_NAME)
+        if src_stat.st_size != dst_stat.st_size:
+            return False
+
+        src_hash = record["src"][4] if record and record["src"][:4] == src_fp else None
+        dst_hash = record["dst"][4] if record and record["dst"][:4] == dst_fp else None
+        if src_hash is None:
+            src_hash = file_digest(src)
+        if dst_hash is None:
+            dst_hash = file_digest(dst)
+        if src_hash != dst_hash:
+            return False
+
+        self._set(dst, {"source": src, "src": src_fp + [src_hash], "dst": dst_fp + [dst_hash]})
+        return True
+
+    def record_copy(self, src, dst):
+        """Remember src and dst as in sync, e.g. right after copying.
+
+        The digest is only computed once it is needed, i.e. when one side has
+        moved, so a fresh copy doesn't read the source a second time.
+        """
+        self._set(dst, {"source": src, "src": _fingerprint(os.stat(src)) + [None], "dst": _fingerprint(os.lstat(dst)) + [None]})
+
+    def record_link(self, src, dst):
+        """Remember dst as a symlink to src."""
+        record = {"source": src, "link": True, "dst": _fingerprint(os.lstat(dst))}
+        if self.targets.get(dst) != record:
+            self._set(dst, record)
+
+    def forget(self, dst):
+        if dst in self.targets:
+            self._set(dst, None)
+
+    def _set(self, dst, record):
+        if record is None:
+            self.targets.pop(dst, None)
+        else:
+            self.targets[dst] = record
+        self.changed[dst] = record
+
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                targets = self._load()
+                for dst, record in self.changed.items():
+                    if record is None:
+                        targets.pop(dst, None)
+                    else:
+                        targets[dst] = record
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump({"version": 1, "targets": targets}, f)
+                os.replace(tmp_path, self.path)
+            self.targets = targets
+            self.changed = {}
+        except OSError as e:
+            print(f"[WARN] Could not save sync state to {self.path}: {e}")
+
+
+_state = None
+
+
+def get_state():
+    """The sync state of the current user, loaded once per process."""
+    global _state
+    if _state is None:
+        _state = FileSyncState(os.path.join(STATE_DIR, f"filesync-{os.getuid()}.json"))
+    return _state
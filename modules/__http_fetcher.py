@@ -0,0 +1,307 @@
+"""In-process HTTP(S) downloads for the curl module.
+
+Connections are kept alive and reused per host. Like curl, requests go through
+the proxy http_proxy/https_proxy name (urllib's getproxies), unless no_proxy
+exempts the host: plain HTTP as absolute-URL requests to the proxy, HTTPS
+through a CONNECT tunnel. Every download is recorded in
+a per-user state (url, ETag, Last-Modified, sha256 and the target's stat
+fingerprint), so the next run sends If-None-Match/If-Modified-Since and a 304
+leaves the target alone. Bodies are streamed to a temp file next to the target,
+hashed on the way, and renamed into place.
+
+Before modules run, `run_modules` can prefetch every curl entry concurrently
+(see `SyncsmithModule.prefetch`). Prefetched bodies are staged in the directory
+named by SYNCSMITH_PREFETCH_DIR with a small JSON manifest each, and the entry
+installs from there instead of going to the network again.
+"""
+import base64
+import hashlib
+import http.client
+import json
+import os
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+from modules.__filesync_state import FileSyncState, file_digest, _fingerprint
+from utils import counters, tracing
+from globals import STATE_DIR
+
+CACHE_NAME = "http cache"
+MAX_REDIRECTS = 5
+TIMEOUT = 30
+USER_AGENT = "syncsmith"
+
+
+class FetchError(Exception):
+    pass
+
+
+class FetchResult:
+    def __init__(self, url, status, etag=None, last_modified=None, sha256=None):
+        self.url = url
+        self.status = status
+        self.etag = etag
+        self.last_modified = last_modified
+        self.sha256 = sha256
+
+    def to_dict(self):
+        return {"url": self.url, "status": self.status, "etag": self.etag, "last_modified": self.last_modified, "sha256": self.sha256}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["url"], data["status"], data.get("etag"), data.get("last_modified"), data.get("sha256"))
+
+
+def _proxy(scheme, netloc):
+    """The proxy URL to reach netloc through, None for a direct connection."""
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(urllib.parse.urlsplit(f"//{netloc}").hostname or netloc):
+        return None
+    return proxy if "://" in proxy else f"http://{proxy}"
+
+
+def _proxy_headers(proxy):
+    parts = urllib.parse.urlsplit(proxy)
+    if not parts.username:
+        return {}
+    credentials = f"{urllib.parse.unquote(parts.username)}:{urllib.parse.unquote(parts.password or '')}"
+    return {"Proxy-Authorization": "Basic " + base64.b64encode(credentials.encode()).decode()}
+
+
+class ConnectionPool:
+    """Idle keep-alive connections per (scheme, host), safe to share between threads."""
+
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        with self.lock:
+            connections = self.idle.get((scheme, netloc))
+            if connections:
+                return connections.pop(), True
+        return self.new(scheme, netloc), False
+
+    @staticmethod
+    def new(scheme, netloc):
+        if scheme not in ("http", "https"):
+            raise FetchError(f"Unsupported URL scheme '{scheme}'")
+        proxy = _proxy(scheme, netloc)
+        if proxy is None:
+            if scheme == "https":
+                return http.client.HTTPSConnection(netloc, timeout=TIMEOUT)
+            return http.client.HTTPConnection(netloc, timeout=TIMEOUT)
+
+        proxy_parts = urllib.parse.urlsplit(proxy)
+        proxy_netloc = proxy_parts.netloc.rpartition("@")[2]
+        if scheme == "http":
+            # Requests carry the absolute URL and the credentials, see _request
+            if proxy_parts.scheme == "https":
+                return http.client.HTTPSConnection(proxy_netloc, timeout=TIMEOUT)
+            return http.client.HTTPConnection(proxy_netloc, timeout=TIMEOUT)
+        if proxy_parts.scheme == "https":
+            raise FetchError(f"Can't reach {netloc} through the HTTPS proxy {proxy_netloc}, only through HTTP proxies")
+        # TLS with the host itself, through a CONNECT tunnel
+        connection = http.client.HTTPSConnection(proxy_netloc, timeout=TIMEOUT)
+        host = urllib.parse.urlsplit(f"//{netloc}")
+        connection.set_tunnel(host.hostname, host.port or 443, headers=_proxy_headers(proxy))
+        return connection
+
+    def put(self, scheme, netloc, connection):
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append(connection)
+
+
+_pool = ConnectionPool()
+
+
+def _request(url, headers):
+    """GET url, following redirects. Returns (connection, response, scheme, netloc, final url)."""
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        request_headers = headers
+        proxy = _proxy(parts.scheme, parts.netloc) if parts.scheme == "http" else None
+        if proxy:
+            path = urllib.parse.urlunsplit((parts.scheme, parts.netloc, path, "", ""))
+            request_headers = dict(headers, **_proxy_headers(proxy))
+
+        connection, reused = _pool.get(parts.scheme, parts.netloc)
+        try:
+            connection.request("GET", path, headers=request_headers)
+            response = connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            if not reused:
+                raise
+            # The server closed the kept-alive connection, retry on a new one
+            connection = _pool.new(parts.scheme, parts.netloc)
+            connection.request("GET", path, headers=request_headers)
+            response = connection.getresponse()
+
+        if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+            response.read()
+            _release(parts.scheme, parts.netloc, connection, response)
+            url = urllib.parse.urljoin(url, response.getheader("Location"))
+            continue
+        return connection, response, parts.scheme, parts.netloc, url
+    raise FetchError(f"Too many redirects for {url}")
+
+
+def _release(scheme, netloc, connection, response):
+    if response.will_close:
+        connection.close()
+    else:
+        _pool.put(scheme, netloc, connection)
+
+
+def fetch(url, dest, validators=None, expected_sha256=None, before_replace=None):
+    """Download url to dest, replacing it atomically.
+
+    With `validators` ({"etag": ..., "last_modified": ...}) the request is
+    conditional and a 304 result leaves dest untouched. With `expected_sha256`
+    a body with a different digest raises FetchError and dest is kept.
+    `before_replace()` is called right before a new body replaces dest.
+    """
+    headers = {"User-Agent": USER_AGENT, "Accept-Encoding": "identity"}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    with tracing.span("GET", cat="http", url=url):
+        connection, response, scheme, netloc, final_url = _request(url, headers)
+        if response.status != 200:
+            response.read()
+            _release(scheme, netloc, connection, response)
+            if response.status == 304:
+                validators = validators or {}
+                return FetchResult(url, 304, validators.get("etag"), validators.get("last_modified"), validators.get("sha256"))
+            raise FetchError(f"{final_url} answered {response.status} {response.reason}")
+
+        try:
+            digest = hashlib.sha256()
+            directory, name = os.path.split(dest)
+            fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".syncsmith-tmp", dir=directory or ".")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    while chunk := response.read(1024 * 1024):
+                        digest.update(chunk)
+                        f.write(chunk)
+                if expected_sha256 and digest.hexdigest() != expected_sha256.lower():
+                    raise FetchError(f"{final_url} has sha256 {digest.hexdigest()}, expected {expected_sha256}")
+                os.chmod(tmp_path, 0o666 & ~_UMASK)
+                if before_replace:
+                    before_replace()
+                os.replace(tmp_path, dest)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+        except BaseException:
+            # The body may not have been read to the end, so the connection can't be reused
+            connection.close()
+            raise
+        _release(scheme, netloc, connection, response)
+        return FetchResult(url, 200, response.getheader("ETag"), response.getheader("Last-Modified"), digest.hexdigest())
+
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+# Read once: the umask is process-wide, so it can't be probed while other threads create files
+_UMASK = _umask()
+
+
+class DownloadState(FileSyncState):
+    """Per-user record of downloaded targets, keyed by target path."""
+
+    def validators(self, url, path):
+        """ETag/Last-Modified of path if it is still the file downloaded from url."""
+        record = self.targets.get(path)
+        if not record or record.get("url") != url:
+            return None
+        try:
+            if _fingerprint(os.lstat(path)) != record["dst"]:
+                return None
+        except OSError:
+            return None
+        return record
+
+    def matches_sha256(self, path, sha256):
+        """True if path has the given digest, hashing it only if it changed since it was recorded."""
+        record = self.targets.get(path)
+        try:
+            fingerprint = _fingerprint(os.lstat(path))
+        except OSError:
+            return False
+        if record and record["dst"] == fingerprint and record.get("sha256"):
+            return record["sha256"] == sha256.lower()
+        return file_digest(path) == sha256.lower()
+
+    def record_download(self, path, result):
+        self._set(path, {"url": result.url, "etag": result.etag, "last_modified": result.last_modified,
+                         "sha256": result.sha256, "dst": _fingerprint(os.lstat(path))})
+
+
+def state_path(uid):
+    return os.path.join(STATE_DIR, f"download-{uid}.json")
+
+
+_state = None
+
+
+def get_state():
+    """The download state of the current user, loaded once per process."""
+    global _state
+    if _state is None:
+        _state = DownloadState(state_path(os.getuid()))
+    return _state
+
+
+def _manifest_name(url, path):
+    return hashlib.sha256(f"{url}\0{path}".encode()).hexdigest()[:20]
+
+
+def prefetch(url, path, uid, staging_dir, expected_sha256=None):
+    """Revalidate or download url for the target path of user uid into staging_dir."""
+    state = get_state() if uid == os.getuid() else DownloadState(state_path(uid))
+    name = _manifest_name(url, path)
+    staged = os.path.join(staging_dir, name)
+    if expected_sha256 and state.matches_sha256(path, expected_sha256):
+        result = FetchResult(url, 304, sha256=expected_sha256.lower())
+    else:
+        result = fetch(url, staged, state.validators(url, path), expected_sha256)
+        if result.status == 200:
+            os.chmod(staged, 0o644)
+    manifest = dict(result.to_dict(), file=staged if result.status == 200 else None)
+    with open(staged + ".json", "w") as f:
+        json.dump(manifest, f)
+    os.chmod(staged + ".json", 0o644)
+
+
+def prefetched(url, path, staging_dir):
+    """(FetchResult, staged file or None) from a prefetch, or None if there was none."""
+    if not staging_dir:
+        return None
+    try:
+        with open(os.path.join(staging_dir, _manifest_name(url, path) + ".json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return FetchResult.from_dict(manifest), manifest["file"]
+
+
+def count(result):
+    if result.status == 304:
+        counters.hit(CACHE_NAME)
+    else:
+        counters.miss(CACHE_NAME)
@@ -1,6 +1,27 @@
 import os
+import shutil
 
 from globals import FILES_DIR, COMPILED_FILES_DIR
+from utils import tracing
+
+# Directory where `prefetch` leaves its results for `apply`, set by run_modules
+PREFETCH_DIR_ENV = "SYNCSMITH_PREFETCH_DIR"
+
+# Work deferred to the end of the run, in the process that applied the entries
+_end_of_run = []
+
+
+def at_end_of_run(fn):
+    """Have fn() called once the process applied its last entry of the run: once per
+    worker, or at the end of a per-entry subprocess. For batching work across entries."""
+    if fn not in _end_of_run:
+        _end_of_run.append(fn)
+    return fn
+
+
+def end_of_run():
+    for fn in _end_of_run:
+        fn()
 
 
 class SyncsmithModule:
@@ -16,6 +37,35 @@ class SyncsmithModule:
     def generate_config_stub(self, env):
         return {}
 
+    def check(self, config):
+        """Read-only drift check for --check. Returns a list of drifts (dicts with at least
+        `path` and `drift`), empty if everything is in sync, or None if the module can't tell
+        without applying. Runs concurrently with other checks: must not write or print."""
+        return None
+
+    @classmethod
+    def prefetch(cls, config, user, home, staging_dir):
+        """Called in the main process for entries of modules with `"prefetch": True` in
+        their metadata, concurrently and before the run starts. Only slow, side-effect
+        free work (like downloads) belongs here: results go to `staging_dir`, where
+        `apply` picks them up. `apply` must still work if prefetching failed.
+        """
+        return
+
+    def span(self, name, **args):
+        """Trace a `with` block in --profile output, e.g. `with self.span("fetch", url=url):`."""
+        return tracing.span(name, cat=self.name or type(self).__name__, **args)
+
+    @staticmethod
+    def _run(cmd, **kwargs):
+        """subprocess.run, traced in --profile output."""
+        return tracing.run(cmd, **kwargs)
+
+    @staticmethod
+    def _system(command):
+        """os.system, traced in --profile output."""
+        return tracing.system(command)
+
     @staticmethod
     def _find_file(filename):
         if os.path.isabs(filename):
@@ -50,6 +100,18 @@ class SyncsmithModule:
             output_location = os.path.join(COMPILED_FILES_DIR, output_path)
 
         os.makedirs(os.path.dirname(output_location), exist_ok=True)
-        with open(output_location, "w") as f:
+
+        # Leave unchanged files alone so their mtime stays stable between runs
+        if os.path.isfile(output_location):
+            with open(output_location, "r", newline="") as f:
+                if f.read() == content:
+                    return output_location
+
+        # Written next to the target and renamed over it, so readers never see a partial file
+        tmp_location = f"{output_location}.{os.getpid()}.tmp"
+        with open(tmp_location, "w") as f:
             f.write(content)
+        if os.path.isfile(output_location):
+            shutil.copymode(output_location, tmp_location)
+        os.replace(tmp_location, output_location)
         return output_location
\ No newline at end of file
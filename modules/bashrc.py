@@ -6,6 +6,8 @@ metadata = {
     "name": "bashrc",
     "description": "Sync .bashrc file",
     "single_instance": True,
+    "paths": {"writes": ["~/.bashrc"]},
+    "target_root": True,
 }
 
 class BashRC(SymLink):
@@ -16,5 +18,8 @@ class BashRC(SymLink):
         result = super().apply({"source": os.path.join(FILES_DIR, ".bashrc"), "target": os.path.expanduser("~/.bashrc")}, dry_run=dry_run)
         return result
     
+    def check(self, config=None):
+        return super().check({"source": os.path.join(FILES_DIR, ".bashrc"), "target": os.path.expanduser("~/.bashrc")})
+
     def rollback(self, config=None, dry_run=False):
         return super().rollback({"source": os.path.join(FILES_DIR, ".bashrc"), "target": os.path.expanduser("~/.bashrc")}, dry_run=dry_run)
\ No newline at end of file
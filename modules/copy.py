@@ -1,13 +1,15 @@
-import filecmp
 import os
-import shutil
 from modules.__syncsmith_module import SyncsmithModule
-from modules.__filesync_backbone import build_entries, apply_entries, rollback_entries
+from modules.__filesync_backbone import config_entries, apply_entries, check_entries, rollback_entries
+from modules.__filesync_copy import copy_file
+from modules.__filesync_state import get_state
 
 metadata = {
     "name": "copy",
     "description": "Sync any file by copying",
     "single_instance": False,
+    "paths": {"reads": ["source"], "writes": ["target"]},
+    "target_root": True,
 }
 
 class Copy(SyncsmithModule):
@@ -19,11 +21,12 @@ class Copy(SyncsmithModule):
             print(f"[DRY RUN] Would copy {src} to {dst}")
         else:
             print(f"Copying from {src} to {dst}")
-            shutil.copy2(src, dst)
+            copy_file(src, dst)
+            get_state().record_copy(src, dst)
     
     def is_synced_file(self, src, dst):
         if os.path.isfile(dst):
-            return filecmp.cmp(src, dst)
+            return get_state().is_synced_copy(src, dst)
         return False
 
     def apply(self, config, dry_run=False):
@@ -33,11 +36,14 @@ class Copy(SyncsmithModule):
         if not changed:
             print(f"Files already copied from {config.get('source', '')} to {config.get('target', '')}")
 
+    def check(self, config):
+        return check_entries(config, self.is_synced_file)
+
     def rollback(self, config, dry_run=False):
         super().rollback(config, dry_run=dry_run)
 
         try:
-            entries = build_entries(config.get("source", ""), config.get("target", ""))
+            entries = config_entries(config)
         except FileNotFoundError:
             # nothing to rollback if source missing
             entries = []
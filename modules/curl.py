@@ -1,39 +1,90 @@
 import os
-from modules.__syncsmith_module import SyncsmithModule
+import pwd
+from modules.__syncsmith_module import SyncsmithModule, PREFETCH_DIR_ENV
+from modules.__filesync_copy import copy_file
+from modules import __http_fetcher as http_fetcher
+from utils import journal, target_root
 from globals import COMPILED_FILES_DIR
 
 metadata = {
     "name": "curl",
-    "description": "Clone a git repository to a target location",
+    "description": "Download a file to a target location",
     "single_instance": False,
+    "paths": {"writes": ["path"]},
+    "prefetch": True,
+    "target_root": True,
 }
 
 class Curl(SyncsmithModule):
     def __init__(self, modulename=None):
         super().__init__(modulename)
 
+    @staticmethod
+    def _target(config, home=None):
+        outfile = config.get('path', '')
+        if home and outfile.startswith("~/"):
+            outfile = os.path.join(home, outfile[2:])
+        outfile = os.path.expanduser(outfile)
+        if not os.path.isabs(outfile):
+            return os.path.join(COMPILED_FILES_DIR, outfile)
+        return target_root.path(outfile)
+
+    @classmethod
+    def prefetch(cls, config, user, home, staging_dir):
+        http_fetcher.prefetch(config['url'], cls._target(config, home), pwd.getpwnam(user).pw_uid, staging_dir, config.get('sha256'))
+
     def apply(self, config, dry_run=False):
         super().apply(config, dry_run=dry_run)
 
         if dry_run:
             print(f"[DRY RUN] Would curl {config['url']} to {config.get('path', '')}")
             return
-        outfile = os.path.expanduser(config.get('path', ''))
-        curl_command = f"curl -sS -o {COMPILED_FILES_DIR if not os.path.isabs(outfile) else ''}{outfile} {config['url']}"
+        url = config['url']
+        outfile = self._target(config)
+        expected_sha256 = config.get('sha256')
+        state = http_fetcher.get_state()
+        journal.before_makedirs(os.path.dirname(outfile))
+        os.makedirs(os.path.dirname(outfile), exist_ok=True)
+        # Only a new body is journaled, a 304 changes nothing
+        before_write = lambda: journal.before_write(outfile)
 
-        print(f"Curling from {config['url']} to {outfile}")
-        os.system(curl_command)
+        prefetched = http_fetcher.prefetched(url, outfile, os.environ.get(PREFETCH_DIR_ENV))
+        if prefetched:
+            result, staged = prefetched
+            if staged:
+                before_write()
+                copy_file(staged, outfile)
+        elif expected_sha256 and state.matches_sha256(outfile, expected_sha256):
+            result = http_fetcher.FetchResult(url, 304, sha256=expected_sha256.lower())
+        else:
+            result = http_fetcher.fetch(url, outfile, state.validators(url, outfile), expected_sha256, before_write)
+        http_fetcher.count(result)
+
+        if result.status == 304:
+            print(f"{outfile} is up to date with {url}")
+        else:
+            print(f"Curling from {url} to {outfile}")
+            state.record_download(outfile, result)
+            state.save()
     
+    def check(self, config):
+        """Only what can be told offline: the file is there and, with `sha256`, has that digest."""
+        outfile = self._target(config)
+        if not os.path.isfile(outfile):
+            return [{"path": outfile, "drift": "missing", "source": config['url']}]
+        expected_sha256 = config.get('sha256')
+        if expected_sha256 and not http_fetcher.get_state().matches_sha256(outfile, expected_sha256):
+            return [{"path": outfile, "drift": "sha256", "expected": expected_sha256.lower()}]
+        return []
+
     def rollback(self, config, dry_run=False):
         super().rollback(config, dry_run=dry_run)
 
-        target_path = os.path.expanduser(config.get("path", ""))
-        if not os.path.isabs(target_path):
-            target_path = os.path.join(COMPILED_FILES_DIR, target_path)
+        target_path = self._target(config)
 
         if dry_run:
             print(f"[DRY RUN] Would remove file at {target_path}")
             return
         
         if os.path.exists(target_path):
-            os.remove(target_path)
\ No newline at end of file
+            os.remove(target_path)
@@ -0,0 +1,110 @@
+from modules.__syncsmith_module import SyncsmithModule
+from modules.__dconf_merge import ExceptionRules, diff, format_keyfile, merge, parse_keyfile
+from pathlib import Path
+from utils import journal
+from globals import FILES_DIR, COMPILED_FILES_DIR
+from colorama import Fore, Style
+
+
+metadata = {
+    "name": "dconf_sync",
+    "description": "Sync any dconf subtree with a three-way merge",
+    "single_instance": False,
+    "persistent_compiled_files": True,
+    "paths": {"writes": ["dconf:{paths}"]},
+}
+
+class DconfSync(SyncsmithModule):
+    """Keeps dconf subtrees in sync with files/dconf_sync/.
+
+    Example:
+        - name: dconf_sync
+          paths: ["/org/gnome/shell/extensions/", "/org/gnome/terminal/legacy/profiles:/"]
+          exceptions:
+            - key: "/org/gnome/shell/extensions/dash-to-dock/dock-position"   # keep local value
+            - key: "*/font"
+              value: "'Monospace 11'"                                       # always use this value
+    """
+
+    def __init__(self):
+        super().__init__(metadata["name"])
+
+    @staticmethod
+    def _storage_name(path):
+        return path.strip("/").replace("/", "-").replace(":", "") or "root"
+
+    def _merged(self, config):
+        """For each configured path: the path, its live values, the merge result, the keys to
+        set and to reset, and where the global and local storage are. `apply` and `check` both
+        go through this."""
+        paths = config.get("paths", [])
+        if isinstance(paths, str):
+            paths = [paths]
+        rules = ExceptionRules(config.get("exceptions", []))
+
+        merged = []
+        for path in paths:
+            path = "/" + path.strip("/") + "/"
+            name = self._storage_name(path)
+            global_path = Path(FILES_DIR) / "dconf_sync" / name
+            local_path = Path(COMPILED_FILES_DIR) / "dconf_sync" / (name + "-local")
+
+            with self.span("dconf dump", path=path):
+                live = parse_keyfile(self._run(["dconf", "dump", path], capture_output=True, text=True).stdout, path)
+            global_values = parse_keyfile(global_path.read_text(), path) if global_path.exists() else {}
+            # Without global storage there is nothing to merge against yet: local wins, like a first run
+            previous = parse_keyfile(local_path.read_text(), path) if local_path.exists() and global_path.exists() else {}
+
+            with self.span("merge", path=path, keys=len(live)):
+                result = merge(global_values, live, previous, rules)
+            changes, resets = diff(result.compiled, live)
+            merged.append((path, live, result, changes, resets, global_path, local_path))
+        return merged
+
+    def apply(self, config=None, dry_run=False):
+        changes = {}
+        resets = []
+        previous_live = {}
+        pending_writes = []
+        merged = self._merged(config)
+        for path, live, result, path_changes, path_resets, global_path, local_path in merged:
+            changes.update(path_changes)
+            resets += path_resets
+            previous_live.update({key: live.get(key) for key in list(path_changes) + path_resets})
+
+            if result.globals_changed:
+                print(Fore.YELLOW + f"[dconf_sync] {len(result.updated)} local change(s) and {len(result.removed)} removal(s) below {path}; updating global storage file." + Style.RESET_ALL)
+            pending_writes.append((format_keyfile(result.global_values, path), global_path))
+            pending_writes.append((format_keyfile(result.compiled, path), local_path))
+
+        if not changes and not resets:
+            print(f"dconf settings already in sync for {', '.join(path for path, *_ in merged)}")
+        elif dry_run:
+            print(f"[DRY RUN] Would set {len(changes)} and reset {len(resets)} dconf key(s).")
+        else:
+            journal.record("dconf", values=previous_live)
+            if changes:
+                with self.span("dconf load", keys=len(changes)):
+                    result = self._run(["dconf", "load", "/"], input=format_keyfile(changes), text=True)
+                if result.returncode != 0:
+                    print(Fore.RED + f"[dconf_sync] dconf load failed with exit code {result.returncode}" + Style.RESET_ALL)
+            for key in resets:
+                self._run(["dconf", "reset", key])
+            print(f"Applied {len(changes)} dconf setting(s), reset {len(resets)}.")
+
+        if not dry_run:
+            for content, path in pending_writes:
+                self._write_file(content, str(path))
+
+        return super().apply(config, dry_run)
+
+    def check(self, config):
+        """The keys `apply` would set or reset, from the same merge without writing anything."""
+        drifts = []
+        for path, live, result, changes, resets, global_path, local_path in self._merged(config):
+            drifts += [{"path": key, "drift": "dconf", "expected": value, "actual": live.get(key)} for key, value in changes.items()]
+            drifts += [{"path": key, "drift": "dconf", "expected": None, "actual": live[key]} for key in resets]
+        return drifts
+
+    def generate_config_stub(self, env):
+        return {"paths": [], "exceptions": []}
@@ -1,11 +1,19 @@
 import os
 from modules.__syncsmith_module import SyncsmithModule
+from modules.__edit_engine import apply_modifications
+from modules.__filesync_copy import replace_with_link
+from modules import __compile_cache as compile_cache
+from utils import journal, target_root
 from globals import COMPILED_FILES_DIR, FILES_DIR
 
 metadata = {
     "name": "edit_file",
     "description": "Edit files using custom rules",
     "single_instance": False,
+    # Part of the compile cache key: bump when the output for the same input changes
+    "version": 1,
+    "paths": {"reads": ["file"], "writes": [["output", "file"]]},
+    "target_root": True,
 }
 
 """
@@ -24,6 +32,7 @@ Notes:
 - `delete` will remove any lines that match the specified text.
 - `replace` will replace all occurrences of the specified text with the new text.
 - If `output` is specified, the modified content will be written to that path instead of overwriting the original file.
+- Outputs are cached by source content and modifications, so an unchanged output keeps its inode and mtime across runs.
 """
 
 class EditFile(SyncsmithModule):
@@ -40,49 +49,65 @@ class EditFile(SyncsmithModule):
         
         content = SyncsmithModule._read_file(file_name)
     
-        for modification in config.get("modifications", []):
-            if "add" in modification:
-                text = modification.get("add", "")
+        modifications = config.get("modifications", [])
+        output = config.get("output", file_name)
+        cache = compile_cache.get_state()
+        cache_key = compile_cache.key(metadata["name"], metadata["version"], content, modifications)
+        cached = cache.lookup(cache_key)
 
-                if text in content:                        
-                    print(f"Text already exists, skipping add: {text}")
-                    continue
-
-                if "after" in modification:
-                    after_text = modification.get("after", "")
-                    if after_text not in content:
-                        print(f"Could not find text to add after ({after_text}), skipping add: {text}")
-                        continue
-                    print(f"Adding content after '{after_text}': {text}")
-                    content = content.replace(after_text, after_text + "\n" + text)
+        if cached is None:
+            content = apply_modifications(content, modifications)
+            if dry_run:
+                print(f"[DRY RUN] Would write modified content to {output}")
+                return
+            cached = cache.store(cache_key, content)
+        elif dry_run:
+            print(f"[DRY RUN] Would reuse the cached edit of {file_name} for {output}")
+            return
+        else:
+            print(f"Unchanged since last run, reusing cached edit of {file_name}")
 
-                elif "before" in modification:
-                    before_text = modification.get("before", "")
-                    if before_text not in content:
-                        print(f"Could not find text to add before ({before_text}), skipping add: {text}")
-                        continue
-                    print(f"Adding content before '{before_text}': {text}")
-                    content = content.replace(before_text, text + "\n" + before_text)
+        if os.path.isabs(output):
+            output_location = target_root.path(os.path.expanduser(output))
+            journal.before_makedirs(os.path.dirname(output_location))
+            journal.before_write(output_location)
+            with open(cached) as f:
+                SyncsmithModule._write_file(f.read(), output_location)
+        else:
+            output_location = os.path.join(COMPILED_FILES_DIR, output)
+            os.makedirs(os.path.dirname(output_location), exist_ok=True)
+            replace_with_link(cached, output_location)
+        cache.save()
+        print(f"Finish editing file {config.get('file', '')}")
 
-                print(f"Adding content: {text}")
-                content += "\n" + text
-            elif "delete" in modification:
-                print(f"Deleting content: {modification.get('delete', '')}")
-                lines = content.splitlines()
-                lines = [line for line in lines if line.strip() != modification.get("delete", "").strip()]
-                content = "\n".join(lines)
-            elif "replace" in modification:
-                print(f"Replacing '{modification.get('replace', '')}' with '{modification.get('with', '')}'")
-                content = content.replace(
-                    modification.get("replace", ""),
-                    modification.get("with", "")
-                )
+    def check(self, config):
+        """Whether the output holds what editing the source file now would give."""
+        file_name = config.get("file", "")
+        if os.path.isabs(file_name):
+            return []
+        output = config.get("output", file_name)
+        output_location = target_root.path(output) if os.path.isabs(output) else os.path.join(COMPILED_FILES_DIR, output)
+        # A run starts from a clean compiled_files/, where an in-place edit's output isn't there yet
+        source = os.path.join(FILES_DIR, file_name) if output == file_name else self._find_file(file_name)
+        try:
+            with open(source) as f:
+                content = f.read()
+        except FileNotFoundError:
+            return [{"path": source, "drift": "source missing"}]
 
-        if not dry_run:
-            SyncsmithModule._write_file(content, config.get("output", file_name))
-            print(f"Finish editing file {config.get('file', '')}")
+        modifications = config.get("modifications", [])
+        cached = compile_cache.get_state().lookup(compile_cache.key(metadata["name"], metadata["version"], content, modifications))
+        if cached is not None:
+            with open(cached) as f:
+                expected = f.read()
         else:
-            print(f"[DRY RUN] Would write modified content to {config.get('output', file_name)}")
+            expected = apply_modifications(content, modifications, log=lambda message: None)
+        try:
+            with open(output_location) as f:
+                actual = f.read()
+        except FileNotFoundError:
+            return [{"path": output_location, "drift": "missing", "source": source}]
+        return [] if actual == expected else [{"path": output_location, "drift": "differs", "source": source}]
 
     def rollback(self, config, dry_run=False):
         super().rollback(config, dry_run=dry_run)
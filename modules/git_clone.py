@@ -1,17 +1,145 @@
+import hashlib
+import json
 import os
-from modules.__syncsmith_module import SyncsmithModule
+import pwd
+from modules.__syncsmith_module import SyncsmithModule, PREFETCH_DIR_ENV
+from utils import git_refs, journal, target_root
 from globals import COMPILED_FILES_DIR
 
 metadata = {
     "name": "git_clone",
     "description": "Clone a git repository to a target location",
     "single_instance": False,
+    "paths": {"writes": ["path"]},
+    "prefetch": True,
+    "target_root": True,
 }
 
+# Shared object store for `reference: true`, one per user
+REFERENCE_REPO = "~/.cache/syncsmith/git-reference.git"
+# Where prefetch leaves the remote's commit in its staging repository
+PREFETCHED_REF = "refs/syncsmith/prefetched"
+
 class GitClone(SyncsmithModule):
+    """Clones a repository, or brings an existing clone up to date.
+
+    Optional settings:
+        branch: main
+        depth: 1                 # shallow clone/fetch
+        filter: blob:none        # partial clone, blobs are fetched on demand
+        reference: true          # copy objects already in REFERENCE_REPO instead of downloading them,
+                                 # or the path of a local repository to copy them from
+
+    Existing clones are only fetched when the remote ref differs from the local HEAD.
+    Clones made with a reference are dissociated from it, so they never depend on
+    objects in REFERENCE_REPO (whose refs are rewritten as remotes move).
+    """
+
     def __init__(self, modulename=None):
         super().__init__(modulename)
 
+    @staticmethod
+    def _target(config, home=None):
+        target_path = config.get("path", "")
+        if home and target_path.startswith("~/"):
+            target_path = os.path.join(home, target_path[2:])
+        target_path = os.path.expanduser(target_path)
+        if target_path and not os.path.isabs(target_path):
+            return os.path.join(COMPILED_FILES_DIR, target_path)
+        return target_root.path(target_path)
+
+    @staticmethod
+    def _remote_ref(config):
+        return f"refs/heads/{config['branch']}" if "branch" in config else "HEAD"
+
+    @classmethod
+    def _remote_head(cls, config, run=None):
+        """Commit of the configured branch (or HEAD) on the remote, one round trip without fetching."""
+        run = run or cls._run
+        result = run(["git", "ls-remote", config["url"], cls._remote_ref(config)], capture_output=True, text=True)
+        if result.returncode != 0 or not result.stdout.strip():
+            return None
+        return result.stdout.split()[0]
+
+    @classmethod
+    def _fetch_args(cls, config):
+        args = ["origin"]
+        if "branch" in config:
+            args.append(config["branch"])
+        if "depth" in config:
+            args += ["--depth", str(config["depth"])]
+        return args
+
+    @staticmethod
+    def _manifest_path(staging_dir, target_path):
+        return os.path.join(staging_dir, "git-" + hashlib.sha256(target_path.encode()).hexdigest()[:20] + ".json")
+
+    @classmethod
+    def prefetch(cls, config, user, home, staging_dir):
+        """Check the remote of existing clones and, when it moved, download the new objects into
+        a staging repository that borrows the clone's objects. The clone itself is not touched:
+        `apply` fetches from the staging repository, which is local and fast."""
+        target_path = cls._target(config, home)
+        if not os.path.isdir(os.path.join(target_path, ".git")):
+            return
+
+        def run(cmd, **kwargs):
+            if pwd.getpwuid(os.getuid()).pw_name != user:
+                cmd = ["sudo", "-u", user] + cmd
+            return cls._run(cmd, **kwargs)
+
+        git_dir = git_refs.git_dir(target_path)
+        remote = cls._remote_head(config, run)
+        local = git_refs.read_head(git_dir)
+        fetched = None
+        manifest = cls._manifest_path(staging_dir, target_path)
+        if remote and remote != local:
+            staging_repo = manifest[:-len(".json")] + ".git"
+            os.mkdir(staging_repo)
+            if os.getuid() == 0:
+                os.chown(staging_repo, pwd.getpwnam(user).pw_uid, -1)
+            if run(["git", "init", "--quiet", "--bare", staging_repo], capture_output=True).returncode == 0:
+                # Objects the clone has are not downloaded again
+                with open(os.path.join(staging_repo, "objects", "info", "alternates"), "w") as f:
+                    f.write(os.path.join(os.path.abspath(git_dir), "objects") + "\n")
+                fetch = ["git", "--git-dir", staging_repo, "fetch", "--quiet", config["url"], f"{cls._remote_ref(config)}:{PREFETCHED_REF}"]
+                if "depth" in config:
+                    fetch += ["--depth", str(config["depth"])]
+                if run(fetch, capture_output=True).returncode == 0:
+                    fetched = staging_repo
+        with open(manifest, "w") as f:
+            json.dump({"remote": remote, "fetched": fetched}, f)
+        os.chmod(manifest, 0o644)
+
+    def _prefetched(self, target_path):
+        staging_dir = os.environ.get(PREFETCH_DIR_ENV)
+        if not staging_dir:
+            return None
+        try:
+            with open(self._manifest_path(staging_dir, target_path)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _reference(self, config):
+        reference = config.get("reference")
+        if not reference:
+            return None
+        if reference is not True:
+            return os.path.expanduser(str(reference))
+
+        # Keep the shared store up to date with this repository, so the clone itself only copies local objects
+        reference = os.path.expanduser(REFERENCE_REPO)
+        if not os.path.isdir(reference):
+            os.makedirs(os.path.dirname(reference), exist_ok=True)
+            self._run(["git", "init", "--quiet", "--bare", reference], check=True)
+        key = hashlib.sha256(config["url"].encode()).hexdigest()[:16]
+        with self.span("update reference", url=config["url"]):
+            result = self._run(["git", "--git-dir", reference, "fetch", "--quiet", config["url"], f"+{self._remote_ref(config)}:refs/syncsmith/{key}"])
+        if result.returncode != 0:
+            print(f"Could not update {reference}, cloning with the objects it has.")
+        return reference
+
     def apply(self, config, dry_run=False):
         super().apply(config, dry_run=dry_run)
 
@@ -19,27 +147,62 @@ class GitClone(SyncsmithModule):
             print(f"[DRY RUN] Would clone into {config['url']}")
             return
 
-        target_path = os.path.expanduser(config.get("path", ""))
+        target_path = self._target(config)
 
         if os.path.exists(target_path) and os.path.isdir(os.path.join(target_path, ".git")):
+            local = git_refs.read_head(git_refs.git_dir(target_path))
+            prefetched = self._prefetched(target_path)
+            remote = prefetched["remote"] if prefetched else self._remote_head(config)
+            if remote and remote == local:
+                print(f"Repository at {target_path} is up to date.")
+                return
+
             print(f"Repository already exists at {target_path}, pulling latest changes.")
-            os.system(f"cd {target_path} && git pull")
+            depth = ["--depth", str(config["depth"])] if "depth" in config else []
+            fetched = prefetched and prefetched["fetched"]
+            if fetched:
+                # The objects were downloaded by prefetch, this only copies them over
+                fetched = self._run(["git", "-C", target_path, "fetch", "--quiet", fetched, PREFETCHED_REF] + depth).returncode == 0
+            if "depth" in config:
+                # A shallow fetch shares no history with the old tip, so move to the new tip
+                # instead of merging; --keep refuses if that would lose local changes
+                if not fetched:
+                    self._run(["git", "-C", target_path, "fetch", "--quiet"] + self._fetch_args(config), check=True)
+                self._run(["git", "-C", target_path, "reset", "--quiet", "--keep", "FETCH_HEAD"], check=True)
+            elif fetched:
+                self._run(["git", "-C", target_path, "merge", "--quiet", "FETCH_HEAD"], check=True)
+            else:
+                self._run(["git", "-C", target_path, "pull", "--quiet"], check=True)
             return
 
-        clone_command = f"git clone {config['url']}"
+        clone_command = ["git", "clone", config["url"]]
 
         if "branch" in config:
-            clone_command += f" -b {config['branch']}"
+            clone_command += ["-b", config["branch"]]
+        if "depth" in config:
+            clone_command += ["--depth", str(config["depth"])]
+        if "filter" in config:
+            clone_command += [f"--filter={config['filter']}"]
+        reference = self._reference(config)
+        if reference:
+            clone_command += ["--reference-if-able", reference, "--dissociate"]
 
         if target_path:
-            if not os.path.isabs(target_path):
-                clone_command += str(COMPILED_FILES_DIR) + "/"
+            clone_command.append(target_path)
 
-            clone_command += f" {target_path}"
-
-        print(f"Executing: {clone_command}")
-        os.system(clone_command)
+        print(f"Executing: {' '.join(clone_command)}")
+        if target_path and not os.path.lexists(target_path) and journal.current():
+            # Pulls into an existing clone are not journaled; a new clone is undone by removing it
+            journal.record("create_dir", path=target_path)
+        self._run(clone_command, check=True)
     
+    def check(self, config):
+        """Offline: the clone is there. Whether the remote moved is left to `apply`."""
+        target_path = self._target(config)
+        if not os.path.isdir(os.path.join(target_path, ".git")):
+            return [{"path": target_path, "drift": "missing", "source": config.get("url")}]
+        return []
+
     def rollback(self, config, dry_run=False):
         super().rollback(config, dry_run=dry_run)
 
@@ -52,4 +215,4 @@ class GitClone(SyncsmithModule):
             return
         
         if os.path.exists(target_path):
-            os.system(f"rm -rf {target_path}")
\ No newline at end of file
+            self._system(f"rm -rf {target_path}")
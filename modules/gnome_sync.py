@@ -1,4 +1,6 @@
 from modules.__syncsmith_module import SyncsmithModule
+from modules.__dconf_merge import parse_keyfile
+from utils import journal
 import os
 from pathlib import Path
 from globals import FILES_DIR, COMPILED_FILES_DIR
@@ -10,11 +12,22 @@ import re
 from io import StringIO
 
 
+DCONF_ROOT = "/org/gnome/"
+
+CONF_FILES = [
+    "settings-daemon/plugins/media-keys",
+    "desktop/wm/keybindings",
+    "shell/keybindings",
+    "mutter/keybindings",
+    "mutter/wayland/keybindings",
+]
+
 metadata = {
     "name": "gnome_sync",
     "description": "Sync Gnome configuration",
     "single_instance": True,
     "persistent_compiled_files": True,
+    "paths": {"writes": ["dconf:/org/gnome/"]},
 }
 
 class GnomeSync(SyncsmithModule):
@@ -29,49 +42,126 @@ class GnomeSync(SyncsmithModule):
 
         exceptions = config.get("shortcut_exceptions", [])
 
-        conf_files = [
-            "settings-daemon/plugins/media-keys",
-            "desktop/wm/keybindings",
-            "shell/keybindings",
-            "mutter/keybindings",
-            "mutter/wayland/keybindings",
-        ]
+        # One snapshot of everything below /org/gnome/, split per keybinding schema in memory
+        with self.span("dconf dump"):
+            live = self._split_dump(self._run(["dconf", "dump", DCONF_ROOT], capture_output=True, text=True).stdout, CONF_FILES)
 
-        for conf_file in conf_files:
+        changes = []
+        pending_writes = []
+        for conf_file in CONF_FILES:
             global_path = STORAGE_DIR / conf_file.replace("/", "-")
-            local_path = COMPILED_DIR / conf_file.replace("/", "-")
+            local_path = COMPILED_DIR / (conf_file.replace("/", "-") + "-local")
+            backup_path = COMPILED_DIR / (conf_file.replace("/", "-") + "-local-backup")
 
-            if (os.path.exists(str(local_path) + '-local')):
-                os.system(f"mv {str(local_path) + '-local'} {str(local_path) + '-local-previous'}")
-                
-            os.system(f"dconf dump /org/gnome/{conf_file}/ > {str(local_path) + '-local'}")
+            # The compiled config of the last run is what the user saw before changing anything
+            previous = local_path.read_text() if local_path.exists() else None
 
-            local_keybindings = self._parse_gnome_keybindings(str(local_path) + '-local')
-            local_keybindings_previous = self._parse_gnome_keybindings(str(local_path) + '-local-previous')
+            local_keybindings = self._parse_gnome_keybindings_text(live[conf_file])
+            local_keybindings_previous = self._parse_gnome_keybindings_text(previous or "")
             global_keybindings = self._parse_gnome_keybindings(str(global_path))
 
-            self._generate_gnome_keybindings(conf_file, local_keybindings, local_keybindings_previous, global_keybindings, exceptions)
-
-            # Apply the compiled local config
-            if not dry_run:
-                os.system(f"dconf load /org/gnome/{conf_file}/ < {str(local_path) + '-local'}")
-            
-            # If first run (local_previous doesn't exist), backup current local
-            if (not os.path.exists(str(local_path) + '-local-previous') and not os.path.exists(str(local_path) + '-local-backup')):
-                os.system(f"cp {str(local_path) + '-local'} {str(local_path) + '-local-backup'}")
+            compiled = self._generate_gnome_keybindings(conf_file, local_keybindings, local_keybindings_previous, global_keybindings, exceptions)
+            changes += self._changed_keys(conf_file, compiled, live[conf_file])
+
+            pending_writes.append((compiled, local_path))
+            # If first run (no previous compiled config), backup current local
+            if previous is None and not backup_path.exists():
+                pending_writes.append((compiled, backup_path))
+
+        # Apply only the keys whose compiled value differs from the live one
+        if not changes:
+            print("Gnome keyboard shortcuts already up to date.")
+        elif dry_run:
+            print(f"[DRY RUN] Would update {len(changes)} Gnome keyboard shortcut setting(s).")
+        else:
+            previous_live = {}
+            for conf_file in CONF_FILES:
+                previous_live.update(parse_keyfile(live[conf_file], DCONF_ROOT + conf_file))
+            journal.record("dconf", values={f"{DCONF_ROOT}{section}/{key}": previous_live.get(f"{DCONF_ROOT}{section}/{key}") for section, key, _ in changes})
+            with self.span("dconf load", keys=len(changes)):
+                result = self._run(["dconf", "load", DCONF_ROOT], input=self._keyfile(changes), text=True)
+            if result.returncode != 0:
+                print(Fore.RED + f"[gnome_sync] dconf load failed with exit code {result.returncode}" + Style.RESET_ALL)
+            else:
+                print(f"Applied compiled Gnome keyboard shortcuts ({len(changes)} setting(s) changed).")
 
-            if os.path.exists(str(local_path) + '-local-previous'):
-                os.remove(str(local_path) + '-local-previous')
+        for content, path in pending_writes:
+            self._write_file(content, str(path))
 
-        print(f"Applied compiled Gnome keyboard shortcuts.")
         return super().apply(config, dry_run)
+
+    def check(self, config=None):
+        """Shortcuts changed in dconf since they were last applied. Merging in global storage
+        writes it, so changes coming from there only show up once `apply` ran."""
+        live = self._split_dump(self._run(["dconf", "dump", DCONF_ROOT], capture_output=True, text=True).stdout, CONF_FILES)
+        drifts = []
+        for conf_file in CONF_FILES:
+            local_path = COMPILED_DIR / (conf_file.replace("/", "-") + "-local")
+            if not local_path.exists():
+                drifts.append({"path": DCONF_ROOT + conf_file + "/", "drift": "never applied"})
+                continue
+            for section, key, value in self._changed_keys(conf_file, local_path.read_text(), live[conf_file]):
+                drifts.append({"path": f"{DCONF_ROOT}{section}/{key}", "drift": "dconf", "expected": value})
+        return drifts
+
+    @staticmethod
+    def _split_dump(dump, conf_files):
+        """Split a `dconf dump /org/gnome/` into what `dconf dump /org/gnome/<conf_file>/` would print for each conf_file."""
+        parts = {conf_file: [] for conf_file in conf_files}
+        current = None
+        for line in dump.splitlines():
+            stripped = line.strip()
+            if stripped.startswith("[") and stripped.endswith("]"):
+                section = stripped[1:-1]
+                current = None
+                for conf_file in conf_files:
+                    if section == conf_file:
+                        current = parts[conf_file]
+                        current.append("[/]")
+                    elif section.startswith(conf_file + "/"):
+                        current = parts[conf_file]
+                        current.append(f"[{section[len(conf_file) + 1:]}]")
+            elif current is not None:
+                current.append(line)
+        return {conf_file: "\n".join(lines) + "\n" if lines else "" for conf_file, lines in parts.items()}
+
+    @staticmethod
+    def _raw_config(text):
+        config = configparser.ConfigParser(interpolation=None)
+        config.optionxform = str
+        config.read_string(text)
+        return config
+
+    def _changed_keys(self, conf_file, compiled, live):
+        """(dconf section, key, value) for every compiled key that differs from the live value."""
+        compiled_config = self._raw_config(compiled)
+        live_config = self._raw_config(live)
+        changes = []
+        for section in compiled_config.sections():
+            full_section = conf_file if section == "/" else f"{conf_file}/{section}"
+            for key, value in compiled_config[section].items():
+                if not live_config.has_section(section) or live_config[section].get(key) != value:
+                    changes.append((full_section, key, value))
+        return changes
+
+    @staticmethod
+    def _keyfile(changes):
+        """Keyfile for `dconf load /org/gnome/` setting exactly `changes`."""
+        sections = {}
+        for section, key, value in changes:
+            sections.setdefault(section, []).append(f"{key}={value}")
+        return "".join(f"[{section}]\n" + "\n".join(lines) + "\n\n" for section, lines in sections.items())
     
     def generate_config_stub(self, env):
         return {"shortcut_exceptions": []}
 
     def _parse_gnome_keybindings(self, path):
+        text = Path(path).read_text() if os.path.exists(path) else ""
+        return self._parse_gnome_keybindings_text(text)
+
+    def _parse_gnome_keybindings_text(self, text):
         config = configparser.ConfigParser()
-        config.read(path)
+        config.read_string(text)
 
         keybindings = {}
 
@@ -172,10 +262,11 @@ class GnomeSync(SyncsmithModule):
         locals_prev = {v.get("name"): v for v in local_custom_previous.values() if v.get("name")}
 
         # Preserve input order by `name`: iterate local entries in their original order
-        # (skipping entries that lack a name), then append any global-only names
-        ordered_names = list(locs.keys()).copy()
-        ordered_names.extend([name for name in globs.keys() if name not in ordered_names])
-        ordered_names.extend([name for name in exceptions_by_name.keys() if name not in ordered_names and exceptions_by_name[name].get("command")])
+        # (skipping entries that lack a name), then append any global-only names.
+        # A dict keeps that order and makes the membership checks constant time.
+        ordered_names = dict.fromkeys(locs)
+        ordered_names.update(dict.fromkeys(globs))
+        ordered_names.update(dict.fromkeys(name for name, ex in exceptions_by_name.items() if ex.get("command")))
 
         final_custom_entries = []
         for name in ordered_names:
@@ -185,7 +276,7 @@ class GnomeSync(SyncsmithModule):
                 
             if name in locals_prev and name not in locs:
                 # Was removed locally -> remove from global as well
-                if name in exceptions_by_name or not set(exceptions_by_binding.keys()).isdisjoint([glob.get("binding", ""), loc.get("binding", ""), loc_prev.get("binding", "")]):
+                if name in exceptions_by_name or not exceptions_by_binding.keys().isdisjoint([glob.get("binding", ""), loc.get("binding", ""), loc_prev.get("binding", "")]):
                     print(Fore.YELLOW + f"[gnome_sync] Detected removal of custom keybinding '{name}' but it is in exceptions, preserving in global storage." + Style.RESET_ALL)
                 else: 
                     print(Fore.YELLOW + f"[gnome_sync] Detected removal of custom keybinding '{name}', removing from global storage." + Style.RESET_ALL)
@@ -276,13 +367,17 @@ class GnomeSync(SyncsmithModule):
         except Exception as e:
             print(Fore.RED + f"[gnome_sync] Error writing updated global storage: {e}" + Style.RESET_ALL)
 
-        return self._write_config(config, str(COMPILED_DIR / (conf_file.replace("/", "-") + "-local")))
+        # The compiled local config is written by `apply` once dconf is updated
+        return self._config_text(config)
 
-    def _write_config(self, config, path):
+    def _config_text(self, config):
         buffer = StringIO()
         config.write(buffer)
         content = buffer.getvalue()
         new_contents = [line.replace(" = ", "=", 1) for line in content.splitlines()]
-        content = "\n".join(new_contents)
+        return "\n".join(new_contents)
+
+    def _write_config(self, config, path):
+        content = self._config_text(config)
         self._write_file(content, path)
         return content
\ No newline at end of file
@@ -6,6 +6,8 @@ metadata = {
     "name": "ssh_keys",
     "description": "Sync SSH authorized_keys file",
     "single_instance": True,
+    "paths": {"writes": ["~/.ssh/authorized_keys"]},
+    "target_root": True,
 }
 
 class SSHKeys(SymLink):
@@ -15,5 +17,8 @@ class SSHKeys(SymLink):
     def apply(self, config=None, dry_run=False):
         return super().apply({"source": os.path.join(FILES_DIR, "ssh_keys"), "target": os.path.expanduser("~/.ssh/authorized_keys")}, dry_run=dry_run)
     
+    def check(self, config=None):
+        return super().check({"source": os.path.join(FILES_DIR, "ssh_keys"), "target": os.path.expanduser("~/.ssh/authorized_keys")})
+
     def rollback(self, config=None, dry_run=False):
         return super().rollback({"source": os.path.join(FILES_DIR, "ssh_keys"), "target": os.path.expanduser("~/.ssh/authorized_keys")}, dry_run=dry_run)
\ No newline at end of file
@@ -1,11 +1,17 @@
 import os
 from modules.__syncsmith_module import SyncsmithModule
-from modules.__filesync_backbone import build_entries, apply_entries, rollback_entries
+from modules.__filesync_backbone import config_entries, apply_entries, check_entries, rollback_entries
+from modules.__filesync_copy import copy_file, replace_with_symlink
+from modules.__filesync_state import get_state
+from utils import target_root
+from utils.generations import current_path
 
 metadata = {
     "name": "symlink",
     "description": "Sync any file using symbolic links",
     "single_instance": False,
+    "paths": {"reads": ["source"], "writes": ["target"]},
+    "target_root": True,
 }
 
 class SymLink(SyncsmithModule):
@@ -13,15 +19,31 @@ class SymLink(SyncsmithModule):
         super().__init__(modulename)
 
     def _apply_one(self, src, dst, dry_run=False):
+        # In another root a link back into syncsmith's tree would dangle: files are copied there
+        if target_root.active():
+            if dry_run:
+                print(f"[DRY RUN] Would copy {src} to {dst} (no symlinks out of the target root)")
+            else:
+                print(f"Copying from {src} to {dst} (no symlinks out of the target root)")
+                copy_file(src, dst)
+                get_state().record_copy(src, dst)
+            return
+        # Links into compiled_files go through the generation pointer, which only moves after a complete run
+        src = current_path(src)
         if dry_run:
             print(f"[DRY RUN] Would create symlink from {src} to {dst}")
         else:
             print(f"Creating symlink from {src} to {dst}")
-            os.symlink(src, dst)
+            replace_with_symlink(src, dst)
+            get_state().record_link(src, dst)
 
     def is_synced_file(self, src, dst):
-        if os.path.islink(dst):
-            return os.readlink(dst) == src
+        if target_root.active():
+            return os.path.isfile(dst) and get_state().is_synced_copy(src, dst)
+        src = current_path(src)
+        if os.path.islink(dst) and os.readlink(dst) == src:
+            get_state().record_link(src, dst)
+            return True
         return False
 
     def apply(self, config, dry_run=False):
@@ -31,11 +53,19 @@ class SymLink(SyncsmithModule):
         if not changed:
             print(f"Symlinks already exist from {config.get('source', '')} to {config.get('target', '')}")
 
+    def _linked_before_commit(self, src, dst):
+        """dst links through compiled_files/ (made before the generation with src was current),
+        which stays right until the next run moves it to current."""
+        return not target_root.active() and os.path.islink(dst) and os.readlink(dst) == src
+
+    def check(self, config):
+        return check_entries(config, lambda src, dst: self.is_synced_file(src, dst) or self._linked_before_commit(src, dst))
+
     def rollback(self, config, dry_run=False):
         super().rollback(config, dry_run=dry_run)
 
         try:
-            entries = build_entries(config.get("source", ""), config.get("target", ""))
+            entries = config_entries(config)
         except FileNotFoundError:
             # nothing to rollback if source missing
             entries = []
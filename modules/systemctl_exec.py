@@ -1,14 +1,31 @@
 import subprocess
 import shlex
 from modules.__syncsmith_module import SyncsmithModule
-from globals import COMPILED_FILES_DIR
+from utils import journal, target_root
+from globals import COMPILED_FILES_DIR, TARGET_ROOT
 
 metadata = {
     "name": "systemctl_exec",
     "description": "Execute systemctl commands",
     "single_instance": False,
+    "paths": {"reads": ["/etc/systemd", "/usr/lib/systemd", "~/.config/systemd"], "writes": ["systemd:"]},
+    "target_root": True,
 }
 
+# Action -> (systemctl query, states that count as done for enable/start)
+CHECKS = {
+    "enable": ("is-enabled", {"enabled", "enabled-runtime", "static", "alias", "indirect", "generated"}),
+    "disable": ("is-enabled", {"enabled", "enabled-runtime"}),
+    "start": ("is-active", {"active", "reloading", "activating"}),
+    "stop": ("is-active", {"active", "reloading", "activating"}),
+}
+
+# What undoes an action, for the change journal
+UNDO = {"enable": "disable", "disable": "enable", "start": "stop", "stop": "start"}
+
+# What works offline on another root, through `systemctl --root`
+ROOT_ACTIONS = ["enable", "disable"]
+
 class SystemctlExec(SyncsmithModule):
     def __init__(self, modulename=None):
         super().__init__(modulename)
@@ -30,13 +47,55 @@ class SystemctlExec(SyncsmithModule):
             return
 
         full_cmd = ["systemctl"] + parts
+        if target_root.active():
+            if action not in ROOT_ACTIONS:
+                print(f"Skipping '{action}' in target root {TARGET_ROOT}, only {', '.join(ROOT_ACTIONS)} apply there.")
+                return
+            full_cmd = ["systemctl", f"--root={TARGET_ROOT}"] + parts
 
         if dry_run:
             print(f"[DRY RUN] Would run: {' '.join(full_cmd)}")
             return
 
+        if journal.current() and action in UNDO:
+            scope, units = self._scope(parts)
+            for unit, state in self._states(action, scope, units):
+                # Units already in the wanted state are left as they are by a rollback
+                if not self._done(action, state):
+                    journal.record("systemctl", args=scope + [UNDO[action], unit])
+
         try:
             print(f"Executing: {' '.join(full_cmd)}")
-            subprocess.run(full_cmd, check=True)
+            self._run(full_cmd, check=True)
         except subprocess.CalledProcessError as e:
-            print(f"[ERROR] systemctl failed: {e}")
\ No newline at end of file
+            print(f"[ERROR] systemctl failed: {e}")
+
+    def check(self, config):
+        """Whether the units are enabled/disabled or active/inactive as `enable`, `disable`,
+        `start` and `stop` would leave them. Other actions can't be checked."""
+        parts = shlex.split(config.get("command", "").strip())
+        if not parts or parts[0] not in CHECKS:
+            return None
+        if target_root.active() and parts[0] not in ROOT_ACTIONS:
+            return None
+        scope, units = self._scope(parts)
+        query = CHECKS[parts[0]][0]
+        return [{"path": f"systemd:{unit}", "drift": query, "expected": parts[0], "actual": state}
+                for unit, state in self._states(parts[0], scope, units) if not self._done(parts[0], state)]
+
+    @staticmethod
+    def _scope(parts):
+        """(systemctl options selecting the manager, units) of a command."""
+        scope = [part for part in parts[1:] if part in ("--user", "--system", "--global")]
+        if target_root.active():
+            scope.append(f"--root={TARGET_ROOT}")
+        return scope, [part for part in parts[1:] if not part.startswith("-")]
+
+    def _states(self, action, scope, units):
+        query = CHECKS[action][0]
+        for unit in units:
+            yield unit, self._run(["systemctl"] + scope + [query, unit], capture_output=True, text=True).stdout.strip()
+
+    @staticmethod
+    def _done(action, state):
+        return (state in CHECKS[action][1]) == (action in ("enable", "start"))
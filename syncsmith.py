@@ -1,27 +1,98 @@
 #!/usr/bin/env python3
-import os, argparse, yaml, importlib, inspect
+import os, argparse, json
 import sys
 from colorama import Fore, Style
-from utils.system_info import get_os_release
-from utils.conditional_config import ConditionalConfig
-from globals import ROOT_DIR, ENV_FILE, CONFIG_FILE, COMPILED_FILES_DIR
-import subprocess
-import pwd
-import shutil
+from utils import tracing
+from globals import ROOT_DIR, ENV_FILE, CONFIG_FILE, COMPILED_FILES_DIR, FILES_DIR, STATE_DIR, TARGET_ROOT
+
+# Only what every invocation needs, --help included, is imported up here; the
+# rest where it is used, so runs with nothing to do start fast (see benchmarks/startup.py)
+
+# Concurrent prefetches (downloads) before modules run
+PREFETCH_JOBS = 8
+
+# Roots provisioned at once with --root
+ROOT_JOBS = os.cpu_count() or 4
+
+# Facts written into a new environment.yaml; the rest are only computed when a condition asks
+ENV_FILE_FACTS = ["host", "os", "os_pretty", "os_version", "desktop_environment", "install_dir", "user"]
+# Those that describe this machine: a --root run finds them out for the root instead
+MACHINE_FACTS = ["host", "os", "os_pretty", "os_version", "desktop_environment"]
+
+def _yaml_load(stream):
+    import yaml
+    # Use the libyaml C loader when PyYAML was built with it
+    return yaml.load(stream, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)) or {}
 
 def load_yaml(path):
     if not path.exists(): return {}
-    with open(path) as f: return yaml.safe_load(f) or {}
+    with open(path) as f: return _yaml_load(f)
+
+def load_plan(config_file, env):
+    """Return the pruned config, reusing the cached plan when config and env are unchanged."""
+    from utils import plan_cache
+    from utils.conditional_config import ConditionalConfig
+    from utils.facts import FactError
+    config_bytes = config_file.read_bytes() if config_file.exists() else b""
+    key = plan_cache.plan_key(config_bytes, env.values)
+    with tracing.span("plan_cache.load", cat="phase"):
+        plan = plan_cache.load(key, env)
+    if plan is None:
+        with tracing.span("load_yaml", cat="phase", path=config_file):
+            raw_config = _yaml_load(config_bytes)
+        with tracing.span("ConditionalConfig.parse", cat="phase"):
+            try:
+                plan = ConditionalConfig.parse(raw_config, env)
+            except FactError as e:
+                print(Fore.RED + f"[ERROR] {e}" + Style.RESET_ALL)
+                sys.exit(1)
+        plan_cache.store(key, plan, env.used)
+    return plan
+
+def _write_output(data):
+    sys.stdout.write(data)
+    sys.stdout.flush()
+
+def _result_file(directory, user):
+    """A new empty file in directory that only `user` (besides root) may write."""
+    import pwd, tempfile
+    fd, path = tempfile.mkstemp(dir=directory)
+    if os.getuid() == 0 and user != "root":
+        os.fchown(fd, pwd.getpwnam(user).pw_uid, -1)
+    os.close(fd)
+    return path
 
-def run_modules(config, env, args):
+def _prefetch(cls, entry, home, staging_dir):
+    with tracing.span("prefetch", cat="prefetch", module=entry.name, index=entry.index):
+        try:
+            cls.prefetch(entry.conf, entry.user, home, staging_dir)
+        except Exception:
+            # The entry does the work itself, and reports any error, when it runs
+            pass
+
+def run_modules(config, env, args, select=None):
+    """Run the entries of config. With `select`, a function from the entries to the indices
+    to run (for --watch and --resume), only those run, on top of what compiled_files/ holds."""
+    import pwd, shutil, tempfile, threading, subprocess
+    from concurrent.futures import ThreadPoolExecutor, wait
+    from modules.__syncsmith_module import PREFETCH_DIR_ENV
+    from utils import backups, counters, generations, journal, ownership, registry, run_fingerprint, target_root
+    from utils.module_worker import ModuleWorker, WorkerError, WorkerPool, worker_command
+    from utils.scheduler import Entry, build_graph, resolve_paths, run_graph
     dry_run = args.dry_run
     modules = config.get("modules", {})
-    module_path = ROOT_DIR / "modules"
     initiated_modules = []
+    rebuilt = set()
 
     REAL_USER = env.get("user", "unknown")
-    REAL_USER_UID = pwd.getpwnam(REAL_USER).pw_uid
-    REAL_HOME = pwd.getpwnam(REAL_USER).pw_dir
+    # In a target root the user, home and groups are the root's
+    REAL_USER_UID, REAL_USER_PRIMARY_GID, REAL_HOME = target_root.user(REAL_USER)
+    # `chown user:user` means the group named after the user
+    try:
+        REAL_USER_GID = target_root.group(REAL_USER)
+    except KeyError:
+        REAL_USER_GID = REAL_USER_PRIMARY_GID
+    ownership_skip = config.get("ownership_skip", ownership.DEFAULT_SKIP)
     RUNNING_AS = pwd.getpwuid(os.getuid()).pw_name
     DIR_OWNER = pwd.getpwuid(os.stat(ROOT_DIR).st_uid).pw_name
 
@@ -30,15 +101,20 @@ def run_modules(config, env, args):
     module_env["USER"] = REAL_USER
     module_env["XDG_RUNTIME_DIR"] = f"/run/user/{REAL_USER_UID}"
 
-    # Create compiled_files directory if it doesn't exist
-    COMPILED_FILES_DIR.mkdir(parents=True, exist_ok=True)
+    # Create the state directory if it doesn't exist; compiled_files is made by generations.begin
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    if os.getuid() == 0:
+        os.chown(STATE_DIR, REAL_USER_UID, REAL_USER_PRIMARY_GID)
+
+    # Cache counters from per-entry subprocesses are collected through a file per entry,
+    # in a directory of this run that nobody else can list or write into
+    run_counters = {}
+    results_dir = tempfile.mkdtemp(prefix="syncsmith-run-")
+    os.chmod(results_dir, 0o711)
 
-    # Delete all loose files from compiled_files directory
-    for item in COMPILED_FILES_DIR.iterdir():
-        if item.is_file():
-            item.unlink()
-        elif item.is_dir() and item.name not in [mod.get("name", "") for mod in modules]:
-            shutil.rmtree(item)
+    # Trace events from per-entry subprocesses are collected the same way
+    if tracing.enabled():
+        module_env[tracing.TRACE_ENV] = "1"
 
     # Try to find the DBUS address if it's not in the environment
     if "DBUS_SESSION_BUS_ADDRESS" not in module_env:
@@ -47,76 +123,267 @@ def run_modules(config, env, args):
         if os.path.exists(bus_path):
             module_env["DBUS_SESSION_BUS_ADDRESS"] = f"unix:path={bus_path}"
 
-    if DIR_OWNER != REAL_USER:
-        subprocess.run(["sudo", "-u", DIR_OWNER, "chown", "-R", f":{REAL_USER}", str(ROOT_DIR)], check=True)
-        subprocess.run(["sudo", "-u", DIR_OWNER, "chmod", "-R", "g+rwX", str(ROOT_DIR)], check=True)
+    # In a target root the user is the root's, not one who works on this tree
+    if DIR_OWNER != REAL_USER and not TARGET_ROOT:
+        # Saved files keep their owner and mode, they are hardlinks to what was replaced
+        internal = [str(backups.BACKUP_DIR.relative_to(ROOT_DIR)), str(journal.JOURNAL_DIR.relative_to(ROOT_DIR))]
+        result = ownership.fix_as(DIR_OWNER, ROOT_DIR, gid=REAL_USER_GID, group_writable=True, skip=list(ownership_skip) + internal)
+        print(Fore.CYAN + f"[syncsmith] ownership of {ROOT_DIR}: {result}" + Style.RESET_ALL)
+
+    entries = []
     for module_conf in modules:
-        mod_file = module_path / f"{module_conf['name']}.py"
-        if not mod_file.exists():
+        # Class and metadata come from the manifest, the module itself is only imported by workers
+        info = registry.get(module_conf["name"])
+        if info is None:
             print(Fore.RED + f"[ERROR] Unknown module '{module_conf['name']}' — file not found." + Style.RESET_ALL)
             continue
         
         if not module_conf.get("enabled", True):
             print(Fore.YELLOW + f"==> Module '{module_conf['name']}' is disabled in config, skipping." + Style.RESET_ALL)
             continue
-            
-        module = importlib.import_module(f"modules.{module_conf['name']}")
-        classes = [cls for _, cls in inspect.getmembers(module, inspect.isclass) if cls.__module__ == module.__name__]
         
-        if not classes:
+        if not info["class"]:
             print(Fore.YELLOW + f"[WARN] No class found in {module_conf['name']}.py" + Style.RESET_ALL)
             continue
 
-        meta = getattr(module, "metadata", {"name": module_conf["name"]})
+        meta = info["metadata"]
+
+        if TARGET_ROOT and not meta.get("target_root", False):
+            print(Fore.YELLOW + f"==> Module '{module_conf['name']}' only applies to the running system, skipping it for {TARGET_ROOT}." + Style.RESET_ALL)
+            continue
 
         if meta.get("single_instance", True) and module_conf['name'] in initiated_modules:
             print(Fore.YELLOW + f"[WARN] Module '{module_conf['name']}' is single-instance and already initiated, skipping." + Style.RESET_ALL)
             continue
         
-        # Clear compiled files for this module unless marked as persistent
-        if not meta.get("persistent_compiled_files", False):
-            for item in COMPILED_FILES_DIR.glob(f"{module_conf['name']}*"):
-                if item.is_file():
-                    item.unlink()
-                elif item.is_dir():
-                    for subitem in item.iterdir():
-                        if subitem.is_file():
-                            subitem.unlink()
-                    item.rmdir()
+        # This module's compiled files start from scratch unless marked as persistent
+        if select is None and not meta.get("persistent_compiled_files", False):
+            rebuilt.add(module_conf['name'])
 
-        print(Fore.CYAN + f"==> Running module: {module_conf['name']}" + Style.RESET_ALL)
+        expected_user = ("root" if module_conf.get("sudo", False) else REAL_USER)
+        if TARGET_ROOT:
+            # The user may only exist in the root; files are chowned to them afterwards
+            expected_user = RUNNING_AS
+        entry = Entry(len(entries), module_conf, info["class"], meta, expected_user)
+        resolve_paths(entry, REAL_HOME)
+        entries.append(entry)
+        initiated_modules.append(module_conf['name'])
 
-        cmd = ["python3", "-c", f"import sys; sys.path.insert(0, '{ROOT_DIR}'); from modules.{module_conf['name']} import *; {classes[0].__name__}().apply({module_conf}, dry_run={dry_run})"]
+    try:
+        with tracing.span("build_graph", cat="phase"):
+            build_graph(entries)
+    except ValueError as e:
+        print(Fore.RED + f"[ERROR] {e}" + Style.RESET_ALL)
+        sys.exit(1)
 
-        expected_user = ("root" if module_conf.get("sudo", False) else REAL_USER)
-        if RUNNING_AS != expected_user:
-            cmd = ["sudo", "-u", expected_user, "-E"] + cmd
+    # What the entries write besides the sync state's targets, for the run fingerprint
+    run_fingerprint.set_targets({target_root.path(path) for entry in entries for path in entry.writes
+                                 if os.path.isabs(path) and not path.startswith(str(ROOT_DIR) + os.sep)})
+
+    # The journal is this user's; entries running as someone else save the files they replace in their own
+    # part of it. Each user has a backup store of their own.
+    for user in {entry.user for entry in entries}:
+        if journal.current():
+            journal.allow(pwd.getpwnam(user).pw_uid)
+        if not dry_run:
+            backups.allow(pwd.getpwnam(user).pw_uid)
+
+    # Outputs go into a new generation. Persistent modules' compiled files are carried over
+    # into it, and for partial runs everything is. A dry run looks at the current one.
+    owner = (REAL_USER_UID, REAL_USER_GID) if os.getuid() == 0 else None
+    if not dry_run:
+        generations.begin(None if select is not None else {conf.get("name", "") for conf in modules} - rebuilt, owner)
+
+    selected = None
+    if select is not None:
+        selected = select(entries)
+        print(Fore.CYAN + f"[syncsmith] Running {len(selected)} of {len(entries)} entries: {', '.join(entries[i].label for i in sorted(selected)) or 'none'}" + Style.RESET_ALL)
+        # What affected entries compile is built again from scratch
+        for index in selected:
+            if entries[index].meta.get("persistent_compiled_files", False):
+                continue
+            for path in entries[index].writes:
+                if path.startswith(str(COMPILED_FILES_DIR) + os.sep) and os.path.isfile(path) and not dry_run:
+                    os.unlink(path)
+
+    # Long-lived workers per effective user, started on first use. If a worker
+    # cannot be started, entries fall back to one subprocess each.
+    def start_worker(user):
+        cmd = worker_command(ROOT_DIR)
+        if RUNNING_AS != user:
+            cmd = ["sudo", "-u", user, "-E"] + cmd
+        # Includes waiting for sudo authentication
+        with tracing.span("start worker", cat="sudo" if RUNNING_AS != user else "worker", user=user):
+            return ModuleWorker(user, cmd, module_env)
+
+    # Up to --jobs workers per user, started only while entries of that user wait for one
+    pool = WorkerPool(start_worker, size=args.jobs)
+    counters_lock = threading.Lock()
+
+    # Slow, side-effect free work (downloads) of all entries runs concurrently up front;
+    # an entry waits for its own prefetch before it is applied
+    prefetches = {}
+    prefetch_dir = None
+    prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_JOBS)
+    to_prefetch = [entry for entry in entries if entry.meta.get("prefetch") and (selected is None or entry.index in selected)]
+    if to_prefetch and not dry_run:
+        prefetch_dir = tempfile.mkdtemp(prefix="syncsmith-prefetch-")
+        os.chmod(prefetch_dir, 0o755)
+        module_env[PREFETCH_DIR_ENV] = prefetch_dir
+        for entry in to_prefetch:
+            prefetches[entry.index] = prefetch_pool.submit(_prefetch, registry.module_class(entry.name), entry, REAL_HOME, prefetch_dir)
+
+    def run_entry(entry, out):
+        if selected is not None and entry.index not in selected:
+            return True
+        with tracing.span(entry.label, cat="entry", module=entry.name, user=entry.user, index=entry.index):
+            ok = _run_entry(entry, out)
+        if ok:
+            journal.entry_done(entry.index, entry.label)
+        return ok
+
+    def _run_entry(entry, out):
+        module_conf = entry.conf
+        out(Fore.CYAN + f"==> Running module: {entry.name}" + Style.RESET_ALL + "\n")
+        if entry.index in prefetches:
+            with tracing.span("wait for prefetch", cat="entry"):
+                wait([prefetches[entry.index]])
         if module_conf.get("sudo", False) and REAL_USER != "root":
-            print(Fore.YELLOW + f"Running module using sudo." + Style.RESET_ALL)
+            out(Fore.YELLOW + f"Running module using sudo." + Style.RESET_ALL + "\n")
 
-        subprocess.run(cmd, env=module_env, check=True, stdout=sys.stdout.fileno(), stderr=sys.stderr.fileno())        
+        worker = None
+        if not args.no_worker:
+            try:
+                worker = pool.acquire(entry.user)
+            except (OSError, WorkerError) as e:
+                out(Fore.YELLOW + f"[WARN] Could not start module worker for '{entry.user}' ({e}), falling back to one process per module." + Style.RESET_ALL + "\n")
 
-        initiated_modules.append(module_conf['name'])
-    
-    os.system(f"sudo chown -R {REAL_USER}:{REAL_USER} {COMPILED_FILES_DIR}")
+        if worker:
+            try:
+                result = worker.run(entry.name, entry.class_name, module_conf, dry_run=dry_run, on_output=out)
+            except WorkerError as e:
+                pool.release(worker, broken=True)
+                out(Fore.RED + f"[ERROR] {e}" + Style.RESET_ALL + "\n")
+                return False
+            pool.release(worker)
+            with counters_lock:
+                counters.merge(run_counters, result.get("counters", {}))
+            tracing.add(result.get("trace", []))
+            if not result["ok"]:
+                out(Fore.RED + f"[ERROR] Module '{entry.name}' failed: {result['error']}" + Style.RESET_ALL + "\n")
+            return result["ok"]
+
+        cmd = ["python3", "-c", f"import sys; sys.path.insert(0, '{ROOT_DIR}'); from modules.{entry.name} import *; {entry.class_name}().apply({module_conf}, dry_run={dry_run}); from utils import counters, tracing; from modules.__syncsmith_module import end_of_run; end_of_run(); counters.dump(); tracing.dump()"]
+        if RUNNING_AS != entry.user:
+            cmd = ["sudo", "-u", entry.user, "-E"] + cmd
+        entry_env = dict(module_env)
+        entry_env[counters.COUNTERS_FILE_ENV] = counters_file = _result_file(results_dir, entry.user)
+        if tracing.enabled():
+            entry_env[tracing.TRACE_FILE_ENV] = trace_file = _result_file(results_dir, entry.user)
+        # As another user it can't append to the journal, its records are added when it is done
+        records_file = None
+        if journal.current() and RUNNING_AS != entry.user:
+            entry_env[journal.RECORDS_FILE_ENV] = records_file = _result_file(results_dir, entry.user)
+
+        with tracing.span("subprocess", cat="sudo" if RUNNING_AS != entry.user else "worker", user=entry.user):
+            if args.jobs == 1:
+                returncode = subprocess.run(cmd, env=entry_env, stdout=sys.stdout.fileno(), stderr=sys.stderr.fileno()).returncode
+            else:
+                proc = subprocess.run(cmd, env=entry_env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+                out(proc.stdout)
+                returncode = proc.returncode
+        with counters_lock:
+            counters.merge(run_counters, counters.load(counters_file))
+        if tracing.enabled():
+            tracing.add(tracing.load(trace_file))
+        if records_file:
+            journal.load_relayed(records_file, pwd.getpwnam(entry.user).pw_uid)
+        if returncode != 0:
+            out(Fore.RED + f"[ERROR] Module '{entry.name}' exited with status {returncode}" + Style.RESET_ALL + "\n")
+        return returncode == 0
+
+    def prune_backups(user):
+        """Apply the retention policy to user's backup store as them, in one of their workers
+        or through sudo. Returns (versions dropped, bytes freed)."""
+        worker = None
+        if not args.no_worker:
+            try:
+                worker = pool.acquire(user)
+            except (OSError, WorkerError):
+                pass
+        if worker:
+            try:
+                result = worker.prune_backups(config.get("backups"), on_output=_write_output)
+                pool.release(worker)
+            except WorkerError as e:
+                pool.release(worker, broken=True)
+                result = {"ok": False, "error": str(e)}
+        else:
+            cmd = ["sudo", "-u", user, "-E", sys.executable, "-m", "utils.backups", "prune", json.dumps(config.get("backups"))]
+            proc = subprocess.run(cmd, cwd=ROOT_DIR, env=module_env, capture_output=True, text=True)
+            result = {"ok": proc.returncode == 0, "error": proc.stderr.strip(), "pruned": json.loads(proc.stdout) if proc.returncode == 0 else None}
+        if not result["ok"]:
+            print(Fore.YELLOW + f"[WARN] Could not prune the backups of '{user}': {result['error']}" + Style.RESET_ALL)
+            return 0, 0
+        return result["pruned"]
+
+    pruned = [0, 0]
+    try:
+        failed = run_graph(entries, run_entry, jobs=args.jobs, write=_write_output)
+        # Work the modules batch across entries (SELinux contexts) runs once per worker
+        for result in pool.end_of_run(on_output=_write_output):
+            with counters_lock:
+                counters.merge(run_counters, result.get("counters", {}))
+            tracing.add(result.get("trace", []))
+            if not result["ok"]:
+                print(Fore.RED + f"[ERROR] End of run work failed: {result['error']}" + Style.RESET_ALL)
+        # The stores of the other users with entries are only theirs to prune (ours is below)
+        if not dry_run:
+            for user in sorted({entry.user for entry in entries}):
+                if pwd.getpwnam(user).pw_uid != os.getuid():
+                    with tracing.span("backup retention", cat="phase", user=user):
+                        dropped, freed = prune_backups(user)
+                    pruned = [pruned[0] + dropped, pruned[1] + freed]
+    finally:
+        pool.close()
+        prefetch_pool.shutdown(wait=True, cancel_futures=True)
+        if prefetch_dir:
+            shutil.rmtree(prefetch_dir, ignore_errors=True)
+        shutil.rmtree(results_dir, ignore_errors=True)
+
+    if not dry_run:
+        result = ownership.fix_as("root", COMPILED_FILES_DIR, uid=REAL_USER_UID, gid=REAL_USER_GID, skip=ownership_skip)
+        print(Fore.CYAN + f"[syncsmith] ownership of {COMPILED_FILES_DIR}: {result}" + Style.RESET_ALL)
+    home_in_root = target_root.path(REAL_HOME, follow=True)
+    if TARGET_ROOT and os.getuid() == 0 and os.path.isdir(home_in_root) and not dry_run:
+        result = ownership.fix(home_in_root, uid=REAL_USER_UID, gid=REAL_USER_GID, skip=ownership_skip)
+        print(Fore.CYAN + f"[syncsmith] ownership of {home_in_root}: {result}" + Style.RESET_ALL)
+
+    # Only a complete run becomes what symlinks into compiled_files see
+    if not failed and not dry_run:
+        generations.commit(owner)
+        counters.merge(run_counters, counters.take())
+    if not dry_run:
+        with tracing.span("backup retention", cat="phase"):
+            dropped, freed = backups.prune(config.get("backups"))
+        dropped, freed = dropped + pruned[0], freed + pruned[1]
+        if dropped:
+            print(Fore.CYAN + f"[syncsmith] backups: dropped {dropped} old version(s), {freed // 1024} KiB freed" + Style.RESET_ALL)
+
+    for line in counters.summary(run_counters):
+        print(Fore.CYAN + f"[syncsmith] {line}" + Style.RESET_ALL)
+    return failed
 
 def ensure_local_env(env_file, args):
+    """Load environment.yaml as the facts for `when:` conditions. Only a new (or reset)
+    file is filled in with the basic facts; everything else is computed when asked for."""
+    import copy, yaml
+    from utils import facts
     reset = args.reset_env
-    os_info = get_os_release()
-
-    # Auto-filled envdata values
-    default_env = {
-        "host": os.uname().nodename,
-        "os": os_info.get("ID", "unknown"),
-        "os_pretty": os_info.get("PRETTY_NAME", "Unknown"),
-        "os_version": os_info.get("VERSION_ID", "unknown"),
-        "desktop_environment": os.environ.get("DESKTOP_SESSION", "unknown").strip().lower(),
-        "install_dir": str(ROOT_DIR),
-        "user": os.environ.get("USER", "unknown"),
-        "tags": [],
-    }
 
     # Parse additional env vars from command line
+    cli_values = {}
+    cli_tags = []
     if args.env:
         for item in args.env:
             if "=" not in item:
@@ -124,47 +391,55 @@ def ensure_local_env(env_file, args):
                 continue
             key, value = item.split("=", 1)
 
-            if key.strip() not in default_env:
-                print(Fore.YELLOW + f"[WARN] Unrecognized env var '{key.strip()}' provided via command line, skipping." + Style.RESET_ALL)
-                continue
-
             if key.strip() in ["tag", "tags"]:
-                default_env["tags"].append(value.strip())
+                cli_tags.append(value.strip())
+            elif key.strip() in facts.names():
+                cli_values[key.strip()] = value.strip()
             else:
-                default_env[key.strip()] = value.strip()
+                print(Fore.YELLOW + f"[WARN] Unrecognized env var '{key.strip()}' provided via command line, skipping." + Style.RESET_ALL)
 
-    # Check if on proxmox host using `os.path.isdir("/etc/pve")` and append 'proxmox' tag
-    if os.path.isdir("/etc/pve"):
-        default_env["tags"].append("proxmox")
-    # Check if on a laptop using `os.path.exists("/sys/class/power_supply/BAT*")` and append 'laptop' tag
-    # Check not only BAT0 but any BAT* to cover more hardware variations
-    # Use a os.system command to do it more slimly
-    if os.system("ls /sys/class/power_supply/BAT* >/dev/null 2>&1") == 0:
-        default_env["tags"].append("laptop")
+    if TARGET_ROOT:
+        # Every root starts from environment.yaml with its own values on top, and nothing is written back
+        new_env = {key: value for key, value in load_yaml(env_file).items() if key not in MACHINE_FACTS}
+        new_env.update(cli_values)
+        new_env["tags"] = list(dict.fromkeys((new_env.get("tags") or []) + cli_tags))
+        return facts.Facts(new_env)
 
     new_env = None
     if env_file.exists() and not reset:
-        with open(env_file) as f:
-            new_env = yaml.safe_load(f) or {}
+        new_env = load_yaml(env_file)
     else:
         print(Fore.YELLOW + "[syncsmith] Creating or refreshing environment file..." + Style.RESET_ALL)
         new_env = {}
+    previous_env = copy.deepcopy(new_env) if env_file.exists() and not reset else None
 
-    # --- Merge in auto-fill data (don’t overwrite user values) ---
-    for key, value in default_env.items():
+    # --- Merge in command line values and, for a new file, the basic facts (don’t overwrite user values) ---
+    for key, value in cli_values.items():
         if key not in new_env:
             new_env[key] = value
+    if previous_env is None:
+        computed = facts.Facts()
+        for key in ENV_FILE_FACTS:
+            if key not in new_env:
+                new_env[key] = computed.get(key)
 
     # --- Merge tags ---
     new_env["tags"] = (new_env.get("tags") or [])
-    new_env["tags"].extend(default_env["tags"])
+    new_env["tags"].extend(cli_tags)
     new_env["tags"] = list(dict.fromkeys(new_env["tags"]))
 
-    # --- Write back to disk ---
-    with open(env_file, "w") as f:
-        yaml.safe_dump(new_env, f, sort_keys=False)
+    # --- Write back to disk, only if something changed ---
+    if new_env != previous_env:
+        with open(env_file, "w") as f:
+            yaml.safe_dump(new_env, f, sort_keys=False)
+
+    return facts.Facts(new_env)
 
-    return new_env
+def _positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return number
 
 def main():
     parser = argparse.ArgumentParser(description="Syncsmith — Keep your system configuration in sync")
@@ -174,14 +449,279 @@ def main():
     parser.add_argument("--reset-env", action="store_true", help="Reset the local environment configuration file")
     parser.add_argument("--user", help="Set the standard user for running modules")
     parser.add_argument("--env", nargs="*", help="Additional environment variables (key=value)")
+    parser.add_argument("--jobs", "-j", type=_positive_int, default=1, help="Number of independent module entries to run concurrently (and of workers started per user)")
+    parser.add_argument("--no-worker", action="store_true", help="Run every module entry in its own process instead of a shared worker")
+    parser.add_argument("--force", action="store_true", help="Run even if nothing changed since the last successful run")
+    parser.add_argument("--profile", metavar="FILE", help="Write a Chrome trace / Perfetto JSON profile of the run to FILE")
+    parser.add_argument("--watch", action="store_true", help="Keep running and apply the entries affected by changes to files/, config.yaml and environment.yaml")
+    parser.add_argument("--check", action="store_true", help="Only check for drift, without changing anything, and print a JSON report")
+    parser.add_argument("--root", action="append", metavar="DIR[:key=value,...]", help="Apply into DIR instead of / (repeat for several roots, provisioned in parallel), with the given environment values on top of environment.yaml")
+    parser.add_argument("--root-jobs", type=_positive_int, default=ROOT_JOBS, help="Number of roots provisioned concurrently")
+    parser.add_argument("--rollback", nargs="?", const="last", metavar="RUN", help="Undo the changes journaled by the last run (or RUN) and exit")
+    parser.add_argument("--resume", action="store_true", help="Continue the last run from where it was interrupted or failed")
+    parser.add_argument("--backups", nargs="?", const="", metavar="PATH", help="List the backed up paths, or the saved versions of PATH, and exit (from the backup store of --user, or of PATH's owner)")
+    parser.add_argument("--restore", metavar="PATH[@N]", help="Put version N (default the newest) of PATH back from the backup store (of --user, or of PATH's owner) and exit")
     args = parser.parse_args()
 
-    environment = ensure_local_env(ENV_FILE, args)
-    raw_config = load_yaml(CONFIG_FILE)
-    parsed_config = ConditionalConfig.parse(raw_config, environment)
-    
-    run_modules(parsed_config, environment, args)
+    if args.root and not TARGET_ROOT:
+        if args.watch or args.profile:
+            parser.error("--root can't be combined with --watch or --profile")
+        sys.exit(run_roots(args))
+
+    if args.check:
+        sys.exit(check(args))
+    if args.rollback:
+        sys.exit(rollback(args))
+    if args.backups is not None:
+        sys.exit(list_backups(args))
+    if args.restore:
+        sys.exit(restore(args))
+
+    if args.resume:
+        from utils import journal
+        try:
+            run_id, records = journal.load()
+        except (FileNotFoundError, PermissionError) as e:
+            print(Fore.RED + f"[ERROR] {e}" + Style.RESET_ALL)
+            sys.exit(1)
+        done = journal.resumable(records)
+        if done is None:
+            print(Fore.GREEN + f"[syncsmith] Run {run_id} completed, nothing to resume." + Style.RESET_ALL)
+            return
+        print(Fore.CYAN + f"[syncsmith] Resuming run {run_id} after {len(done)} completed entries." + Style.RESET_ALL)
+        sys.exit(1 if run(args, resume_from=(run_id, records[0].get("plan"), done)) else 0)
+
+    main_run = watch if args.watch else run
+    if args.profile:
+        tracing.enable()
+        tracing.process_name("syncsmith")
+        try:
+            failed = main_run(args)
+        finally:
+            tracing.write(args.profile, tracing.take())
+            print(f"[syncsmith] Wrote profile to {args.profile}")
+    else:
+        failed = main_run(args)
+    if failed:
+        sys.exit(1)
+
+def run(args, changed=None, resume_from=None):
+    """One run: of everything, of the entries affected by the `changed` paths (--watch), or of
+    the entries the journaled run `resume_from` (its id, plan hash and completed entries) didn't
+    complete (--resume). Returns the failed or skipped entries."""
+    from utils import run_fingerprint
+    partial = changed is not None or resume_from is not None
+    with tracing.span("fingerprint check", cat="phase"):
+        unchanged = not partial and not (args.force or args.dry_run or args.reset_env) and run_fingerprint.is_unchanged(args)
+    if unchanged:
+        print(Fore.GREEN + "[syncsmith] Nothing changed since the last run, skipping. Use --force to run anyway." + Style.RESET_ALL)
+        return []
+
+    from utils import journal
+    from utils.scheduler import affected
+    with tracing.span("ensure_local_env", cat="phase"):
+        environment = ensure_local_env(ENV_FILE, args)
+    parsed_config = load_plan(CONFIG_FILE, environment)
+
+    select = None
+    if changed is not None:
+        select = lambda entries: affected(entries, changed)
+    elif resume_from is not None:
+        run_id, plan_hash, done = resume_from
+        if journal.plan_hash(parsed_config) != plan_hash:
+            print(Fore.RED + f"[ERROR] The plan changed since run {run_id}, it can't be resumed. Run everything again instead." + Style.RESET_ALL)
+            sys.exit(1)
+        select = lambda entries: {entry.index for entry in entries} - done
+
+    if not args.dry_run:
+        if resume_from is not None:
+            journal.resume(resume_from[0])
+        else:
+            journal.start(journal.plan_hash(parsed_config), sys.argv[1:])
+    ok = False
+    try:
+        with tracing.span("run_modules", cat="phase"):
+            failed = run_modules(parsed_config, environment, args, select)
+        ok = not failed
+    finally:
+        if journal.current():
+            journal.finish(ok)
+    if failed:
+        run_fingerprint.clear()
+        print(Fore.RED + f"\n[syncsmith] Finished with {len(failed)} failed or skipped module(s): {', '.join(entry.label for entry in failed)}" + Style.RESET_ALL)
+        return failed
+    # A partial run leaves the fingerprint of the last full one, which no longer matches
+    if not args.dry_run and not partial:
+        run_fingerprint.record(args)
     print(Fore.GREEN + "\n[syncsmith] Done." + Style.RESET_ALL)
+    return failed
+
+def _root_command(args, env_items):
+    """The command line for one root's run, the same as this one without --root."""
+    cmd = [sys.executable, str(ROOT_DIR / "syncsmith.py"), "--jobs", str(args.jobs)]
+    for flag, enabled in (("--dry-run", args.dry_run), ("--yes", args.yes), ("--no-worker", args.no_worker),
+                          ("--force", args.force), ("--check", args.check), ("--resume", args.resume)):
+        if enabled:
+            cmd.append(flag)
+    if args.rollback:
+        cmd += ["--rollback", args.rollback]
+    if args.backups is not None:
+        cmd += ["--backups", args.backups]
+    if args.restore:
+        cmd += ["--restore", args.restore]
+    if args.user:
+        cmd += ["--user", args.user]
+    env_items = (args.env or []) + env_items
+    if env_items:
+        cmd += ["--env"] + env_items
+    return cmd
+
+def run_roots(args):
+    """--root: one run per root, each in its own process with the root in its environment,
+    at most --root-jobs at a time. Output is printed per root, in command line order.
+    Returns the highest exit status."""
+    import subprocess
+    from concurrent.futures import ThreadPoolExecutor
+    from utils import target_root
+    def run_one(spec):
+        root, env_items = target_root.parse_spec(spec)
+        if not os.path.isdir(root):
+            return root, 1, f"[ERROR] Target root {root} is not a directory\n"
+        env = dict(os.environ, **{target_root.TARGET_ROOT_ENV: root})
+        proc = subprocess.run(_root_command(args, env_items), cwd=ROOT_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        return root, proc.returncode, proc.stdout
+
+    status = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.root_jobs)) as pool:
+        for root, returncode, output in pool.map(run_one, args.root):
+            color = Fore.GREEN if returncode == 0 else Fore.RED
+            print(Fore.CYAN + f"==> Root {root}" + Style.RESET_ALL)
+            sys.stdout.write(output)
+            print(color + f"[syncsmith] {root}: exit status {returncode}" + Style.RESET_ALL)
+            status = max(status, returncode)
+    return status
+
+def rollback(args):
+    """--rollback: undo a journaled run, returns the exit status."""
+    from utils import journal, run_fingerprint
+    try:
+        failed = journal.rollback(None if args.rollback == "last" else args.rollback, dry_run=args.dry_run)
+    except (FileNotFoundError, PermissionError) as e:
+        print(Fore.RED + f"[ERROR] {e}" + Style.RESET_ALL)
+        return 1
+    if not args.dry_run:
+        run_fingerprint.clear()
+    return 1 if failed else 0
+
+def _backup_store(args, path=None):
+    """The uid whose backup store --backups/--restore use: --user's, else the owner of path, else ours."""
+    import pwd
+    from utils import backups
+    if args.user:
+        return pwd.getpwnam(args.user).pw_uid
+    return backups.owner(path) if path else os.getuid()
+
+def list_backups(args):
+    """--backups: list the backup store, or the versions of one path."""
+    import time
+    from utils import backups, target_root
+    try:
+        if not args.backups:
+            for path, count in sorted(backups.paths(_backup_store(args)).items()):
+                print(f"{count:4}  {path}")
+            return 0
+        path = target_root.path(args.backups)
+        saved = backups.versions(path, _backup_store(args, path))
+    except (KeyError, OSError) as e:
+        print(Fore.RED + f"[ERROR] {e}" + Style.RESET_ALL)
+        return 1
+    if not saved:
+        print(Fore.YELLOW + f"No backups of {args.backups}" + Style.RESET_ALL)
+        return 1
+    for number, version in enumerate(saved, 1):
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(version["time"]))
+        what = f"-> {version['link']}" if version["kind"] == "symlink" else f"{version['kind']} {version['mode']:o} {version['uid']}:{version['gid']}"
+        print(f"{number:4}  {when}  {what}")
+    return 0
+
+def restore(args):
+    """--restore: put a saved version of a path back, returns the exit status."""
+    import subprocess, time
+    from utils import backups, run_fingerprint, target_root
+    path, _, number = args.restore.rpartition("@")
+    if not path or not number.isdigit():
+        path, number = args.restore, None
+    target = target_root.path(path)
+    try:
+        uid = _backup_store(args, target)
+        if uid == os.getuid():
+            version = backups.restore(target, int(number) if number else None)
+        else:
+            # Only the store's owner trusts what is in it
+            cmd = ["sudo", "-u", f"#{uid}", "-E", sys.executable, "-m", "utils.backups", "restore", os.path.abspath(os.path.expanduser(target))] + ([number] if number else [])
+            proc = subprocess.run(cmd, cwd=ROOT_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            if proc.returncode != 0:
+                raise OSError(proc.stderr.strip() or f"Restoring as uid {uid} failed")
+            version = json.loads(proc.stdout)
+    except (KeyError, OSError, IndexError) as e:
+        print(Fore.RED + f"[ERROR] {e}" + Style.RESET_ALL)
+        return 1
+    print(Fore.GREEN + f"[syncsmith] Restored {path} as of {time.ctime(version['time'])}." + Style.RESET_ALL)
+    # The next run must not assume the target is still as it left it
+    run_fingerprint.clear()
+    return 0
+
+def check(args):
+    """--check: scan every entry for drift in this process, print the report as JSON and
+    return the exit status (see drift.exit_status)."""
+    from utils import drift, target_root
+    environment = ensure_local_env(ENV_FILE, args)
+    parsed_config = load_plan(CONFIG_FILE, environment)
+    home = target_root.user(environment.get("user", "unknown"))[2]
+    # Targets like ~/.bashrc are the real user's, as when modules run
+    os.environ["HOME"] = home
+    report = drift.scan(parsed_config, home)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    return drift.exit_status(report)
+
+def watch(args):
+    """--watch: run everything, then after every batch of changes only the affected entries.
+    A change to config.yaml or environment.yaml (or more changes than are tracked) runs everything."""
+    import yaml
+    from utils.watch import Watcher
+    watcher = Watcher(trees=[FILES_DIR], files=[CONFIG_FILE, ENV_FILE])
+    args.force = True
+
+    def run_once(changed=None):
+        # Whatever stops one run (a half-saved config, a dependency cycle, a failing fact or
+        # module), the next save gets another chance
+        try:
+            run(args, changed)
+        except yaml.YAMLError as e:
+            print(Fore.RED + f"[ERROR] {e}" + Style.RESET_ALL)
+        except SystemExit as e:
+            if e.code:
+                print(Fore.RED + f"[ERROR] The run stopped with exit status {e.code}, waiting for the next change." + Style.RESET_ALL)
+        except Exception as e:
+            print(Fore.RED + f"[ERROR] The run failed: {type(e).__name__}: {e}" + Style.RESET_ALL)
+
+    print(Fore.CYAN + "[syncsmith] Watching files/, config.yaml and environment.yaml for changes, Ctrl+C to stop." + Style.RESET_ALL)
+    try:
+        run_once()
+        while True:
+            changed, overflow = watcher.wait()
+            if overflow or str(CONFIG_FILE) in changed or str(ENV_FILE) in changed:
+                print(Fore.CYAN + "\n[syncsmith] Configuration changed, running everything." + Style.RESET_ALL)
+                run_once()
+            else:
+                print(Fore.CYAN + f"\n[syncsmith] {len(changed)} path(s) changed." + Style.RESET_ALL)
+                run_once(changed)
+    except KeyboardInterrupt:
+        print(Fore.CYAN + "\n[syncsmith] Stopped watching." + Style.RESET_ALL)
+    finally:
+        watcher.close()
+    return []
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -7,6 +7,7 @@ else
 fi
 
 AUTO_MODE=false
+FORCE=false
 REPAIR=false
 REPAIR_ATTEMPTED=false
 for arg in "$@"; do
@@ -14,6 +15,9 @@ for arg in "$@"; do
         --auto)
             AUTO_MODE=true
             ;;
+        --force)
+            FORCE=true
+            ;;
         --repair)
             REPAIR=true
             ;;
@@ -26,9 +30,14 @@ done
 cd "$INSTALL_DIR" || { echo "[syncsmith] Failed to enter install directory"; exit 1; }
 
 if [ "$AUTO_MODE" = true ]; then
-    git stash -u
     git fetch origin main
-    git reset --hard origin/main
+    # Nothing to reset if we are already at origin/main with no local changes
+    if [ "$FORCE" = false ] && [ "$(git rev-parse HEAD)" = "$(git rev-parse origin/main)" ] && [ -z "$(git status --porcelain --untracked-files=no)" ]; then
+        echo "[syncsmith] Already up to date with origin/main."
+    else
+        git stash -u
+        git reset --hard origin/main
+    fi
 else
     git pull origin main
 fi
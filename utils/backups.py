@@ -0,0 +1,362 @@
+"""Backup store for the files syncsmith replaces.
+
+A diverged target is saved here instead of as `<target>.bak` next to it.
+Every user has a store of their own, backups/<uid>/, that only they can
+enter: entries running as root save into root's, the others into their
+user's. `--backups`/`--restore` use the store of `--user`, or of the path's
+owner, and a store is only restored from by its owner (through sudo, with
+`python -m utils.backups restore PATH [NUMBER]`).
+Contents are stored once per distinct content in objects/<sha256>: hardlinked
+to the displaced file when possible (it is replaced by rename right after, so
+the store keeps the only link), reflinked otherwise, and gzip-compressed as a
+last resort (objects/<sha256>.gz). Directories are kept as objects/<sha256>.tar.gz.
+An object is checked against its name whenever it is stored again or restored.
+
+index/<sha256 of the path>.json lists the versions of one path, oldest first,
+with their time, mode and owner, so finding and restoring any version of a path
+is one small file read.
+
+`prune()` runs after every run, for each user with entries in their worker (or
+through sudo, `python -m utils.backups prune RETENTION`), and enforces the
+retention policy (`backups:` in config.yaml, see DEFAULT_RETENTION) on their store:
+versions older than max_age_days are dropped except for the newest one of each
+path, then the oldest versions go until the store fits in max_size_mb.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import sys
+import time
+from modules.__filesync_copy import FICLONE, _temp_name
+from globals import STATE_DIR
+
+BACKUP_DIR = STATE_DIR / "backups"
+DEFAULT_RETENTION = {"max_age_days": 90, "max_size_mb": 1024}
+# Objects nothing refers to are only removed once older than this, an index may be about to
+ORPHAN_AGE = 3600
+
+
+def allow(uid):
+    """Make sure processes of uid can keep their store, creating it for them when running as root."""
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    st = os.stat(BACKUP_DIR)
+    # Shared (1777) by older versions
+    if st.st_mode & 0o022 and st.st_uid == os.getuid():
+        os.chmod(BACKUP_DIR, 0o755)
+    store = BACKUP_DIR / str(uid)
+    if os.getuid() == 0 and uid != 0 and not os.path.lexists(store):
+        os.mkdir(store, 0o700)
+        os.chown(store, uid, -1)
+
+
+def _store_dir(create=False, uid=None):
+    """The store of uid (default this user), None if there is none (and not `create`).
+    Raises PermissionError if it is not a directory of theirs that only they can enter."""
+    uid = os.getuid() if uid is None else uid
+    store = BACKUP_DIR / str(uid)
+    if create and not os.path.lexists(store):
+        BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+        try:
+            os.mkdir(store, 0o700)
+        except FileExistsError:
+            pass
+    try:
+        st = os.lstat(store)
+    except FileNotFoundError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != uid or st.st_mode & 0o077:
+        raise PermissionError(f"{store} may have been written by another user (owner {st.st_uid}, "
+                              f"mode {st.st_mode & 0o7777:o}), refusing to use it")
+    if create:
+        for directory in ("objects", "index"):
+            os.makedirs(store / directory, mode=0o700, exist_ok=True)
+    return store
+
+
+def _index_path(store, path):
+    return store / "index" / (hashlib.sha256(path.encode()).hexdigest() + ".json")
+
+
+def _load_index(index_path):
+    try:
+        with open(index_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_index(index_path, index):
+    tmp_path = _temp_name(str(index_path))
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _copy_checked(src, dst_path, name):
+    """Copy the file object src to dst_path, raising OSError unless what was copied hashes to name."""
+    digest = hashlib.sha256()
+    with open(dst_path, "wb") as dst:
+        while chunk := src.read(1024 * 1024):
+            digest.update(chunk)
+            dst.write(chunk)
+    if digest.hexdigest() != name.split(".")[0]:
+        raise OSError(f"Backup object {name} does not hold what its name says, not restoring it")
+
+
+def _intact(object_path, name):
+    """Whether the object at object_path holds what its name says."""
+    import gzip
+    try:
+        if name.endswith(".gz") and not name.endswith(".tar.gz"):
+            digest = hashlib.sha256()
+            with gzip.open(object_path, "rb") as f:
+                while chunk := f.read(1024 * 1024):
+                    digest.update(chunk)
+            return digest.hexdigest() == name.split(".")[0]
+        return _hash_file(object_path) == name.split(".")[0]
+    except (OSError, EOFError):
+        return False
+
+
+def _store(store, tmp_path, name):
+    """Move tmp_path to objects/name unless an intact object of that name exists already."""
+    object_path = store / "objects" / name
+    if object_path.exists() and _intact(object_path, name):
+        os.unlink(tmp_path)
+    else:
+        os.replace(tmp_path, object_path)
+    return name
+
+
+def _store_file(store, path):
+    """Store the contents of the file at path, returns the object name."""
+    tmp_path = _temp_name(str(store / "objects" / "new"))
+    try:
+        os.link(path, tmp_path)
+        return _store(store, tmp_path, _hash_file(tmp_path))
+    except OSError:
+        pass
+    # Another filesystem, or a file we may read but not link (protected_hardlinks)
+    with open(path, "rb") as src:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            fcntl.ioctl(fd, FICLONE, src.fileno())
+            os.close(fd)
+            return _store(store, tmp_path, _hash_file(tmp_path))
+        except OSError:
+            os.close(fd)
+            os.unlink(tmp_path)
+        import gzip
+        sha = hashlib.sha256()
+        with gzip.open(tmp_path, "wb") as dst:
+            while chunk := src.read(1024 * 1024):
+                sha.update(chunk)
+                dst.write(chunk)
+    os.chmod(tmp_path, 0o600)
+    return _store(store, tmp_path, sha.hexdigest() + ".gz")
+
+
+def _store_tree(store, path):
+    import gzip
+    import tarfile
+    tmp_path = _temp_name(str(store / "objects" / "new"))
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    # mtime=0 so that the same tree gives the same object
+    with os.fdopen(fd, "wb") as f, gzip.GzipFile(fileobj=f, mode="wb", mtime=0) as gz, tarfile.open(fileobj=gz, mode="w") as tar:
+        tar.add(path, arcname=".")
+    return _store(store, tmp_path, _hash_file(tmp_path) + ".tar.gz")
+
+
+def save(path):
+    """Save what is at path as its newest version. Directories are taken away, since
+    they can't be replaced by rename; files and symlinks stay in place. Returns the version."""
+    path = str(path)
+    store = _store_dir(create=True)
+    st = os.lstat(path)
+    version = {"time": time.time(), "mode": st.st_mode & 0o7777, "uid": st.st_uid, "gid": st.st_gid}
+    if os.path.islink(path):
+        version.update(kind="symlink", link=os.readlink(path))
+    elif os.path.isdir(path):
+        version.update(kind="tree", object=_store_tree(store, path))
+        shutil.rmtree(path)
+    else:
+        version.update(kind="file", object=_store_file(store, path))
+    index_path = _index_path(store, path)
+    index = _load_index(index_path) or {"path": path, "versions": []}
+    index["versions"].append(version)
+    _write_index(index_path, index)
+    return version
+
+
+def versions(path, uid=None):
+    """The saved versions of path in the store of uid (default this user), oldest first."""
+    store = _store_dir(uid=uid)
+    if store is None:
+        return []
+    index = _load_index(_index_path(store, os.path.abspath(os.path.expanduser(str(path)))))
+    return index["versions"] if index else []
+
+
+def paths(uid=None):
+    """{path: number of versions} for everything in the store of uid (default this user)."""
+    found = {}
+    store = _store_dir(uid=uid)
+    if store is not None and (store / "index").exists():
+        for index_file in (store / "index").glob("*.json"):
+            index = _load_index(index_file)
+            if index:
+                found[index["path"]] = len(index["versions"])
+    return found
+
+
+def _extract(version, tmp_path):
+    import gzip
+    import tarfile
+    name = version["object"]
+    object_path = _store_dir() / "objects" / name
+    if version["kind"] == "tree":
+        if not _intact(object_path, name):
+            raise OSError(f"Backup object {name} does not hold what its name says, not restoring it")
+        os.mkdir(tmp_path)
+        with tarfile.open(object_path, "r:gz") as tar:
+            tar.extractall(tmp_path, **({"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}))
+    elif name.endswith(".gz"):
+        with gzip.open(object_path, "rb") as src:
+            _copy_checked(src, tmp_path, name)
+    else:
+        with open(object_path, "rb") as src:
+            _copy_checked(src, tmp_path, name)
+
+
+def restore(path, number=None):
+    """Put version `number` (1 is the oldest, default the newest) of path back in place.
+    What is there now is saved first. Returns the restored version."""
+    path = os.path.abspath(os.path.expanduser(str(path)))
+    saved = versions(path)
+    if not saved:
+        raise FileNotFoundError(f"No backups of {path}")
+    if number is None:
+        number = len(saved)
+    if not 1 <= number <= len(saved):
+        raise IndexError(f"{path} has versions 1 to {len(saved)}, not {number}")
+    version = saved[number - 1]
+
+    tmp_path = _temp_name(path)
+    try:
+        if version["kind"] == "symlink":
+            os.symlink(version["link"], tmp_path)
+        else:
+            _extract(version, tmp_path)
+            os.chmod(tmp_path, version["mode"])
+            if os.getuid() == 0:
+                os.chown(tmp_path, version["uid"], version["gid"])
+        if os.path.lexists(path):
+            save(path)
+            # A directory can't be renamed over a file
+            if os.path.lexists(path) and version["kind"] == "tree":
+                os.unlink(path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.isdir(tmp_path) and not os.path.islink(tmp_path):
+            shutil.rmtree(tmp_path)
+        elif os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return version
+
+
+def prune(retention=None):
+    """Apply the retention policy. Returns (versions dropped, bytes freed)."""
+    store = _store_dir()
+    if store is None or not (store / "index").exists():
+        return 0, 0
+    retention = dict(DEFAULT_RETENTION, **(retention or {}))
+    oldest = time.time() - retention["max_age_days"] * 24 * 3600
+    max_bytes = retention["max_size_mb"] * 1024 * 1024
+
+    indexes = {}
+    for index_file in (store / "index").glob("*.json"):
+        index = _load_index(index_file)
+        if index:
+            indexes[index_file] = index
+    objects = {entry.name: entry.stat(follow_symlinks=False) for entry in os.scandir(store / "objects")}
+    before = {index_file: len(index["versions"]) for index_file, index in indexes.items()}
+    referenced = {v["object"] for index in indexes.values() for v in index["versions"] if "object" in v}
+
+    # Too old, unless it is the only way back for its path
+    for index in indexes.values():
+        index["versions"] = [v for v in index["versions"][:-1] if v["time"] >= oldest] + index["versions"][-1:]
+
+    refs = {}
+    for index in indexes.values():
+        for version in index["versions"]:
+            if "object" in version:
+                refs[version["object"]] = refs.get(version["object"], 0) + 1
+    total = sum(objects[name].st_size for name in refs if name in objects)
+    if total > max_bytes:
+        by_age = sorted(((version, index) for index in indexes.values() for version in index["versions"]), key=lambda item: item[0]["time"])
+        for version, index in by_age:
+            if total <= max_bytes:
+                break
+            index["versions"].remove(version)
+            name = version.get("object")
+            if name:
+                refs[name] -= 1
+                if not refs[name]:
+                    del refs[name]
+                    total -= objects[name].st_size if name in objects else 0
+
+    dropped = 0
+    for index_file, index in indexes.items():
+        if len(index["versions"]) == before[index_file]:
+            continue
+        if index["versions"]:
+            _write_index(index_file, index)
+        else:
+            os.unlink(index_file)
+        dropped += before[index_file] - len(index["versions"])
+
+    freed = 0
+    now = time.time()
+    for name, st in objects.items():
+        if name in refs:
+            continue
+        # Objects no index knows yet may belong to a save in progress (a link's ctime is when it was made)
+        if name in referenced or now - st.st_ctime > ORPHAN_AGE:
+            try:
+                os.unlink(store / "objects" / name)
+                freed += st.st_size
+            except OSError:
+                pass
+    return dropped, freed
+
+
+def owner(path):
+    """The uid whose store has the backups of path: its owner, or that of the directory it would be in."""
+    path = os.path.abspath(os.path.expanduser(str(path)))
+    while not os.path.lexists(path) and path != os.path.dirname(path):
+        path = os.path.dirname(path)
+    return os.lstat(path).st_uid
+
+
+if __name__ == "__main__":
+    # Run as a store's owner for a parent of another user, prints the result as JSON
+    try:
+        if sys.argv[1] == "restore":
+            print(json.dumps(restore(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)))
+        elif sys.argv[1] == "prune":
+            print(json.dumps(prune(json.loads(sys.argv[2]))))
+    except (OSError, IndexError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
@@ -1,18 +1,25 @@
 import copy, yaml
+from utils import facts
 
 class ConditionalConfig:
     @staticmethod
     def parse(config, env):
         # print(yaml.dump(env, sort_keys=False))
+        # Facts are only computed when a condition asks for them, see utils/facts.py
+        if not isinstance(env, facts.Facts):
+            env = facts.Facts(env)
         return ConditionalConfig._prune(config, env)
     
     @staticmethod
-    def _prune(node, env):
+    def _prune(node, env, sudo=False):
+        # The input is never mutated, so a parsed config can be cached and reused.
+        # `sudo` is set for items of a do:/else: list whose parent has sudo: true.
+
         # Case 1: list -> rebuild list, flatten sublists
         if isinstance(node, list):
             new_list = []
             for item in node:
-                pruned = ConditionalConfig._prune(item, env)
+                pruned = ConditionalConfig._prune(item, env, sudo)
 
                 if pruned is None:
                     continue
@@ -27,24 +34,24 @@ class ConditionalConfig:
 
         # Case 2: dict -> evaluate when:, then handle do:, then recurse
         if isinstance(node, dict):
+            if sudo:
+                node = {**node, "sudo": True}
+
             # 1. Handle when:
             condition_fulfilled = True
             if "when" in node:
                 condition_fulfilled = ConditionalConfig._evaluate_condition(node["when"], env)
                 node = {k: v for k, v in node.items() if k != "when"}
 
-            if "sudo" in node and node["sudo"] == True:
-                for item in node.get("do", []) + node.get("else", []):
-                    if isinstance(item, dict):
-                        item["sudo"] = True
+            sudo_children = "sudo" in node and node["sudo"] == True
             # 2. If dict contains "do", flatten it by returning the list directly
             if condition_fulfilled and "do" in node:
 
-                pruned_do = ConditionalConfig._prune(node["do"], env)
+                pruned_do = ConditionalConfig._prune(node["do"], env, sudo_children)
                 return pruned_do  # may be list or None
 
             elif not condition_fulfilled and "else" in node:
-                pruned_else = ConditionalConfig._prune(node["else"], env)
+                pruned_else = ConditionalConfig._prune(node["else"], env, sudo_children)
                 return pruned_else  # may be list or None
             elif not condition_fulfilled:
                 return None
@@ -77,7 +84,10 @@ class ConditionalConfig:
                     else:
                         return False
                 elif key == "tag":
-                    if value not in env.get("tags", []):
+                    if not env.has_tag(value):
+                        return False
+                elif facts.is_param(key):
+                    if not env.get(f"{key}:{value}"):
                         return False
                 elif env.get(key) != value:
                     return False
@@ -0,0 +1,71 @@
+"""Run-wide cache counters.
+
+Modules count cache hits and misses in whatever process they run in. Workers
+send their counts back with each result, per-entry subprocesses write them to
+the file named by SYNCSMITH_COUNTERS_FILE (one per entry, in a directory only
+the run can list), and `run_modules` prints a summary.
+"""
+import json
+import os
+
+COUNTERS_FILE_ENV = "SYNCSMITH_COUNTERS_FILE"
+
+_counts = {}
+
+
+def hit(cache, n=1):
+    add(f"{cache}.hit", n)
+
+
+def miss(cache, n=1):
+    add(f"{cache}.miss", n)
+
+
+def add(name, n=1):
+    _counts[name] = _counts.get(name, 0) + n
+
+
+def take():
+    """Return the counts collected so far and start over."""
+    counts = dict(_counts)
+    _counts.clear()
+    return counts
+
+
+def merge(into, counts):
+    for name, n in counts.items():
+        into[name] = into.get(name, 0) + n
+    return into
+
+
+def dump():
+    """Append this process' counts to the counters file, if one is set."""
+    path = os.environ.get(COUNTERS_FILE_ENV)
+    counts = take()
+    if path and counts:
+        try:
+            with open(path, "a") as f:
+                f.write(json.dumps(counts) + "\n")
+        except OSError:
+            # Run as a user the run couldn't give the file to: only the counts are lost
+            pass
+
+
+def load(path):
+    counts = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    merge(counts, json.loads(line))
+    return counts
+
+
+def summary(counts):
+    """Return one line per cache, e.g. "sync state: 12 hits, 1 miss"."""
+    lines = []
+    for cache in sorted({name.rsplit(".", 1)[0] for name in counts}):
+        hits = counts.get(f"{cache}.hit", 0)
+        misses = counts.get(f"{cache}.miss", 0)
+        lines.append(f"{cache}: {hits} hit{'s' if hits != 1 else ''}, {misses} miss{'es' if misses != 1 else ''}")
+    return lines
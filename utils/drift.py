@@ -0,0 +1,95 @@
+"""Read-only drift scan for --check.
+
+Every entry of the plan is checked in this process with its module's `check`
+method, concurrently, without cleaning compiled_files/, spawning workers or
+fixing ownership. Symlinks, copies and their permissions are checked against
+what compiled_files/ held after the last run; systemd units with systemctl
+is-enabled/is-active; dconf values with a dump.
+
+An entry whose compiled output is also written by other entries (chained
+edits of one file) can't be checked on its own and is reported as unchecked,
+as are entries of modules without `check`.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import registry
+from utils.scheduler import Entry, resolve_paths
+from globals import COMPILED_FILES_DIR
+
+CHECK_JOBS = 16
+
+
+def _entries(config, home):
+    entries = []
+    instances = {}
+    seen = set()
+    for module_conf in config.get("modules", []):
+        name = module_conf["name"]
+        info = registry.get(name)
+        if info is None or not info["class"] or not module_conf.get("enabled", True):
+            continue
+        meta = info["metadata"]
+        if meta.get("single_instance", True) and name in seen:
+            continue
+        seen.add(name)
+        entry = Entry(len(entries), module_conf, info["class"], meta, None)
+        resolve_paths(entry, home)
+        entries.append(entry)
+        instances[entry.index] = registry.module_class(name)()
+    return entries, instances
+
+
+def _shared_outputs(entries):
+    """Entry index -> a compiled path it writes that other entries write too."""
+    writers = {}
+    for entry in entries:
+        for path in entry.writes:
+            if path.startswith(str(COMPILED_FILES_DIR) + os.sep):
+                writers.setdefault(path, []).append(entry.index)
+    return {index: path for path, indices in writers.items() if len(indices) > 1 for index in indices}
+
+
+def scan(config, home):
+    """Check every entry of config. Returns the report as a dict."""
+    start = time.perf_counter()
+    entries, instances = _entries(config, home)
+    shared = _shared_outputs(entries)
+
+    def check_one(entry):
+        if entry.index in shared:
+            return "unchecked", f"output {shared[entry.index]} is also written by other entries"
+        try:
+            drifts = instances[entry.index].check(entry.conf)
+        except Exception as e:
+            return "error", f"{type(e).__name__}: {e}"
+        if drifts is None:
+            return "unchecked", f"module '{entry.name}' can't be checked without applying"
+        return ("drifted", drifts) if drifts else ("in_sync", None)
+
+    with ThreadPoolExecutor(max_workers=CHECK_JOBS) as pool:
+        results = list(pool.map(check_one, entries))
+
+    report = {"checked": 0, "drifted": [], "unchecked": [], "errors": []}
+    for entry, (status, detail) in zip(entries, results):
+        item = {"index": entry.index, "entry": entry.label, "module": entry.name}
+        if status == "drifted":
+            report["drifted"].append(dict(item, drifts=detail))
+        elif status == "unchecked":
+            report["unchecked"].append(dict(item, reason=detail))
+        elif status == "error":
+            report["errors"].append(dict(item, error=detail))
+        if status in ("drifted", "in_sync"):
+            report["checked"] += 1
+    report["in_sync"] = not report["drifted"] and not report["errors"]
+    report["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return report
+
+
+def exit_status(report):
+    """0 if everything checked is in sync, 1 on drift, 2 if some entries couldn't be checked for errors."""
+    if report["drifted"]:
+        return 1
+    if report["errors"]:
+        return 2
+    return 0
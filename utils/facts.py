@@ -0,0 +1,245 @@
+"""Facts about the host for `when:` conditions.
+
+Every fact is a function registered with `@fact`, computed the first time a
+condition asks for it and then memoized for the run. Facts registered with a
+`ttl` are also kept in state/facts.json for that many seconds, for facts that
+are slow to find out (like the virtualization). Adding a fact is adding a
+function here:
+
+    @fact("gpu_vendor", ttl=24 * 3600)
+    def _gpu_vendor():
+        ...
+
+and using it in config.yaml with `when: {gpu_vendor: nvidia}`.
+
+Values in environment.yaml (and --env) take precedence over computed facts.
+Facts registered with `tag=True` also count as tags (`when: {tag: laptop}`)
+while true, and parametrized facts are asked with their argument:
+`when: {command: flatpak}` is true if flatpak is installed.
+
+In a --root run facts are about the root: the OS comes from its os-release and
+commands are looked up in its bin directories. Facts registered with
+`host_only=True` (the hardware, the session) can't be found out from a
+directory and raise FactError unless given with `--root DIR:key=value`.
+"""
+import json
+import os
+import time
+from functools import lru_cache
+
+from utils import target_root
+from utils.system_info import get_os_release
+from globals import ROOT_DIR, STATE_DIR, TARGET_ROOT
+
+CACHE_FILE = STATE_DIR / "facts.json"
+
+_registry = {}
+
+
+# Where `command:` looks in a target root, whose PATH we don't know
+ROOT_BIN_DIRS = ["/usr/local/sbin", "/usr/local/bin", "/usr/sbin", "/usr/bin", "/sbin", "/bin"]
+
+
+class FactError(Exception):
+    pass
+
+
+class _Fact:
+    def __init__(self, name, fn, ttl=None, tag=False, param=False, host_only=False):
+        self.name = name
+        self.fn = fn
+        self.ttl = ttl
+        self.tag = tag
+        self.param = param
+        self.host_only = host_only
+
+
+def fact(name, ttl=None, tag=False, param=False, host_only=False):
+    """Register the decorated function as the fact `name`."""
+    def register(fn):
+        _registry[name] = _Fact(name, fn, ttl, tag, param, host_only)
+        return fn
+    return register
+
+
+def names():
+    return list(_registry)
+
+
+def is_param(name):
+    return name in _registry and _registry[name].param
+
+
+class Facts:
+    """The environment for conditions: environment.yaml values, then facts computed on demand.
+
+    `used` maps every computed fact that was asked for (`command:git` for
+    parametrized ones) to its value, so a cached plan can be checked against them.
+    """
+
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+        self.used = {}
+        self._disk = None
+
+    def get(self, name, default=None):
+        if name in self.values:
+            return self.values[name]
+        if name in self.used:
+            return self.used[name]
+        base, _, arg = name.partition(":")
+        registered = _registry.get(base)
+        if registered is None or registered.param != bool(arg):
+            return default
+        self.used[name] = value = self._compute(registered, name, arg)
+        return value
+
+    def has_tag(self, tag):
+        if tag in (self.values.get("tags") or []):
+            return True
+        registered = _registry.get(tag)
+        return bool(registered and registered.tag and self.get(tag))
+
+    def _compute(self, registered, name, arg):
+        if TARGET_ROOT and registered.host_only:
+            raise FactError(f"The '{name}' fact is about the machine syncsmith runs on, not {TARGET_ROOT}: "
+                            f"give it with --root {TARGET_ROOT}:{name}=VALUE")
+        if registered.ttl is None:
+            return registered.fn(arg) if registered.param else registered.fn()
+
+        disk = self._load_disk()
+        cached = disk.get(name)
+        if cached and time.time() - cached[1] < registered.ttl:
+            return cached[0]
+        value = registered.fn(arg) if registered.param else registered.fn()
+        disk[name] = [value, time.time()]
+        self._save_disk(disk)
+        return value
+
+    def _load_disk(self):
+        if self._disk is None:
+            try:
+                with open(CACHE_FILE) as f:
+                    self._disk = json.load(f)
+            except (OSError, ValueError):
+                self._disk = {}
+        return self._disk
+
+    def _save_disk(self, disk):
+        try:
+            STATE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp_path = f"{CACHE_FILE}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(disk, f)
+            os.replace(tmp_path, CACHE_FILE)
+        except OSError:
+            pass
+
+
+@lru_cache(maxsize=None)
+def _os_release():
+    """os-release of this system, or of the target root."""
+    for path in ("/etc/os-release", "/usr/lib/os-release"):
+        try:
+            return get_os_release(target_root.path(path, follow=True))
+        except OSError:
+            continue
+    return {}
+
+
+@fact("host")
+def _host():
+    if TARGET_ROOT:
+        try:
+            with open(target_root.path("/etc/hostname", follow=True)) as f:
+                return f.read().strip() or "unknown"
+        except OSError:
+            return "unknown"
+    return os.uname().nodename
+
+
+@fact("os")
+def _os():
+    return _os_release().get("ID", "unknown")
+
+
+@fact("os_pretty")
+def _os_pretty():
+    return _os_release().get("PRETTY_NAME", "Unknown")
+
+
+@fact("os_version")
+def _os_version():
+    return _os_release().get("VERSION_ID", "unknown")
+
+
+@fact("desktop_environment", host_only=True)
+def _desktop_environment():
+    return os.environ.get("DESKTOP_SESSION", "unknown").strip().lower()
+
+
+@fact("install_dir")
+def _install_dir():
+    return str(ROOT_DIR)
+
+
+@fact("user")
+def _user():
+    return os.environ.get("USER", "unknown")
+
+
+@fact("arch", host_only=True)
+def _arch():
+    return os.uname().machine
+
+
+@fact("laptop", tag=True, host_only=True)
+def _laptop():
+    import glob
+    return bool(glob.glob("/sys/class/power_supply/BAT*"))
+
+
+@fact("proxmox", tag=True)
+def _proxmox():
+    return os.path.isdir(target_root.path("/etc/pve", follow=True))
+
+
+@fact("cpu_count", host_only=True)
+def _cpu_count():
+    return os.cpu_count()
+
+
+@fact("memory_gb", host_only=True)
+def _memory_gb():
+    """Total memory in GiB, rounded."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return round(int(line.split()[1]) / (1024 * 1024))
+    except OSError:
+        pass
+    return None
+
+
+@fact("virtualization", ttl=24 * 3600, host_only=True)
+def _virtualization():
+    """What systemd-detect-virt says ("none" on bare metal), or "vm" if only the CPU tells."""
+    import shutil
+    import subprocess
+    if shutil.which("systemd-detect-virt"):
+        proc = subprocess.run(["systemd-detect-virt"], capture_output=True, text=True)
+        return proc.stdout.strip() or "none"
+    try:
+        with open("/proc/cpuinfo") as f:
+            return "vm" if " hypervisor" in f.read() else "none"
+    except OSError:
+        return "unknown"
+
+
+@fact("command", param=True)
+def _command(name):
+    import shutil
+    if TARGET_ROOT:
+        return any(os.access(target_root.path(os.path.join(directory, name), follow=True), os.X_OK) for directory in ROOT_BIN_DIRS)
+    return shutil.which(name) is not None
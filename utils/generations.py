@@ -0,0 +1,179 @@
+"""Generations of compiled_files.
+
+compiled_files/ is a symlink to the generation the run builds: every run starts
+a new, empty `compiled_generations/gen-NNNNNN` (with only what must carry over
+copied in, see `begin`) and points compiled_files/ at it, so modules write
+their outputs straight into the new generation and nothing that is linked to
+is ever cleared or rewritten in place. What symlinks point at is
+`compiled_generations/current/...`: after a successful run the generation
+becomes current with one rename of the pointer, so a link into it never
+dangles and never sees a half-built tree. Files the current generation doesn't
+have yet (before the first successful run) are linked through compiled_files/.
+
+On commit the files of a generation become hardlinks into a content-addressed
+blob store, keyed by sha256 and mode: an output with the same content as last
+run ends up as the very same inode (same mtime), a new one is linked into the
+store, not copied. Files are only hashed when their fingerprint moved since the
+last commit.
+"""
+import json
+import os
+import shutil
+import stat
+from modules.__filesync_copy import _temp_name, copy_file, replace_with_link, replace_with_symlink
+from modules.__filesync_state import _fingerprint, file_digest
+from utils import counters, tracing
+from globals import COMPILED_FILES_DIR, GENERATIONS_DIR
+
+CURRENT_DIR = GENERATIONS_DIR / "current"
+BLOB_DIR = GENERATIONS_DIR / "blobs"
+INDEX_FILE = GENERATIONS_DIR / "index.json"
+# Generations kept, including the current one
+KEEP_GENERATIONS = 3
+CACHE_NAME = "compiled blobs"
+
+
+def current_path(path):
+    """The path through the `current` pointer for a path below compiled_files/ that the current
+    generation has, other paths as is."""
+    relative = os.path.relpath(path, COMPILED_FILES_DIR)
+    if relative == "." or relative.startswith(".." + os.sep) or relative == "..":
+        return path
+    current = os.path.join(CURRENT_DIR, relative)
+    return current if os.path.exists(current) else path
+
+
+def _generations():
+    names = [name for name in os.listdir(GENERATIONS_DIR) if name.startswith("gen-")] if GENERATIONS_DIR.exists() else []
+    return sorted(names)
+
+
+def _load_index():
+    try:
+        with open(INDEX_FILE) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    return index.get("files", {}), index.get("blobs", {})
+
+
+def _save_index(files, blobs):
+    tmp_path = f"{INDEX_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": 1, "files": files, "blobs": blobs}, f)
+    os.replace(tmp_path, INDEX_FILE)
+
+
+def _chown(path, owner):
+    if owner is not None:
+        os.lchown(path, *owner)
+
+
+def begin(keep=None, owner=None):
+    """Start the generation this run builds and point compiled_files/ at it. What the last
+    build holds is copied over: everything with keep=None, otherwise only the top-level
+    entries named in keep. A last build that never became current is removed."""
+    GENERATIONS_DIR.mkdir(parents=True, exist_ok=True)
+    _chown(GENERATIONS_DIR, owner)
+    previous = os.path.realpath(COMPILED_FILES_DIR) if os.path.isdir(COMPILED_FILES_DIR) else None
+    generations = _generations()
+    number = int(generations[-1][4:]) + 1 if generations else 1
+    name = f"gen-{number:06d}"
+    build = GENERATIONS_DIR / name
+    build.mkdir()
+    _chown(build, owner)
+
+    with tracing.span("carry over compiled_files", cat="phase", generation=name):
+        for entry in os.scandir(previous) if previous else []:
+            if keep is not None and entry.name not in keep:
+                continue
+            # Copies, not links: these are written again in place, the blobs must not be
+            if entry.is_dir(follow_symlinks=False):
+                shutil.copytree(entry.path, build / entry.name, symlinks=True, copy_function=copy_file)
+            elif entry.is_symlink():
+                os.symlink(os.readlink(entry.path), build / entry.name)
+            else:
+                copy_file(entry.path, build / entry.name)
+
+    if os.path.isdir(COMPILED_FILES_DIR) and not os.path.islink(COMPILED_FILES_DIR):
+        # A compiled_files/ from before generations
+        shutil.rmtree(COMPILED_FILES_DIR)
+    replace_with_symlink(os.path.relpath(build, COMPILED_FILES_DIR.parent), str(COMPILED_FILES_DIR))
+    _chown(COMPILED_FILES_DIR, owner)
+    if previous and os.path.dirname(previous) == os.path.realpath(GENERATIONS_DIR) and previous != os.path.realpath(CURRENT_DIR):
+        shutil.rmtree(previous, ignore_errors=True)
+    return name
+
+
+def _store(path, relative, st, files, blobs, seen, owner):
+    """Make the file at path a hardlink of the blob with its contents, or the blob itself if
+    there is none yet."""
+    fingerprint = _fingerprint(st)
+    record = files.get(relative)
+    digest = record[4] if record and record[:4] == fingerprint else file_digest(path)
+    name = f"{digest}-{stat.S_IMODE(st.st_mode):o}"
+    blob_path = os.path.join(BLOB_DIR, name)
+    try:
+        intact = blobs.get(name) == _fingerprint(os.lstat(blob_path))
+    except FileNotFoundError:
+        intact = False
+    if intact:
+        counters.hit(CACHE_NAME)
+        replace_with_link(blob_path, path)
+    else:
+        counters.miss(CACHE_NAME)
+        tmp_path = _temp_name(blob_path)
+        try:
+            os.link(path, tmp_path)
+            os.replace(tmp_path, blob_path)
+        except OSError:
+            # protected_hardlinks, or no hardlinks at all: the blob is a copy
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+            copy_file(path, blob_path)
+            _chown(blob_path, owner)
+        blobs[name] = _fingerprint(os.lstat(blob_path))
+    seen[relative] = _fingerprint(os.lstat(path)) + [digest]
+
+
+def commit(owner=None):
+    """Store the files of the generation compiled_files/ points at as blobs, make it current
+    and collect old generations. `owner` is a (uid, gid) pair for everything created, like
+    compiled_files/ gets chowned."""
+    build = os.path.realpath(COMPILED_FILES_DIR)
+    name = os.path.basename(build)
+    BLOB_DIR.mkdir(parents=True, exist_ok=True)
+    _chown(GENERATIONS_DIR, owner)
+    _chown(BLOB_DIR, owner)
+
+    files, blobs = _load_index()
+    seen = {}
+    with tracing.span("store compiled files", cat="phase", generation=name):
+        # Linked directories are not descended into, they stay links
+        for directory, dirnames, filenames in os.walk(build):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode):
+                    _store(path, os.path.relpath(path, build), st, files, blobs, seen, owner)
+
+    # The switch: a new symlink renamed over the old one
+    replace_with_symlink(name, str(CURRENT_DIR))
+    _chown(CURRENT_DIR, owner)
+
+    with tracing.span("collect generations", cat="phase"):
+        for old in _generations()[:-KEEP_GENERATIONS]:
+            shutil.rmtree(GENERATIONS_DIR / old)
+        # Blobs no generation links to any more
+        for blob_name in list(blobs):
+            blob_path = BLOB_DIR / blob_name
+            try:
+                if os.lstat(blob_path).st_nlink > 1:
+                    continue
+                blob_path.unlink()
+            except FileNotFoundError:
+                pass
+            del blobs[blob_name]
+    _save_index(seen, blobs)
+    _chown(INDEX_FILE, owner)
+    return name
@@ -0,0 +1,42 @@
+"""Read git refs straight from the repository files, without running git."""
+import os
+
+
+def git_dir(work_tree):
+    """The git directory of a work tree, following `.git` files of worktrees and submodules."""
+    path = os.path.join(work_tree, ".git")
+    if os.path.isfile(path):
+        with open(path) as f:
+            content = f.read().strip()
+        if content.startswith("gitdir: "):
+            return os.path.join(work_tree, content[8:])
+    return path
+
+
+def read_ref(git_directory, ref):
+    """The commit a ref (e.g. "refs/heads/main") points to, or None."""
+    try:
+        with open(os.path.join(git_directory, ref)) as f:
+            return f.read().strip()
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(git_directory, "packed-refs")) as f:
+            for line in f:
+                if line.rstrip().endswith(" " + ref):
+                    return line.split(" ", 1)[0]
+    except OSError:
+        pass
+    return None
+
+
+def read_head(git_directory):
+    """The commit HEAD points to, or None (e.g. no repository, or no commits yet)."""
+    try:
+        with open(os.path.join(git_directory, "HEAD")) as f:
+            head = f.read().strip()
+    except OSError:
+        return None
+    if not head.startswith("ref: "):
+        return head
+    return read_ref(git_directory, head[5:])
@@ -0,0 +1,354 @@
+"""Change journal, for --rollback and --resume.
+
+Every run that changes anything appends one JSON line per operation to
+state/journal/<run>.jsonl: written or replaced files, created directories,
+directories moved to the backup store, chmod/chown, dconf keys and systemd units. Each line is written and fsync'd
+before the change is made, with what is needed to undo it: the previous file
+(hardlinked into <run>.files/, which is safe since files are only ever replaced
+by rename), mode, owner, dconf value or unit state.
+
+`--rollback [RUN]` undoes exactly those operations in reverse order, without
+looking at the config again; every operation is undone as the user that made
+it, through sudo if that is not the one rolling back. Completed entries are
+journaled too, so a run that was interrupted (or failed) can be continued with
+--resume.
+
+The journal and <run>.files/ belong to the user running syncsmith and nobody
+else may write them; rollback refuses a journal that belongs to anyone but the
+invoking user or root. Modules in workers and sudo subprocesses find the
+journal through SYNCSMITH_JOURNAL. Those running as root append to it, others
+pass their records to the parent, which appends them with their uid: workers
+as they are made, over the worker protocol, and per-entry subprocesses through
+their own file (SYNCSMITH_JOURNAL_RECORDS). They save files into
+<run>.files/<uid>/. Without a journal (dry runs, --check) nothing is recorded.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from modules.__filesync_copy import backup
+from utils import backups
+from globals import ROOT_DIR, COMPILED_FILES_DIR, GENERATIONS_DIR, STATE_DIR
+
+JOURNAL_ENV = "SYNCSMITH_JOURNAL"
+RECORDS_FILE_ENV = "SYNCSMITH_JOURNAL_RECORDS"
+JOURNAL_DIR = STATE_DIR / "journal"
+KEEP_JOURNALS = 10
+
+# syncsmith's own trees are rebuilt by every run and not journaled
+_INTERNAL = [str(COMPILED_FILES_DIR) + os.sep, str(GENERATIONS_DIR) + os.sep, str(STATE_DIR) + os.sep]
+
+
+# Set in workers: passes records this process may not append itself to the parent
+_relay = None
+
+
+def current():
+    return os.environ.get(JOURNAL_ENV)
+
+
+def relay_to(send):
+    global _relay
+    _relay = send
+
+
+def _append(journal_path, fields):
+    line = (json.dumps(fields) + "\n").encode()
+    fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def record(op, **fields):
+    journal_path = current()
+    if not journal_path:
+        return
+    fields = dict(fields, op=op, uid=os.getuid(), time=time.time())
+    try:
+        _append(journal_path, fields)
+    except PermissionError:
+        if _relay:
+            _relay(fields)
+        elif os.environ.get(RECORDS_FILE_ENV):
+            _append(os.environ[RECORDS_FILE_ENV], fields)
+        else:
+            raise
+
+
+def add_relayed(fields, uid):
+    """Append a record passed on by a process of `uid` that could not append it itself."""
+    # Such a process only has a say about undoable operations, to be undone as itself
+    if fields.get("op") in UNDOABLE:
+        _append(current(), dict(fields, uid=uid))
+
+
+def load_relayed(path, uid):
+    """add_relayed the records a per-entry subprocess of `uid` left in its records file."""
+    with open(path) as f:
+        for line in f:
+            try:
+                add_relayed(json.loads(line), uid)
+            except ValueError:
+                break
+
+
+def _internal(path):
+    return any(str(path).startswith(prefix) for prefix in _INTERNAL)
+
+
+def _files_dir(journal_path):
+    return journal_path[:-len(".jsonl")] + ".files"
+
+
+def _save(path):
+    """Keep what is at path for undoing, returns where."""
+    files_dir = _files_dir(current())
+    own = os.path.join(files_dir, str(os.getuid()))
+    saved = os.path.join(own if os.path.isdir(own) else files_dir, os.urandom(16).hex())
+    backup(path, saved)
+    return saved
+
+
+def before_write(path):
+    """Record that the file at path is about to be created or replaced."""
+    path = str(path)
+    if not current() or _internal(path):
+        return
+    saved = None
+    if os.path.lexists(path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            # Directories in the way go to the backup store, and come back from there
+            record("remove_tree", path=path)
+            return
+        saved = _save(path)
+    record("write", path=path, saved=saved)
+
+
+def before_makedirs(path):
+    """Record the directories os.makedirs(path) is about to create, outermost first."""
+    path = str(path)
+    if not current() or _internal(path + os.sep):
+        return
+    missing = []
+    while path and not os.path.lexists(path):
+        missing.append(path)
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    for directory in reversed(missing):
+        record("mkdir", path=directory)
+
+
+def before_metadata(path, st, mode=False, owner=False):
+    """Record that the mode and/or owner of path (with stat result st) are about to change."""
+    if not current() or _internal(path):
+        return
+    if mode:
+        record("chmod", path=str(path), mode=st.st_mode & 0o7777)
+    if owner:
+        record("chown", path=str(path), uid_was=st.st_uid, gid_was=st.st_gid)
+
+
+def plan_hash(plan):
+    return hashlib.sha256(json.dumps(plan, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _new_run_id():
+    return time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+
+
+def start(plan_hash, argv):
+    """Start the journal of a new run; modules started from now on record into it."""
+    JOURNAL_DIR.mkdir(parents=True, exist_ok=True)
+    run_id = _new_run_id()
+    journal_path = str(JOURNAL_DIR / f"{run_id}.jsonl")
+    fd = os.open(journal_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    os.fchmod(fd, 0o600)
+    os.close(fd)
+    os.mkdir(_files_dir(journal_path), 0o700)
+    os.chmod(_files_dir(journal_path), 0o700)
+    os.environ[JOURNAL_ENV] = journal_path
+    record("begin", run=run_id, plan=plan_hash, argv=argv)
+    _prune()
+    return run_id
+
+
+def allow(uid):
+    """Give processes of uid a directory of their own in <run>.files/ for the files they save.
+    Only needed (and possible) when running as root."""
+    files_dir = _files_dir(current())
+    own = os.path.join(files_dir, str(uid))
+    if os.getuid() != 0 or uid == 0 or os.path.isdir(own):
+        return
+    os.mkdir(own, 0o700)
+    os.chown(own, uid, -1)
+    # Let them reach it, without listing the others
+    os.chmod(files_dir, 0o711)
+
+
+def resume(run_id):
+    os.environ[JOURNAL_ENV] = str(JOURNAL_DIR / f"{run_id}.jsonl")
+    record("resume")
+
+
+def entry_done(index, label):
+    record("entry", index=index, label=label)
+
+
+def finish(ok):
+    record("end", ok=ok)
+    os.environ.pop(JOURNAL_ENV, None)
+
+
+def _runs():
+    if not JOURNAL_DIR.exists():
+        return []
+    return sorted(name[:-len(".jsonl")] for name in os.listdir(JOURNAL_DIR) if name.endswith(".jsonl"))
+
+
+def _prune():
+    for run_id in _runs()[:-KEEP_JOURNALS]:
+        (JOURNAL_DIR / f"{run_id}.jsonl").unlink()
+        shutil.rmtree(JOURNAL_DIR / f"{run_id}.files", ignore_errors=True)
+
+
+def _check_owner(path):
+    """Raise PermissionError unless path belongs to us or root and nobody else may write it."""
+    st = os.lstat(path)
+    if st.st_uid not in (os.getuid(), 0) or st.st_mode & 0o022:
+        raise PermissionError(f"{path} may have been written by another user (owner {st.st_uid}, "
+                              f"mode {st.st_mode & 0o7777:o}), refusing to use it")
+
+
+def load(run_id=None):
+    """(run id, records) of a run, the last one if run_id is None. Raises FileNotFoundError,
+    or PermissionError for a journal another user could have written."""
+    runs = _runs()
+    if run_id is None:
+        if not runs:
+            raise FileNotFoundError("No journaled runs")
+        run_id = runs[-1]
+    elif run_id not in runs:
+        raise FileNotFoundError(f"No journal for run '{run_id}' (known: {', '.join(runs) or 'none'})")
+    journal_path = str(JOURNAL_DIR / f"{run_id}.jsonl")
+    _check_owner(journal_path)
+    if os.path.lexists(_files_dir(journal_path)):
+        _check_owner(_files_dir(journal_path))
+    records = []
+    with open(JOURNAL_DIR / f"{run_id}.jsonl") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A line cut short by a crash: nothing after it was done either
+                break
+    return run_id, records
+
+
+def resumable(records):
+    """Indices of the completed entries if the run can be resumed, otherwise None."""
+    if any(r["op"] == "rolled_back" for r in records):
+        return None
+    ends = [r for r in records if r["op"] in ("end", "resume")]
+    if ends and ends[-1]["op"] == "end" and ends[-1]["ok"]:
+        return None
+    return {r["index"] for r in records if r["op"] == "entry"}
+
+
+def undo(op):
+    """Undo one journaled operation."""
+    import subprocess
+    kind = op["op"]
+    path = op.get("path")
+    if kind == "write":
+        if op["saved"]:
+            backup(op["saved"], path)
+        elif os.path.lexists(path) and not os.path.isdir(path):
+            os.unlink(path)
+    elif kind == "mkdir":
+        try:
+            os.rmdir(path)
+        except OSError:
+            # Not empty: something else lives there now
+            pass
+    elif kind == "create_dir":
+        shutil.rmtree(path, ignore_errors=True)
+    elif kind == "remove_tree":
+        saved = backups.versions(path)
+        number = next((number for number, version in enumerate(saved, 1)
+                       if version["kind"] == "tree" and version["time"] >= op["time"]), None)
+        if number is None:
+            raise FileNotFoundError(f"The backup store no longer has {path} as of this run (dropped by retention?)")
+        backups.restore(path, number)
+    elif kind == "chmod":
+        os.chmod(path, op["mode"])
+    elif kind == "chown":
+        os.chown(path, op["uid_was"], op["gid_was"])
+    elif kind == "dconf":
+        from modules.__dconf_merge import format_keyfile
+        values = {key: value for key, value in op["values"].items() if value is not None}
+        if values:
+            subprocess.run(["dconf", "load", "/"], input=format_keyfile(values), text=True, check=True)
+        for key, value in op["values"].items():
+            if value is None:
+                subprocess.run(["dconf", "reset", key], check=True)
+    elif kind == "systemctl":
+        subprocess.run(["systemctl"] + op["args"], check=True)
+
+
+UNDOABLE = {"write", "mkdir", "create_dir", "remove_tree", "chmod", "chown", "dconf", "systemctl"}
+
+
+def describe(op):
+    if op["op"] == "write":
+        return f"restore {op['path']}" if op["saved"] else f"remove {op['path']}"
+    if op["op"] in ("mkdir", "create_dir"):
+        return f"remove directory {op['path']}"
+    if op["op"] == "remove_tree":
+        return f"restore directory {op['path']} from the backup store"
+    if op["op"] == "chmod":
+        return f"chmod {op['mode']:o} {op['path']}"
+    if op["op"] == "chown":
+        return f"chown {op['uid_was']}:{op['gid_was']} {op['path']}"
+    if op["op"] == "dconf":
+        return f"restore {len(op['values'])} dconf key(s)"
+    return f"systemctl {' '.join(op['args'])}"
+
+
+def rollback(run_id=None, dry_run=False):
+    """Undo the journaled operations of a run (the last one by default) in reverse order.
+    Returns the number of operations that could not be undone."""
+    import subprocess
+    run_id, records = load(run_id)
+    if any(r["op"] == "rolled_back" for r in records):
+        print(f"Run {run_id} was already rolled back.")
+        return 0
+    ops = [r for r in records if r["op"] in UNDOABLE]
+    failed = 0
+    for op in reversed(ops):
+        print(("[DRY RUN] Would " if dry_run else "") + describe(op))
+        if dry_run:
+            continue
+        try:
+            # As the user that made the change, also when rolling back as root
+            if op["uid"] != os.getuid():
+                subprocess.run(["sudo", "-u", f"#{op['uid']}", "-E", sys.executable, "-m", "utils.journal", json.dumps(op)], cwd=ROOT_DIR, check=True)
+            else:
+                undo(op)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"[ERROR] Could not {describe(op)}: {e}")
+            failed += 1
+    if not dry_run:
+        _append(str(JOURNAL_DIR / f"{run_id}.jsonl"), {"op": "rolled_back", "uid": os.getuid(), "time": time.time(), "failed": failed})
+    print(f"Rolled back {len(ops) - failed} of {len(ops)} operation(s) of run {run_id}.")
+    return failed
+
+
+if __name__ == "__main__":
+    undo(json.loads(sys.argv[1]))
@@ -0,0 +1,333 @@
+"""Long-lived module worker.
+
+`run_modules` starts one worker per effective user (the real user and root),
+shared by all jobs, and sends it module entries over stdin, one JSON object per line. The worker
+applies each entry in-process and answers on its original stdout:
+
+    {"type": "ready", "pid": 1234}
+    {"id": 3, "type": "output", "data": "Copying from ..."}
+    {"id": 3, "type": "result", "ok": true, "error": null, "counters": {}, "trace": []}
+
+A request {"id": 4, "type": "end"} runs the work modules deferred to the end
+of the run (see `at_end_of_run`) and is answered the same way, and
+{"id": 5, "type": "prune_backups", "retention": {...}} applies the backup
+retention policy to the worker user's store, with "pruned": [versions, bytes]
+in the result.
+
+A worker that may not append to the run's journal itself (one of another user
+than the parent's, see utils.journal) sends each record before making the
+change, and waits until the parent has appended it:
+
+    {"id": 3, "type": "journal", "record": {"op": "write", ...}}
+    {"type": "journaled"}                       (parent to worker)
+
+Everything an entry prints, including the output of commands it spawns, is
+forwarded as "output" messages so the parent can stream it.
+"""
+import codecs
+import importlib
+import json
+import os
+import pwd
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from modules.__syncsmith_module import end_of_run
+from utils import counters, journal, tracing
+
+_MARKER_PREFIX = b"\0syncsmith-end-"
+
+
+class WorkerError(Exception):
+    pass
+
+
+def worker_command(root_dir):
+    return ["python3", "-c", f"import sys; sys.path.insert(0, '{root_dir}'); from utils.module_worker import serve; serve()"]
+
+
+class ModuleWorker:
+    """Parent-side handle for a worker process."""
+
+    def __init__(self, user, cmd, env):
+        self.user = user
+        self.uid = pwd.getpwnam(user).pw_uid
+        self.proc = subprocess.Popen(cmd, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+        self._next_id = 0
+
+        ready = self._read_message()
+        if ready is None or ready.get("type") != "ready":
+            self.close()
+            raise WorkerError(f"Worker for user '{user}' failed to start")
+
+    def _read_message(self):
+        line = self.proc.stdout.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+    def run(self, module_name, class_name, config, dry_run=False, on_output=None):
+        """Apply one entry and return the worker's result message."""
+        return self._request({"module": module_name, "class": class_name, "config": config, "dry_run": dry_run}, on_output)
+
+    def end_of_run(self, on_output=None):
+        """Run the work deferred to the end of the run and return the result message."""
+        return self._request({"type": "end"}, on_output)
+
+    def prune_backups(self, retention, on_output=None):
+        """Prune this user's backup store (see utils.backups.prune) and return the result message."""
+        return self._request({"type": "prune_backups", "retention": retention}, on_output)
+
+    def _request(self, request, on_output):
+        self._next_id += 1
+        request["id"] = self._next_id
+        try:
+            self.proc.stdin.write(json.dumps(request, default=str) + "\n")
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            raise WorkerError(f"Worker for user '{self.user}' is not running")
+
+        while True:
+            message = self._read_message()
+            if message is None:
+                raise WorkerError(f"Worker for user '{self.user}' exited unexpectedly")
+            if message.get("type") == "output":
+                if on_output:
+                    on_output(message["data"])
+            elif message.get("type") == "journal":
+                journal.add_relayed(message["record"], self.uid)
+                self.proc.stdin.write(json.dumps({"type": "journaled"}) + "\n")
+                self.proc.stdin.flush()
+            elif message.get("type") == "result" and message.get("id") == self._next_id:
+                return message
+
+    def close(self):
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+
+class WorkerPool:
+    """Hands out workers per user, starting at most `size` of them for each.
+
+    Workers are started in the background, one at a time per user, while
+    entries of that user wait for one: an entry takes whichever is ready
+    first, the new worker or a busy one that finishes. Besides the first, a
+    worker is only started once every busy one has spent as long on its
+    current entry as starting the first worker took: short entries keep
+    sharing the workers there are, slow ones (downloads, clones) overlap.
+
+    `start(user)` creates a worker. If that fails for a user the error is
+    raised once, and once none of that user's workers is left `acquire`
+    returns None for it.
+    """
+
+    def __init__(self, start, size=1):
+        self.start = start
+        self.size = size
+        self.workers = []
+        self.idle = {}
+        self.started = {}
+        self.starting = set()
+        self.unavailable = set()
+        self.errors = {}
+        self.start_cost = {}
+        self.busy = {}
+        self.cond = threading.Condition()
+
+    def acquire(self, user):
+        with self.cond:
+            while True:
+                if user in self.errors:
+                    raise self.errors.pop(user)
+                if self.idle.get(user):
+                    worker = self.idle[user].pop()
+                    self.busy[worker] = time.monotonic()
+                    return worker
+                timeout = None
+                if user in self.unavailable:
+                    if not self.started.get(user, 0):
+                        return None
+                elif user not in self.starting and self.started.get(user, 0) < self.size:
+                    busy_since = [since for worker, since in self.busy.items() if worker.user == user]
+                    timeout = max(busy_since, default=0) + self.start_cost.get(user, 0) - time.monotonic()
+                    if timeout <= 0:
+                        timeout = None
+                        self.started[user] = self.started.get(user, 0) + 1
+                        self.starting.add(user)
+                        threading.Thread(target=self._start, args=(user,), daemon=True).start()
+                self.cond.wait(timeout)
+
+    def _start(self, user):
+        started = time.monotonic()
+        try:
+            worker = self.start(user)
+        except (OSError, WorkerError) as e:
+            with self.cond:
+                self.starting.discard(user)
+                self.started[user] -= 1
+                # Entries go on with the workers there are, or without one if there are none
+                self.unavailable.add(user)
+                if not self.started[user]:
+                    self.errors[user] = e
+                self.cond.notify_all()
+            return
+        with self.cond:
+            self.start_cost.setdefault(user, time.monotonic() - started)
+            self.starting.discard(user)
+            self.workers.append(worker)
+            self.idle.setdefault(user, []).append(worker)
+            self.cond.notify_all()
+
+    def release(self, worker, broken=False):
+        with self.cond:
+            self.busy.pop(worker, None)
+            if broken:
+                self.started[worker.user] -= 1
+                worker.close()
+            else:
+                self.idle.setdefault(worker.user, []).append(worker)
+            self.cond.notify_all()
+
+    def end_of_run(self, on_output=None):
+        """Have every worker run its deferred work, returns the result messages."""
+        results = []
+        for workers in self.idle.values():
+            for worker in workers:
+                try:
+                    results.append(worker.end_of_run(on_output))
+                except WorkerError as e:
+                    results.append({"ok": False, "error": str(e)})
+        return results
+
+    def close(self):
+        with self.cond:
+            while self.starting:
+                self.cond.wait()
+        for worker in self.workers:
+            worker.close()
+        self.workers.clear()
+        self.idle.clear()
+
+
+class _OutputForwarder(threading.Thread):
+    """Reads the worker's redirected stdout/stderr and forwards it as messages."""
+
+    def __init__(self, fd, send):
+        super().__init__(daemon=True)
+        self.fd = fd
+        self.send = send
+        self.request_id = None
+        self.drained = threading.Event()
+
+    def run(self):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pending = b""
+        while True:
+            chunk = os.read(self.fd, 65536)
+            if not chunk:
+                break
+            pending += chunk
+            while True:
+                pos = pending.find(_MARKER_PREFIX)
+                if pos == -1:
+                    # Hold back a possible partial marker at the end of the buffer
+                    keep = 0
+                    for n in range(min(len(pending), len(_MARKER_PREFIX) - 1), 0, -1):
+                        if _MARKER_PREFIX.startswith(pending[-n:]):
+                            keep = n
+                            break
+                    self._forward(decoder.decode(pending[:len(pending) - keep]))
+                    pending = pending[len(pending) - keep:]
+                    break
+                end = pending.find(b"\0", pos + len(_MARKER_PREFIX))
+                if end == -1:
+                    self._forward(decoder.decode(pending[:pos]))
+                    pending = pending[pos:]
+                    break
+                self._forward(decoder.decode(pending[:pos]) + decoder.decode(b"", final=True))
+                pending = pending[end + 1:]
+                self.drained.set()
+
+    def _forward(self, text):
+        if text:
+            self.send({"id": self.request_id, "type": "output", "data": text})
+
+
+def _apply(request):
+    with tracing.span(request["module"], cat="entry"):
+        module = importlib.import_module(f"modules.{request['module']}")
+        cls = getattr(module, request["class"])
+        cls().apply(request["config"], dry_run=request.get("dry_run", False))
+
+
+def serve():
+    # Keep the original stdin/stdout for the protocol and point fds 0-2 elsewhere,
+    # so modules and the commands they spawn cannot read or corrupt it.
+    proto_in = os.fdopen(os.dup(0), "r")
+    proto_out = os.fdopen(os.dup(1), "w")
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    read_fd, write_fd = os.pipe()
+    os.dup2(write_fd, 1)
+    os.dup2(write_fd, 2)
+    os.close(write_fd)
+    sys.stdout = open(1, "w", buffering=1, closefd=False)
+    sys.stderr = open(2, "w", buffering=1, closefd=False)
+
+    lock = threading.Lock()
+
+    def send(message):
+        with lock:
+            proto_out.write(json.dumps(message) + "\n")
+            proto_out.flush()
+
+    forwarder = _OutputForwarder(read_fd, send)
+    forwarder.start()
+
+    def relay(record):
+        send({"id": forwarder.request_id, "type": "journal", "record": record})
+        if json.loads(proto_in.readline() or "{}").get("type") != "journaled":
+            raise OSError("The parent did not journal the change")
+
+    journal.relay_to(relay)
+    tracing.process_name(f"worker ({pwd.getpwuid(os.getuid()).pw_name})")
+    send({"type": "ready", "pid": os.getpid()})
+
+    for line in proto_in:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        forwarder.request_id = request["id"]
+        forwarder.drained.clear()
+
+        ok, error, extra = True, None, {}
+        try:
+            if request.get("type") == "end":
+                end_of_run()
+            elif request.get("type") == "prune_backups":
+                from utils import backups
+                extra["pruned"] = backups.prune(request.get("retention"))
+            else:
+                _apply(request)
+        except BaseException as e:
+            ok, error = False, f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+            if isinstance(e, KeyboardInterrupt):
+                raise
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.write(1, _MARKER_PREFIX + str(request["id"]).encode() + b"\0")
+        forwarder.drained.wait()
+        send({"id": request["id"], "type": "result", "ok": ok, "error": error, "counters": counters.take(), "trace": tracing.take(), **extra})
@@ -0,0 +1,181 @@
+"""Incremental `chown -R` / `chmod -R g+rwX`.
+
+Walks a tree with os.scandir and only changes the inodes whose owner, group or
+mode differ. Directories that were found correct are remembered with their
+(inode, mtime, ctime): as long as those don't move nothing was added, removed,
+renamed, chowned or chmodded in them, so the next run only stats them and
+doesn't even list them. Changes to the files inside such a directory that leave
+the directory alone (a chmod of one file) are caught by a full check once the
+record is older than FULL_CHECK_AGE.
+
+Skipped names (like `.git`, see DEFAULT_SKIP and `ownership_skip:` in
+config.yaml) are neither changed nor descended into.
+
+Runs in-process; what the current user isn't allowed to change is retried
+with `sudo -u USER python3 -m utils.ownership '<options as JSON>'`.
+"""
+import hashlib
+import json
+import os
+import pwd
+import stat
+import sys
+import time
+from utils import tracing
+from globals import ROOT_DIR, STATE_DIR
+
+DEFAULT_SKIP = [".git", ".venv", "venv"]
+FULL_CHECK_AGE = 7 * 24 * 3600
+
+
+class Result:
+    def __init__(self, checked=0, changed=0, unchanged_dirs=0, denied=0):
+        self.checked = checked
+        self.changed = changed
+        self.unchanged_dirs = unchanged_dirs
+        self.denied = denied
+
+    def to_dict(self):
+        return {"checked": self.checked, "changed": self.changed, "unchanged_dirs": self.unchanged_dirs, "denied": self.denied}
+
+    def __str__(self):
+        text = f"{self.changed} of {self.checked} inode(s) changed, {self.unchanged_dirs} unchanged dir(s) skipped"
+        if self.denied:
+            text += f", {self.denied} not permitted"
+        return text
+
+
+def _wanted_mode(st, group_writable):
+    mode = stat.S_IMODE(st.st_mode)
+    if group_writable:
+        mode |= 0o060
+        # X: directories, and files executable by anyone
+        if stat.S_ISDIR(st.st_mode) or mode & 0o111:
+            mode |= 0o010
+    return mode
+
+
+def _fix_one(path, st, uid, gid, group_writable, result):
+    """Fix one inode, returns False if that wasn't permitted."""
+    result.checked += 1
+    changed = False
+    ok = True
+    if (uid != -1 and st.st_uid != uid) or (gid != -1 and st.st_gid != gid):
+        try:
+            os.lchown(path, uid, gid)
+            changed = True
+        except PermissionError:
+            ok = False
+    # Like chmod -R, symlinks themselves are left alone
+    if not stat.S_ISLNK(st.st_mode):
+        mode = _wanted_mode(st, group_writable)
+        if mode != stat.S_IMODE(st.st_mode):
+            try:
+                os.chmod(path, mode)
+                changed = True
+            except PermissionError:
+                ok = False
+    if changed:
+        result.changed += 1
+    if not ok:
+        result.denied += 1
+    return ok
+
+
+def _dir_fingerprint(st):
+    return [st.st_ino, st.st_mtime_ns, st.st_ctime_ns]
+
+
+def state_file(root, uid=-1, gid=-1, group_writable=False, skip=()):
+    key = hashlib.sha256(json.dumps([str(root), uid, gid, group_writable, sorted(skip)]).encode()).hexdigest()[:16]
+    return os.path.join(STATE_DIR, f"ownership-{key}.json")
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f).get("dirs", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(path, dirs):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": 1, "dirs": dirs}, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        # The next run checks everything again
+        pass
+
+
+def fix(root, uid=-1, gid=-1, group_writable=False, skip=()):
+    """Give everything below root the owner uid and group gid (-1 keeps them) and,
+    with group_writable, the g+rwX bits. Returns a Result."""
+    root = str(root)
+    skip = set(skip)
+    path_state = state_file(root, uid, gid, group_writable, skip)
+    previous = _load(path_state)
+    dirs = {}
+    result = Result()
+    now = time.time()
+
+    stack = [("", root)]
+    while stack:
+        relative, path = stack.pop()
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        record = previous.get(relative)
+        if record and record[:3] == _dir_fingerprint(st) and now - record[4] < FULL_CHECK_AGE:
+            result.unchanged_dirs += 1
+            dirs[relative] = record
+            stack.extend((f"{relative}/{name}" if relative else name, os.path.join(path, name)) for name in record[3])
+            continue
+
+        ok = _fix_one(path, st, uid, gid, group_writable, result)
+        subdirs = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    entry_relative = f"{relative}/{entry.name}" if relative else entry.name
+                    if entry.name in skip or entry_relative in skip:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        # Fixed when it is visited itself
+                        subdirs.append(entry.name)
+                        stack.append((entry_relative, entry.path))
+                    else:
+                        ok = _fix_one(entry.path, entry.stat(follow_symlinks=False), uid, gid, group_writable, result) and ok
+        except PermissionError:
+            result.denied += 1
+            continue
+        except (FileNotFoundError, NotADirectoryError):
+            # Replaced while we were looking; its parent's record no longer matches next time
+            continue
+        if ok:
+            dirs[relative] = _dir_fingerprint(os.lstat(path)) + [subdirs, now]
+    _save(path_state, dirs)
+    return result
+
+
+def fix_as(user, root, uid=-1, gid=-1, group_writable=False, skip=()):
+    """`fix` in-process, and again as `user` through sudo for whatever the current user may not change."""
+    options = {"root": str(root), "uid": uid, "gid": gid, "group_writable": group_writable, "skip": list(skip)}
+    with tracing.span("fix ownership", cat="fs", root=str(root), user=user):
+        result = fix(**options)
+        if result.denied and os.getuid() != 0 and pwd.getpwuid(os.getuid()).pw_name != user:
+            proc = tracing.run(["sudo", "-u", user, "python3", "-m", "utils.ownership", json.dumps(options)],
+                               cwd=ROOT_DIR, capture_output=True, text=True)
+            if proc.returncode == 0:
+                retried = json.loads(proc.stdout)
+                result.changed += retried["changed"]
+                result.denied = retried["denied"]
+    return result
+
+
+if __name__ == "__main__":
+    print(json.dumps(fix(**json.loads(sys.argv[1])).to_dict()))
@@ -0,0 +1,57 @@
+"""Cache of the pruned module list (the "plan").
+
+The plan only depends on config.yaml, the environment and the facts its
+conditions asked for, so it is stored as JSON keyed by a hash of the first two,
+together with the values of those facts. Repeated runs with the same inputs
+load the plan instead of parsing YAML and pruning the config tree; only the
+recorded facts are computed again to check it.
+"""
+import hashlib
+import json
+import os
+
+from globals import STATE_DIR
+
+PLAN_FILE = STATE_DIR / "plan.json"
+
+
+def plan_key(config_bytes, env):
+    h = hashlib.sha256(config_bytes)
+    h.update(b"\0")
+    h.update(json.dumps(env, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def _load():
+    try:
+        with open(PLAN_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def recorded_facts():
+    """Names of the facts the cached plan depends on."""
+    return sorted(_load().get("facts", {}))
+
+
+def load(key, env=None):
+    """Return the cached plan for `key`, or None. With `env` (utils.facts.Facts)
+    the facts recorded with the plan must still have the same values."""
+    cached = _load()
+    if cached.get("key") != key:
+        return None
+    if env is not None and any(env.get(name) != value for name, value in cached.get("facts", {}).items()):
+        return None
+    return cached.get("plan")
+
+
+def store(key, plan, facts=None):
+    try:
+        STATE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{PLAN_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"key": key, "plan": plan, "facts": facts or {}}, f, separators=(",", ":"), default=str)
+        os.replace(tmp_path, PLAN_FILE)
+    except OSError as e:
+        print(f"[WARN] Could not cache execution plan: {e}")
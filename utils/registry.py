@@ -0,0 +1,69 @@
+"""Manifest of the modules in modules/.
+
+Finding a module's class and metadata means importing it and looking through
+it with inspect, and the main process only needs them for the scheduler: the
+entries run in workers, which import their modules themselves. So they are
+kept in state/modules.json, with the mtime and size of every module file, and
+a run only imports the modules whose files changed since (and the ones whose
+prefetch it calls).
+"""
+import json
+import os
+from globals import ROOT_DIR, STATE_DIR
+
+MODULES_DIR = ROOT_DIR / "modules"
+MANIFEST_FILE = STATE_DIR / "modules.json"
+
+_manifest = None
+
+
+def _load():
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(MANIFEST_FILE) as f:
+                _manifest = json.load(f)
+        except (OSError, ValueError):
+            _manifest = {}
+    return _manifest
+
+
+def _save():
+    try:
+        STATE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{MANIFEST_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(_manifest, f)
+        os.replace(tmp_path, MANIFEST_FILE)
+    except (OSError, TypeError):
+        # Metadata that isn't JSON is looked up again next time
+        pass
+
+
+def _inspect(name):
+    import importlib
+    import inspect
+    module = importlib.import_module(f"modules.{name}")
+    classes = [cls for _, cls in inspect.getmembers(module, inspect.isclass) if cls.__module__ == module.__name__]
+    return {"class": classes[0].__name__ if classes else None, "metadata": getattr(module, "metadata", {"name": name})}
+
+
+def get(name):
+    """{"class": class name or None, "metadata": ...} of module `name`, None if there is no modules/<name>.py."""
+    try:
+        st = os.stat(MODULES_DIR / f"{name}.py")
+    except FileNotFoundError:
+        return None
+    stamp = [st.st_mtime_ns, st.st_size]
+    manifest = _load()
+    info = manifest.get(name)
+    if info is None or info["stamp"] != stamp:
+        info = manifest[name] = dict(_inspect(name), stamp=stamp)
+        _save()
+    return info
+
+
+def module_class(name):
+    """The class of module `name`, imported."""
+    import importlib
+    return getattr(importlib.import_module(f"modules.{name}"), get(name)["class"])
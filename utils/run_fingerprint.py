@@ -0,0 +1,157 @@
+"""Fingerprint of everything a run depends on.
+
+The fingerprint covers the git HEAD, config.yaml, environment.yaml, the
+command line, the host facts used to build the environment and the ones the
+cached plan's conditions asked for, the code and files/ trees (by stat) and
+the managed targets recorded in the sync state and everything the plan's
+entries write outside the app (downloads, clones, edit outputs; by lstat). It
+is recorded after a successful run, and `main()` exits early when it has not
+changed since, unless a symlink in the sync state still goes through
+compiled_files/ (made before the generation it needs was current): the next
+run moves it to compiled_generations/current.
+
+Only the top of a target is looked at: a file changed inside a clone or a
+recursive target, dconf values and systemd unit state are not covered; use
+--force after changing those by hand.
+"""
+import glob
+import hashlib
+import json
+import os
+
+from globals import ROOT_DIR, CONFIG_FILE, ENV_FILE, FILES_DIR, STATE_DIR, COMPILED_FILES_DIR
+from utils import facts, git_refs, plan_cache
+
+FINGERPRINT_FILE = STATE_DIR / "last_run.json"
+
+# What the entries of this run write, set by run_modules
+_targets = []
+
+
+def _git_head():
+    return git_refs.read_head(git_refs.git_dir(str(ROOT_DIR))) or ""
+
+
+def _file_hash(path):
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return ""
+
+
+def _facts():
+    # Facts the cached plan's conditions asked for, besides the ones environment.yaml is built from
+    computed = facts.Facts()
+    return [[name, computed.get(name)] for name in plan_cache.recorded_facts()] + [
+        os.uname().nodename,
+        _file_hash("/etc/os-release"),
+        os.environ.get("DESKTOP_SESSION", ""),
+        os.environ.get("USER", ""),
+        os.path.isdir("/etc/pve"),
+        sorted(glob.glob("/sys/class/power_supply/BAT*")),
+    ]
+
+
+def _tree_stats(top, h):
+    stack = [str(top)]
+    while stack:
+        path = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                items = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        for item in items:
+            if item.name == "__pycache__":
+                continue
+            st = item.stat(follow_symlinks=False)
+            h.update(f"{item.path}\0{st.st_mode}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+            if item.is_dir(follow_symlinks=False):
+                stack.append(item.path)
+
+
+def set_targets(paths):
+    """Have the fingerprint cover paths, what the entries of this run write."""
+    global _targets
+    _targets = sorted(paths)
+
+
+def _state_targets():
+    """{target: record} of the sync states of all users."""
+    targets = {}
+    for state_file in sorted(glob.glob(str(STATE_DIR / "filesync-*.json"))):
+        try:
+            with open(state_file) as f:
+                targets.update(json.load(f).get("targets", {}))
+        except (OSError, ValueError):
+            continue
+    return targets
+
+
+def _links_through_compiled_files(targets):
+    for target, record in targets.items():
+        if record.get("link") and record.get("source", "").startswith(str(COMPILED_FILES_DIR) + os.sep):
+            try:
+                if os.readlink(target) == record["source"]:
+                    return True
+            except OSError:
+                pass
+    return False
+
+
+def _target_stats(h, targets, entry_targets):
+    for target in sorted(targets) + entry_targets:
+        try:
+            st = os.lstat(target)
+            h.update(f"{target}\0{st.st_dev}\0{st.st_ino}\0{st.st_mode}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_uid}\0{st.st_gid}\n".encode())
+        except OSError:
+            h.update(f"{target}\0missing\n".encode())
+
+
+def compute(args, targets):
+    h = hashlib.sha256()
+    inputs = {
+        "git": _git_head(),
+        "config": _file_hash(CONFIG_FILE),
+        "env": _file_hash(ENV_FILE),
+        "args": [sorted(args.env or []), args.user],
+        "facts": _facts(),
+    }
+    h.update(json.dumps(inputs, sort_keys=True).encode())
+    for top in (ROOT_DIR / "modules", ROOT_DIR / "utils", FILES_DIR):
+        _tree_stats(top, h)
+    for name in ("syncsmith.py", "globals.py"):
+        st = os.stat(ROOT_DIR / name)
+        h.update(f"{name}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    _target_stats(h, _state_targets(), targets)
+    return h.hexdigest()
+
+
+def is_unchanged(args):
+    try:
+        with open(FINGERPRINT_FILE) as f:
+            recorded = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if _links_through_compiled_files(_state_targets()):
+        return False
+    return recorded.get("fingerprint") == compute(args, recorded.get("targets", []))
+
+
+def record(args):
+    try:
+        STATE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{FINGERPRINT_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"fingerprint": compute(args, _targets), "targets": _targets}, f)
+        os.replace(tmp_path, FINGERPRINT_FILE)
+    except OSError as e:
+        print(f"[WARN] Could not record run fingerprint: {e}")
+
+
+def clear():
+    try:
+        os.unlink(FINGERPRINT_FILE)
+    except FileNotFoundError:
+        pass
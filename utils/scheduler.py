@@ -0,0 +1,310 @@
+"""Dependency-aware scheduling of module entries.
+
+Every entry declares the paths it reads and writes through the `paths` key of
+its module's `metadata`. Values are config field names ("source", "target"),
+lists of field names of which the first one present is used (["output",
+"file"]), or literal paths ("~/.bashrc", "/etc/systemd") and pseudo resources
+("dconf:/org/gnome/"). "dconf:{paths}" expands to one resource per value of the
+`paths` field. An entry depends on every earlier entry it conflicts
+with, i.e. one writes a path the other reads or writes (a path also covers
+everything below it). Entries of modules without `paths` are barriers.
+
+Entries can also name an `id:` and list `after:` ids (or module names) to add
+explicit dependencies.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from globals import COMPILED_FILES_DIR, FILES_DIR
+
+
+class Entry:
+    def __init__(self, index, conf, class_name, meta, user):
+        self.index = index
+        self.conf = conf
+        self.name = conf["name"]
+        self.class_name = class_name
+        self.meta = meta
+        self.user = user
+        self.reads = set()
+        self.writes = set()
+        self.barrier = "paths" not in meta
+        self.deps = set()
+        self.dependents = set()
+
+    @property
+    def label(self):
+        return self.conf.get("id", self.name)
+
+
+def _is_literal(value):
+    return value.startswith(("/", "~")) or ":" in value
+
+
+def _normalize(value, home):
+    if ":" in value and not value.startswith(("/", "~")):
+        return value.rstrip("/")
+    if value.startswith("~"):
+        value = home + value[1:]
+    elif not os.path.isabs(value):
+        value = os.path.join(COMPILED_FILES_DIR, value)
+
+    # `dir/*` and similar patterns touch the directory itself
+    parts = value.split("/")
+    while parts and any(c in parts[-1] for c in "*?["):
+        parts.pop()
+    return os.path.normpath("/".join(parts) or "/")
+
+
+def resolve_paths(entry, home):
+    """Fill `entry.reads` and `entry.writes` from the module's `paths` metadata."""
+    if entry.barrier:
+        return
+    for kind in ("reads", "writes"):
+        for item in entry.meta["paths"].get(kind, []):
+            if isinstance(item, list):
+                item = next((field for field in item if field in entry.conf), None)
+                if item is None:
+                    continue
+            if "{" in item:
+                field = item[item.index("{") + 1:item.index("}")]
+                fields = entry.conf.get(field)
+                values = [item.replace("{" + field + "}", str(value)) for value in ([fields] if isinstance(fields, str) else fields or [])]
+            else:
+                values = [item] if _is_literal(item) else entry.conf.get(item)
+            if isinstance(values, str):
+                values = [values]
+            for value in values or []:
+                getattr(entry, kind).add(_normalize(str(value), home))
+
+
+def _ancestors(path):
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path or not parent:
+            return
+        path = parent
+        yield path
+
+
+class _PathIndex:
+    """Maps paths to the entries that touched them, including whole subtrees."""
+
+    def __init__(self):
+        self.exact = {}
+        self.below = {}
+
+    def add(self, path, index):
+        self.exact.setdefault(path, set()).add(index)
+        for ancestor in _ancestors(path):
+            self.below.setdefault(ancestor, set()).add(index)
+
+    def overlapping(self, path):
+        found = set(self.exact.get(path, ()))
+        found.update(self.below.get(path, ()))
+        for ancestor in _ancestors(path):
+            found.update(self.exact.get(ancestor, ()))
+        return found
+
+
+def build_graph(entries):
+    """Compute `deps`/`dependents` for entries, which must be in config order."""
+    readers = _PathIndex()
+    writers = _PathIndex()
+    last_barrier = None
+    since_barrier = []
+
+    for entry in entries:
+        if entry.barrier:
+            entry.deps.update(since_barrier)
+            if last_barrier is not None:
+                entry.deps.add(last_barrier)
+            last_barrier = entry.index
+            since_barrier = []
+            continue
+
+        if last_barrier is not None:
+            entry.deps.add(last_barrier)
+        for path in entry.reads | entry.writes:
+            entry.deps.update(writers.overlapping(path))
+        for path in entry.writes:
+            entry.deps.update(readers.overlapping(path))
+
+        for path in entry.reads:
+            readers.add(path, entry.index)
+        for path in entry.writes:
+            writers.add(path, entry.index)
+        since_barrier.append(entry.index)
+
+    by_label = {}
+    for entry in entries:
+        if "id" in entry.conf:
+            by_label.setdefault(entry.conf["id"], []).append(entry.index)
+        by_label.setdefault(entry.name, []).append(entry.index)
+
+    for entry in entries:
+        after = entry.conf.get("after", [])
+        if isinstance(after, str):
+            after = [after]
+        for label in after:
+            if label not in by_label:
+                raise ValueError(f"Entry '{entry.label}' is configured to run after unknown entry '{label}'")
+            entry.deps.update(i for i in by_label[label] if i != entry.index)
+
+    for entry in entries:
+        for dep in entry.deps:
+            entries[dep].dependents.add(entry.index)
+
+    _check_cycles(entries)
+
+
+def affected(entries, paths):
+    """Indices of the entries to run again after `paths` changed: the entries reading them
+    (a change below files/ also counts for the same path below compiled_files/, as modules
+    fall back to it), everything depending on those, and every entry writing a compiled
+    file one of them writes, since that file is recompiled from scratch."""
+    readers = _PathIndex()
+    writers = _PathIndex()
+    for entry in entries:
+        for path in entry.reads:
+            readers.add(path, entry.index)
+        for path in entry.writes:
+            writers.add(path, entry.index)
+
+    selected = set()
+    for path in paths:
+        path = os.path.normpath(str(path))
+        selected |= readers.overlapping(path)
+        relative = os.path.relpath(path, FILES_DIR)
+        if relative != ".." and not relative.startswith(".." + os.sep):
+            selected |= readers.overlapping(os.path.normpath(os.path.join(COMPILED_FILES_DIR, relative)))
+
+    stack = list(selected)
+    while stack:
+        entry = entries[stack.pop()]
+        more = set(entry.dependents)
+        for path in entry.writes:
+            if path.startswith(str(COMPILED_FILES_DIR) + os.sep):
+                more |= writers.overlapping(path)
+        for index in more - selected:
+            selected.add(index)
+            stack.append(index)
+    return selected
+
+
+def _check_cycles(entries):
+    remaining = {entry.index: len(entry.deps) for entry in entries}
+    ready = [index for index, count in remaining.items() if count == 0]
+    seen = 0
+    while ready:
+        index = ready.pop()
+        seen += 1
+        for dependent in entries[index].dependents:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+    if seen != len(entries):
+        stuck = [entries[i].label for i, count in remaining.items() if count > 0]
+        raise ValueError(f"Dependency cycle between entries: {', '.join(stuck)}")
+
+
+def run_graph(entries, run_entry, jobs=1, write=None):
+    """Run entries respecting dependencies with at most `jobs` at a time.
+
+    `run_entry(entry, out)` applies an entry, writing its output through `out`,
+    and returns True on success. With one job output is streamed as is; with
+    more it is buffered per entry and written in config order, each line
+    prefixed with the entry's position, so logs are the same on every run.
+
+    Entries depending on a failed entry are skipped. Returns the failed and
+    skipped entries.
+    """
+    failed = []
+    remaining = {entry.index: len(entry.deps) for entry in entries}
+    ready = sorted(index for index, count in remaining.items() if count == 0)
+    buffers = {}
+    done = set()
+    next_to_print = 0
+    lock = threading.Lock()
+    width = len(str(len(entries)))
+
+    def flush_in_order():
+        nonlocal next_to_print
+        while next_to_print < len(entries) and next_to_print in done:
+            entry = entries[next_to_print]
+            prefix = f"[{entry.index + 1:>{width}}/{len(entries)} {entry.label}] "
+            text = "".join(buffers.pop(next_to_print, []))
+            if text:
+                write("".join(prefix + line for line in text.splitlines(keepends=True)))
+                if not text.endswith("\n"):
+                    write("\n")
+            next_to_print += 1
+
+    def finish(entry, ok):
+        if not ok:
+            failed.append(entry)
+        done.add(entry.index)
+        for dependent in entry.dependents:
+            if dependent in done:
+                continue
+            remaining[dependent] -= 1
+            if ok and remaining[dependent] == 0:
+                ready.append(dependent)
+        ready.sort()
+
+    def skip_dependents(entry):
+        stack = sorted(entry.dependents)
+        while stack:
+            dependent = entries[stack.pop()]
+            if dependent.index in done:
+                continue
+            message = f"[WARN] Skipping '{dependent.label}' because '{entry.label}' did not complete.\n"
+            if jobs == 1:
+                write(message)
+            else:
+                buffers.setdefault(dependent.index, []).append(message)
+            failed.append(dependent)
+            done.add(dependent.index)
+            stack.extend(dependent.dependents)
+
+    if jobs == 1:
+        while ready:
+            entry = entries[ready.pop(0)]
+            ok = run_entry(entry, write)
+            finish(entry, ok)
+            if not ok:
+                skip_dependents(entry)
+        return failed
+
+    def run_buffered(entry):
+        buffer = buffers.setdefault(entry.index, [])
+
+        def out(text):
+            with lock:
+                buffer.append(text)
+
+        try:
+            return run_entry(entry, out)
+        except Exception as e:
+            out(f"[ERROR] {e}\n")
+            return False
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        running = {}
+        while ready or running:
+            while ready and len(running) < jobs:
+                entry = entries[ready.pop(0)]
+                running[pool.submit(run_buffered, entry)] = entry
+
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in completed:
+                entry = running.pop(future)
+                ok = future.result()
+                with lock:
+                    finish(entry, ok)
+                    if not ok:
+                        skip_dependents(entry)
+                    flush_in_order()
+
+    return failed
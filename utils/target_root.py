@@ -0,0 +1,106 @@
+"""Applying into another root directory, like a container image, chroot or mounted VM disk.
+
+`syncsmith.py --root DIR` runs syncsmith once per root, each in its own process
+with SYNCSMITH_TARGET_ROOT set (see globals.py). In such a run modules put their
+targets below the root: `path()` maps an absolute (and `~`-expanded) target
+path into it, resolving symlinks the way they resolve inside the root, and the
+target user, their home and groups are looked up in the root's /etc/passwd and
+/etc/group, so `~` is the user's home inside the root.
+
+Only modules with `"target_root": True` in their metadata run; the others act
+on the live session (dconf) and are skipped.
+"""
+import errno
+import grp
+import os
+import pwd
+from functools import lru_cache
+from globals import TARGET_ROOT
+
+TARGET_ROOT_ENV = "SYNCSMITH_TARGET_ROOT"
+
+
+def active():
+    return TARGET_ROOT is not None
+
+
+# Symlinks followed for one path before giving up, as the kernel does (ELOOP)
+MAX_SYMLINKS = 40
+
+
+@lru_cache(maxsize=None)
+def _real_root():
+    return os.path.realpath(TARGET_ROOT)
+
+
+def path(target, follow=False):
+    """`target` inside the target root, if there is one. Relative paths are left alone.
+
+    Symlinks on the way are resolved one component at a time as if the root were /,
+    like in a chroot (or openat2 with RESOLVE_IN_ROOT): an absolute link starts over
+    at the root and `..` stops there, so no link in the root leads out of it. The
+    last component is only followed with follow=True (or a trailing slash); modules
+    replace what is there rather than write through it.
+    """
+    if TARGET_ROOT is None or not os.path.isabs(target):
+        return target
+    root = _real_root()
+    pending = [part for part in target.split("/") if part and part != "."]
+    last = None if follow or target.endswith("/") or not pending or pending[-1] == ".." else pending.pop()
+    pending.reverse()
+    resolved = []
+    links = 0
+    while pending:
+        part = pending.pop()
+        if part == "..":
+            if resolved:
+                resolved.pop()
+            continue
+        candidate = os.path.join(root, *resolved, part)
+        if not os.path.islink(candidate):
+            resolved.append(part)
+            continue
+        links += 1
+        if links > MAX_SYMLINKS:
+            raise OSError(errno.ELOOP, f"Too many levels of symbolic links in {TARGET_ROOT}", target)
+        link = os.readlink(candidate)
+        if link.startswith("/"):
+            resolved = []
+        pending.extend(reversed([item for item in link.split("/") if item and item != "."]))
+    result = os.path.join(root, *resolved, *([last] if last else []))
+    return result + "/" if target.endswith("/") else result
+
+
+@lru_cache(maxsize=None)
+def _database(name):
+    """Lines of the root's /etc/passwd or /etc/group, split into fields."""
+    try:
+        with open(os.path.join(TARGET_ROOT, "etc", name)) as f:
+            return [line.rstrip("\n").split(":") for line in f if line.strip() and not line.startswith("#")]
+    except OSError:
+        return []
+
+
+def user(name):
+    """(uid, gid, home) of a user, from the target root if there is one. Raises KeyError."""
+    if TARGET_ROOT is not None:
+        for fields in _database("passwd"):
+            if len(fields) >= 6 and fields[0] == name:
+                return int(fields[2]), int(fields[3]), fields[5]
+    entry = pwd.getpwnam(name)
+    return entry.pw_uid, entry.pw_gid, entry.pw_dir
+
+
+def group(name):
+    """gid of a group, from the target root if there is one. Raises KeyError."""
+    if TARGET_ROOT is not None:
+        for fields in _database("group"):
+            if len(fields) >= 3 and fields[0] == name:
+                return int(fields[2])
+    return grp.getgrnam(name).gr_gid
+
+
+def parse_spec(spec):
+    """`DIR[:key=value,...]` from the command line into (DIR, ["key=value", ...])."""
+    root, _, env = spec.partition(":")
+    return os.path.abspath(root), [item for item in env.split(",") if item]
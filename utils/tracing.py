@@ -0,0 +1,119 @@
+"""Chrome trace / Perfetto compatible tracing for `--profile`.
+
+Spans are recorded as complete ("X") events with wall-clock microsecond
+timestamps, so events from the parent, workers and per-entry subprocesses
+line up on one timeline. Every span also bumps a per-name count, emitted as
+a counter ("C") event per process.
+
+Tracing is off unless `enable()` is called or SYNCSMITH_TRACE (or
+SYNCSMITH_TRACE_FILE) is set. Workers send their events back with each result;
+per-entry subprocesses append them to SYNCSMITH_TRACE_FILE, their own file in
+a directory only the run can list, one JSON list per line.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+TRACE_ENV = "SYNCSMITH_TRACE"
+TRACE_FILE_ENV = "SYNCSMITH_TRACE_FILE"
+
+_enabled = bool(os.environ.get(TRACE_ENV) or os.environ.get(TRACE_FILE_ENV))
+_events = []
+_counts = {}
+_lock = threading.Lock()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def enabled():
+    return _enabled
+
+
+def _now_us():
+    return time.time_ns() // 1000
+
+
+@contextmanager
+def span(name, cat="syncsmith", **args):
+    """Record the time spent in the `with` block as one event."""
+    if not _enabled:
+        yield
+        return
+    start = _now_us()
+    try:
+        yield
+    finally:
+        event = {"name": name, "cat": cat, "ph": "X", "ts": start, "dur": _now_us() - start,
+                 "pid": os.getpid(), "tid": threading.get_ident()}
+        if args:
+            event["args"] = {k: str(v) for k, v in args.items()}
+        with _lock:
+            _events.append(event)
+            _counts[f"{cat}:{name}"] = _counts.get(f"{cat}:{name}", 0) + 1
+
+
+def process_name(name):
+    if _enabled:
+        with _lock:
+            _events.append({"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": name}})
+
+
+def run(cmd, cat="command", **kwargs):
+    """subprocess.run with a span named after the command."""
+    import subprocess
+    with span(cmd[0] if isinstance(cmd, list) else cmd.split()[0], cat=cat, cmd=cmd if isinstance(cmd, str) else " ".join(cmd)):
+        return subprocess.run(cmd, **kwargs)
+
+
+def system(command, cat="command"):
+    """os.system with a span named after the command."""
+    with span(command.split()[0], cat=cat, cmd=command):
+        return os.system(command)
+
+
+def take():
+    """Return the events recorded so far, plus a counter event, and start over."""
+    with _lock:
+        events = list(_events)
+        if _counts:
+            events.append({"name": "operations", "ph": "C", "ts": _now_us(), "pid": os.getpid(), "args": dict(_counts)})
+        _events.clear()
+        _counts.clear()
+    return events
+
+
+def add(events):
+    with _lock:
+        _events.extend(events)
+
+
+def dump():
+    """Append this process' events to the trace file, if one is set."""
+    path = os.environ.get(TRACE_FILE_ENV)
+    events = take()
+    if path and events:
+        try:
+            with open(path, "a") as f:
+                f.write(json.dumps(events) + "\n")
+        except OSError:
+            pass
+
+
+def load(path):
+    events = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    events.extend(json.loads(line))
+    return events
+
+
+def write(path, events):
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,173 @@
+"""File watching for --watch, on inotify through ctypes.
+
+A Watcher watches directory trees recursively (new directories are picked up
+as they appear) and single files (through their directory, since editors
+usually replace files instead of writing them in place). `wait()` blocks
+until something changed, then keeps collecting events until none came for
+`debounce` seconds (or `max_delay` passed) and returns the changed paths.
+
+Memory stays bounded: events are read in fixed-size chunks, changed paths are
+deduplicated, and once more than `max_pending` paths are pending (or the
+kernel queue overflowed) only an overflow flag is kept, meaning "assume
+everything changed".
+
+Nothing here depends on syncsmith's layout, so it can be pointed at a
+temporary directory.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+# Content changes count once the file is closed, not on every write()
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+_EVENT = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1: {os.strerror(error)}")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_add_watch: {os.strerror(error)}", path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read(self):
+        """Yield (wd, mask, name) for every queued event, without blocking."""
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                yield wd, mask, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    def __init__(self, trees=(), files=(), debounce=0.3, max_delay=2.0, max_pending=4096):
+        self.inotify = Inotify()
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        # wd -> directory, and for directories watched for single files the names that count
+        self.dirs = {}
+        self.only = {}
+        self.pending = set()
+        self.overflow = False
+        for tree in trees:
+            self._watch_tree(str(tree))
+        for path in files:
+            directory, name = os.path.split(os.path.abspath(str(path)))
+            wd = self.inotify.add_watch(directory)
+            self.dirs[wd] = directory
+            self.only.setdefault(wd, set()).add(name)
+
+    def _watch_tree(self, top):
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            try:
+                wd = self.inotify.add_watch(directory)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    # Out of watches (fs.inotify.max_user_watches): changes below here can be missed
+                    self.overflow = True
+                    return
+                continue
+            self.dirs[wd] = directory
+            try:
+                with os.scandir(directory) as it:
+                    stack.extend(entry.path for entry in it if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def _add(self, path):
+        if self.overflow:
+            return
+        if len(self.pending) >= self.max_pending:
+            self.overflow = True
+            self.pending.clear()
+        else:
+            self.pending.add(path)
+
+    def _process(self):
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self.overflow = True
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.dirs[wd]
+                self.only.pop(wd, None)
+                continue
+            if wd in self.only and name not in self.only[wd]:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wd not in self.only:
+                self._watch_tree(path)
+            self._add(path)
+
+    def _poll(self, timeout):
+        poller = select.poll()
+        poller.register(self.inotify.fd, select.POLLIN)
+        return bool(poller.poll(None if timeout is None else max(0, timeout) * 1000))
+
+    def wait(self, timeout=None):
+        """Wait for changes and return (changed paths, overflow), or None if timeout passed first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # Events for other files in a directory watched for single files don't count
+        while not self.pending and not self.overflow:
+            if not self._poll(None if deadline is None else deadline - time.monotonic()):
+                return None
+            self._process()
+        first = time.monotonic()
+        while time.monotonic() - first < self.max_delay:
+            if not self._poll(min(self.debounce, self.max_delay - (time.monotonic() - first))):
+                break
+            self._process()
+        changed, overflow = self.pending, self.overflow
+        self.pending, self.overflow = set(), False
+        return changed, overflow
+
+    def close(self):
+        self.inotify.close()